@@ -12,6 +12,8 @@
 #              Maurer distance map is used to inflate and deflate each bone. 
 #              Holes are filled inside each bone.
 #              There are 7 steps. Each bone has to run Steps 3-7 separately.
+#              Optionally, all bones are extracted at Step 3 and contoured in
+#              worker processes, and each bone is pasted back at its Step 7.
 #
 #-----------------------------------------------------
 # Usage:       This module is plugged into 3D Slicer.
@@ -24,11 +26,51 @@
 #              dilateErodeRadius: morphological dilate/erode kernel radius in voxels
 #              boneNum: Number of separate bone structures
 #              roughMask: The file path of optional rough mask that helps separate bones
+#              boneWorkers: Number of worker processes that contour the bones in parallel,
+#                           default=0 (one bone after the other)
 #
 #-----------------------------------------------------
 import SimpleITK as sitk
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 from .AutocontourKnee import AutocontourKnee
+try:
+    from .FillHole import fillHoleSlices
+except ImportError: # run as a script, e.g. from AutomaticContourCmd
+    from FillHole import fillHoleSlices
+
+def _initWorker(threads):
+    """
+    Limit the number of ITK threads in each worker process.
+    """
+    if threads:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+def _contourBone(img, foreground, params):
+    """
+    Run Steps 4-6 on one extracted bone in a worker process.
+
+    Args:
+        img (Image): extracted bone, from extract()
+        foreground (int): label of the bone
+        params (dict): sigma, lower, upper, dilateErodeRadius,
+                       and smoothen, True if img is the greyscale scan
+
+    Returns:
+        Image
+    """
+    contour = ContourLogic(lower=params['lower'], upper=params['upper'], sigma=params['sigma'],
+                           dilateErodeRadius=params['dilateErodeRadius'])
+    radius = params['dilateErodeRadius']
+    if params['smoothen']:
+        img = contour.smoothen(img, params['sigma'], params['lower'], params['upper'],
+                               foreground=foreground)
+    img = contour.inflate(img, radius=radius, foreground=foreground)
+    img = contour.fillHole(img, foreground)
+    img = contour.deflate(img, radius=radius, foreground=foreground)
+
+    return img
 
 class ContourLogic:
     """This class provides methods for automatic contouring"""
@@ -51,6 +93,10 @@ class ContourLogic:
         self._boundingbox = ()              # bounding box of extracted image, will be reused
         self.thresh_method = None
         self.auto_thresh = False
+        self.boneWorkers = 0                # number of worker processes for the bones
+        self._executor = None               # pool of the bone workers, will be reused
+        self._futures = {}                  # contoured bone of each label, will be modified
+        self._boundingboxes = {}            # bounding box of each extracted bone
 
     def smoothen(self, img, sigma, lower, upper, foreground=1):
         """
@@ -271,44 +317,9 @@ class ContourLogic:
         Returns:
             Image
         """
-        # get img info
-        width = img.GetWidth()
-        height = img.GetHeight()
-        depth = img.GetDepth()
-
-        fill_hole_filter = sitk.BinaryFillholeImageFilter()
-        fill_hole_filter.SetForegroundValue(foreground)
-        
         print("Applying fill hole filter")
-        vectorOfImages = sitk.VectorOfImage()
-        # apply fill hole filter slice by slice in z direction
-        for i in range(depth):
-            im = img[:,:,i]
-            contour = fill_hole_filter.Execute(im)
-            vectorOfImages.push_back(contour)
-        fill_hole_img = sitk.JoinSeries(vectorOfImages)
-        vectorOfImages.clear()
-        fill_hole_img.CopyInformation(img)
-        # apply fill hole filter slice by slice in y direction
-        for j in range(height):
-            im = img[:,j,:]
-            contour = fill_hole_filter.Execute(im)
-            vectorOfImages.push_back(contour)
-        fill_hole_img2 = sitk.JoinSeries(vectorOfImages)
-        vectorOfImages.clear()
-        fill_hole_img2 = sitk.PermuteAxes(fill_hole_img2, (0,2,1))
-        fill_hole_img2.CopyInformation(img)
-        # apply fill hole filter slice by slice in x direction
-        for k in range(width):
-            im = img[k,:,:]
-            contour = fill_hole_filter.Execute(im)
-            vectorOfImages.push_back(contour)
-        fill_hole_img3 = sitk.JoinSeries(vectorOfImages)
-        vectorOfImages.clear()
-        fill_hole_img3 = sitk.PermuteAxes(fill_hole_img3, (2,0,1))
-        fill_hole_img3.CopyInformation(img)
-
-        fill_hole_img = fill_hole_img | fill_hole_img2 | fill_hole_img3
+        # all slices along an axis are filled in one call, the axes run in parallel threads
+        fill_hole_img = fillHoleSlices(img, foreground)
 
         return fill_hole_img
 
@@ -414,12 +425,10 @@ class ContourLogic:
         img = self.convert_hu_to_bmd(img, mu_water, rescale_slope, rescale_intercept)
 
         auto_contour = AutocontourKnee()
-        masks = []
 
-        # Find mask for each bone
-        for i in range(boneNum):
-            mask = auto_contour.get_periosteal_mask(img, i+1)
-            masks.append(mask)
+        # Find mask for each bone, sharing the labelling of the bones
+        masks = auto_contour.get_periosteal_masks(img, list(range(1, boneNum+1)),
+                                                  workers=max(self.boneWorkers, 1))
 
         # return array of masks for each bone
         return masks
@@ -455,6 +464,10 @@ class ContourLogic:
                 else:                        # separate bones with rough mask
                     self.label_img = self.roughMask
                     self.label_image = self.relabelWithMap(self.img, self.roughMask)
+            elif step == 3 and self.boneWorkers > 0 and self.boneNum > 1:
+                self._submitBones()
+            elif self._futures and actual_step < 7:
+                pass # the bone is contoured in a worker process
             elif actual_step == 3: # step 3
                 if (self.roughMask is None):
                     self.img = self.extract(self.label_img, self.label_img, foreground=self.boneNum)
@@ -469,6 +482,8 @@ class ContourLogic:
             elif actual_step == 6: # step 6
                 self.img = self.deflate(self.img, radius=self.dilateErodeRadius, foreground=self.boneNum)
             elif actual_step == 7: # step 7
+                if self._futures:
+                    self.img = self._collectBone(self.boneNum)
                 # one bone structure completed
                 if (self.output_img is None): # store first bone in output_img
                     self.output_img = self.pasteBack(self.img)
@@ -530,6 +545,14 @@ class ContourLogic:
             self.boneNum = boneNum
         self.stepNum = 5 * boneNum + 2
     
+    def setBoneWorkers(self, boneWorkers):
+        """
+        Args:
+            boneWorkers (int): Number of worker processes that contour the bones
+                               in parallel, 0 to contour one bone after the other
+        """
+        self.boneWorkers = boneWorkers
+
     def setDilateErodeRadius(self, dilateErodeRadius):
         """
         Args:
@@ -542,6 +565,58 @@ class ContourLogic:
         Reset internal parameters.
         """
         self.output_img = None
+        self._shutdownBones()
+
+    def _submitBones(self):
+        """
+        Extract every bone and contour them in worker processes.
+        """
+        workers = min(self.boneWorkers, self.boneNum)
+        threads = max((os.cpu_count() or 1) // workers, 1)
+        params = {'sigma': self.sigma,
+                  'lower': self.lower_threshold,
+                  'upper': self.upper_threshold,
+                  'dilateErodeRadius': self.dilateErodeRadius,
+                  'smoothen': self.roughMask is not None}
+
+        self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_initWorker,
+                                             initargs=(threads,))
+        # submit in the order of the steps, so that the first bone to paste back is started first
+        for foreground in range(self.boneNum, 0, -1):
+            if (self.roughMask is None):
+                extract_img = self.extract(self.label_img, self.label_img, foreground=foreground)
+            else:
+                extract_img = self.extract(self.model_img, self.label_img, foreground=foreground)
+            self._boundingboxes[foreground] = self._boundingbox
+            self._futures[foreground] = self._executor.submit(_contourBone, extract_img,
+                                                              foreground, params)
+
+    def _collectBone(self, foreground):
+        """
+        Wait for the worker that contours the bone.
+
+        Args:
+            foreground (int): label of the bone
+
+        Returns:
+            Image: contoured bone, to be pasted back
+        """
+        img = self._futures.pop(foreground).result()
+        self._boundingbox = self._boundingboxes.pop(foreground)
+        if not self._futures:
+            self._shutdownBones()
+
+        return img
+
+    def _shutdownBones(self):
+        """
+        Stop the bone workers.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+        self._futures = {}
+        self._boundingboxes = {}
 
     def getStepNum(self):
         """
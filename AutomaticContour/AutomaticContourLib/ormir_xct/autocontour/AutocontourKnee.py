@@ -1,4 +1,6 @@
 import SimpleITK as sitk
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 # import yaml
 
@@ -70,22 +72,31 @@ class AutocontourKnee:
     USE_SPACING : bool
         Needed for the procedural interface of the sitk gaussian filter.
 
+    GAUSSIAN_PROBE_RADIUS : int
+        Half size of the impulse image used to measure the gaussian kernel.
+
     Methods
     -------
     _gaussian_and_threshold(img, sigma, support, lower, upper)
 
-    _get_largest_connected_component(img)
+    _masked_gaussian_and_threshold(img, mask, sigma, support, lower, upper)
+
+    _get_largest_connected_component(img, index, full_size)
 
     _inert_binary_image(img)
 
-    _close_with_connected_components(img, radius)
+    _close_with_connected_components(img, radius, index, full_size)
 
-    get_periosteal_mask(img)
+    get_periosteal_mask(img, component)
+
+    get_periosteal_masks(img, components, workers)
 
     get_endosteal_mask(img, peri)
 
     get_masks(img)
 
+    clear_gaussian_cache()
+
     """
 
     def __init__(
@@ -270,6 +281,11 @@ class AutocontourKnee:
 
         self.DEFAULT_MAX_ERROR = 0.01
         self.USE_SPACING = False
+        self.GAUSSIAN_PROBE_RADIUS = 16
+
+        self._gaussian_cache = {}  # smoothed image by (sigma, support)
+        self._gaussian_cache_img = None  # image of the cached smoothed images
+        self._gaussian_radii = {}  # kernel radius by (sigma, support, spacing)
 
     def _gaussian_and_threshold(self, img, sigma, support, lower, upper):
         """
@@ -298,7 +314,43 @@ class AutocontourKnee:
             The binarized image.
         """
 
-        # gaussian filtering
+        # gaussian filtering, reused for the same image and parameters
+        if self._gaussian_cache_img is not img:
+            self.clear_gaussian_cache()
+            self._gaussian_cache_img = img
+        img_gauss = self._gaussian_cache.get((sigma, support))
+        if img_gauss is None:
+            img_gauss = self._gaussian(img, sigma, support)
+            self._gaussian_cache[(sigma, support)] = img_gauss
+
+        # binary segmentation
+        img_segmented = sitk.BinaryThreshold(
+            img_gauss, lower, upper, self.in_value, self.out_value
+        )
+
+        return img_segmented
+
+    def _gaussian(self, img, sigma, support):
+        """
+        Gaussian smooth an image.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The input image.
+
+        sigma : float
+            Variance for the gaussian filtering.
+
+        support : int
+            Support for the gaussian filtering.
+
+        Returns
+        -------
+        sitk.Image
+            The smoothed image.
+        """
+
         # Suppress warnings from the Gaussian function about kernel size
         sitk.ProcessObject_SetGlobalWarningDisplay(False)
         img_gauss = sitk.DiscreteGaussian(
@@ -306,14 +358,132 @@ class AutocontourKnee:
         )
         sitk.ProcessObject_SetGlobalWarningDisplay(True)
 
-        # binary segmentation
-        img_segmented = sitk.BinaryThreshold(
-            img_gauss, lower, upper, self.in_value, self.out_value
+        return img_gauss
+
+    def _gaussian_radius(self, img, sigma, support):
+        """
+        Radius of the gaussian kernel in voxels, measured once per sigma and
+        support by smoothing an impulse.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The input image, for the voxel spacing.
+
+        sigma : float
+            Variance for the gaussian filtering.
+
+        support : int
+            Support for the gaussian filtering.
+
+        Returns
+        -------
+        list of int
+            The (x,y,z) radius.
+        """
+
+        key = (sigma, support, img.GetSpacing())
+        if key not in self._gaussian_radii:
+            probe_size = 2 * self.GAUSSIAN_PROBE_RADIUS + 1
+            probe = np.zeros([probe_size] * 3, dtype=np.float32)
+            probe[(self.GAUSSIAN_PROBE_RADIUS,) * 3] = 1
+            probe_img = sitk.GetImageFromArray(probe)
+            probe_img.SetSpacing(img.GetSpacing())
+            probe = sitk.GetArrayFromImage(self._gaussian(probe_img, sigma, support))
+
+            radius = []
+            for array_axis in (2, 1, 0):
+                other_axes = tuple(a for a in range(3) if a != array_axis)
+                nonzero = np.flatnonzero(np.any(probe != 0, axis=other_axes))
+                radius.append(int(self.GAUSSIAN_PROBE_RADIUS - nonzero[0]))
+            self._gaussian_radii[key] = radius
+
+        return self._gaussian_radii[key]
+
+    def _masked_gaussian_and_threshold(self, img, mask, sigma, support, lower, upper):
+        """
+        Gaussian smooth and binarize the image masked by a mask, like
+        _gaussian_and_threshold(sitk.Mask(img, mask), ...). The masked image
+        is zero away from the mask, so only the bounding box of the mask padded
+        by the gaussian kernel is smoothed, and the result is pasted back.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The input image.
+
+        mask : sitk.Image
+            The binary mask.
+
+        sigma : float
+            Variance for the gaussian filtering.
+
+        support : int
+            Support for the gaussian filtering.
+
+        lower: float
+            Lower threshold for the binarization.
+
+        upper : float
+            Upper threshold for the binarization.
+
+        Returns
+        -------
+        sitk.Image
+            The binarized image.
+        """
+
+        # value of the binarized image where the smoothed image is zero
+        outside = self.in_value if lower <= 0 <= upper else self.out_value
+        img_segmented = sitk.Image(img.GetSize(), sitk.sitkUInt8) + outside
+        img_segmented.CopyInformation(img)
+
+        shape_filter = sitk.LabelShapeStatisticsImageFilter()
+        shape_filter.ComputePerimeterOff()
+        shape_filter.Execute(mask != 0)
+        if not shape_filter.HasLabel(1):
+            return img_segmented
+
+        # bounding box padded by the kernel, beyond it the masked image stays
+        # zero after smoothing
+        box = shape_filter.GetBoundingBox(1)
+        radius = self._gaussian_radius(img, sigma, support)
+        index = [max(box[i] - radius[i] - 1, 0) for i in range(3)]
+        upper_index = [
+            min(box[i] + box[i + 3] + radius[i] + 1, img.GetSize()[i]) for i in range(3)
+        ]
+        size = [upper_index[i] - index[i] for i in range(3)]
+
+        img_box = sitk.Mask(
+            sitk.RegionOfInterest(img, size, index),
+            sitk.RegionOfInterest(mask, size, index),
+        )
+        img_box = sitk.BinaryThreshold(
+            self._gaussian(img_box, sigma, support),
+            lower,
+            upper,
+            self.in_value,
+            self.out_value,
         )
 
-        return img_segmented
+        return sitk.Paste(img_segmented, img_box, size, [0, 0, 0], index)
 
-    def _get_largest_connected_component(self, img):
+    def clear_gaussian_cache(self):
+        """
+        Release the gaussian smoothed images kept for reuse.
+        """
+
+        self._gaussian_cache = {}
+        self._gaussian_cache_img = None
+
+    def __getstate__(self):
+        # the cached images are not sent to worker processes
+        state = self.__dict__.copy()
+        state["_gaussian_cache"] = {}
+        state["_gaussian_cache_img"] = None
+        return state
+
+    def _get_largest_connected_component(self, img, index=None, full_size=None):
         """
         Get the largest connected component in a binary image.
 
@@ -322,18 +492,73 @@ class AutocontourKnee:
         img : sitk.Image
             The binary image to filter.
 
+        index : list of int
+            If img is a region of a larger image that is foreground everywhere
+            outside of the region, the index of the region in that image. The
+            components on the faces of the region then also count the
+            voxels outside of it. Default is None.
+
+        full_size : list of int
+            The size of the larger image. Default is None.
+
         Returns
         -------
         sitk.Image
             A binary image containing only the largest connected component from
-            the input image.
+            the input image. None if the largest component of the larger image
+            leaves out some of the voxels outside of the region.
         """
 
         img_conn = sitk.ConnectedComponent(img, img, True)
-        img_conn = sitk.RelabelComponent(img_conn, sortByObjectSize=True)
-        img_conn = self.in_value * (img_conn == 1)
+        if full_size is None:
+            img_conn = sitk.RelabelComponent(img_conn, sortByObjectSize=True)
+            return self.in_value * (img_conn == 1)
+
+        labels = sitk.GetArrayViewFromImage(img_conn)
+        size = img.GetSize()
+        outside = int(np.prod(full_size, dtype=np.int64)) - labels.size
+        spanned = [index[i] == 0 and index[i] + size[i] == full_size[i] for i in range(3)]
+
+        # the outside of the region is one region, unless the region spans the
+        # larger image on two axes and splits it into a slab beyond each face
+        regions = []
+        for axis in range(3):
+            array_axis = 2 - axis
+            for face, depth in (
+                (0, index[axis]),
+                (-1, full_size[axis] - index[axis] - size[axis]),
+            ):
+                if depth == 0:
+                    continue
+                face_labels = np.unique(labels.take(face, axis=array_axis))
+                if sum(spanned) == 2:
+                    regions.append((depth * labels.size // size[axis], face_labels))
+                elif regions:
+                    regions[0] = (outside, np.union1d(regions[0][1], face_labels))
+                else:
+                    regions.append((outside, face_labels))
+
+        # each outside region gets a label after those of the region, and
+        # joins the components on the faces it touches
+        sizes = np.bincount(labels.ravel()).astype(np.int64)
+        outside_labels = np.arange(len(sizes), len(sizes) + len(regions))
+        sizes = np.append(sizes, [count for count, face_labels in regions])
+        group = np.arange(len(sizes))
+        for outside_label, (count, face_labels) in zip(outside_labels, regions):
+            joined = np.append(face_labels[face_labels > 0], outside_label)
+            group[np.isin(group, group[joined])] = group[outside_label]
+        group_sizes = np.bincount(group, weights=sizes)
+        group_sizes[0] = 0
+        keep = group == np.argmax(group_sizes)
+        if not np.all(keep[outside_labels]):
+            return None
+
+        img_largest = sitk.GetImageFromArray(
+            (self.in_value * keep[labels]).astype(np.uint8)
+        )
+        img_largest.CopyInformation(img)
 
-        return img_conn
+        return img_largest
 
     def _invert_binary_image(self, img):
         """
@@ -352,7 +577,7 @@ class AutocontourKnee:
 
         return self.in_value * (img != self.in_value)
 
-    def _close_with_connected_components(self, img, radius):
+    def _close_with_connected_components(self, img, radius, index=None, full_size=None):
         """
         Perform a morphological closing operation on a binary image, except
         with a connected component filtering step to keep only the largest
@@ -367,10 +592,18 @@ class AutocontourKnee:
         radius : int
             The radius to use for the dilation and erosion.
 
+        index : list of int
+            If img is cropped from a larger image that is background outside of
+            the crop, the index of the crop. Default is None.
+
+        full_size : list of int
+            The size of the larger image. Default is None.
+
         Returns
         -------
         sitk.Image
-            The filtered image.
+            The filtered image. None if img is cropped and the closing fills
+            background outside of the crop.
         """
 
         # dilate to close holes in cortex
@@ -382,7 +615,9 @@ class AutocontourKnee:
         img = self._invert_binary_image(img)
 
         # perform connected components on background
-        img = self._get_largest_connected_component(img)
+        img = self._get_largest_connected_component(img, index, full_size)
+        if img is None:
+            return None
 
         # reinvert to get back to foreground
         img = self._invert_binary_image(img)
@@ -455,25 +690,22 @@ class AutocontourKnee:
 
         return self.in_value * (img_cl_min > 0)
 
-    def get_periosteal_mask(self, img, component):
+    def _label_components(self, img):
         """
-        Compute the periosteal mask from an input image.
+        Step 1 labelling of the periosteal mask, shared by all bones: gaussian
+        smooth, binarize and label the bones from largest to smallest.
 
         Parameters
         ----------
         img : sitk.Image
-            The gray-scale AIM. Currently this is written for images in HU,
-            if you want to input a density image then you'll need to modify
-            the lower and upper thresholds to be in the correct units.
+            The gray-scale AIM.
 
         Returns
         -------
         sitk.Image
-            A binary image that is the periosteal mask.
+            The label image, bone 1 is the largest.
         """
 
-        # STEP 1: Mask out the largest bone only
-
         img_segmented = self._gaussian_and_threshold(
             img,
             self.peri_s1_sigma,
@@ -482,46 +714,302 @@ class AutocontourKnee:
             self.peri_s1_upper,
         )
 
-        # component labelling to keep only largest region
+        # component labelling to sort the regions by size
         img_conn = sitk.ConnectedComponent(img_segmented, img_segmented, True)
         img_conn = sitk.RelabelComponent(img_conn, sortByObjectSize=True)
+
+        return img_conn
+
+    def _component_padding(self):
+        """
+        Padding around the bounding box of a bone that holds everything the
+        periosteal mask steps compute for it: the step 1 dilation, the later
+        dilations and the gaussian kernels.
+
+        Returns
+        -------
+        int
+            The padding in voxels.
+        """
+
+        return (
+            self.peri_s1_radius
+            + max(
+                self.peri_s2_radius,
+                self.peri_s3_radius,
+                self.peri_s4_open_radius,
+                self.peri_s4_close_radius,
+            )
+            + max(self.peri_s1_support, self.peri_s2_support, self.peri_s3_support)
+            + 2
+        )
+
+    def get_periosteal_mask(self, img, component):
+        """
+        Compute the periosteal mask from an input image.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM. Currently this is written for images in HU,
+            if you want to input a density image then you'll need to modify
+            the lower and upper thresholds to be in the correct units.
+
+        component : int
+            The bone to compute the mask of, 1 is the largest.
+
+        Returns
+        -------
+        sitk.Image
+            A binary image that is the periosteal mask.
+        """
+
+        try:
+            return self._component_periosteal_mask(
+                img, self._label_components(img), component
+            )
+        finally:
+            # do not keep the smoothed scan and the scan alive after the call
+            self.clear_gaussian_cache()
+
+    def get_periosteal_masks(self, img, components, workers=1):
+        """
+        Compute the periosteal masks of several bones. The step 1 labelling is
+        computed once, then each bone is cropped to its bounding box, padded
+        by the reach of the later steps, and steps 1-4 run on the crop.
+
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM, see get_periosteal_mask.
+
+        components : list of int
+            The bones to compute the masks of, 1 is the largest.
+
+        workers : int
+            Number of worker processes that compute the masks in parallel.
+            Default is 1.
+
+        Returns
+        -------
+        list of sitk.Image
+            A binary image that is the periosteal mask of each bone.
+        """
+
+        img_conn = self._label_components(img)
+        self.clear_gaussian_cache()
+        shape_filter = sitk.LabelShapeStatisticsImageFilter()
+        shape_filter.ComputePerimeterOff()
+        shape_filter.Execute(img_conn)
+
+        # crop each bone, a missing bone gets an empty mask
+        pad = self._component_padding()
+        full_size = img.GetSize()
+        crops = []
+        for component in components:
+            if not shape_filter.HasLabel(component):
+                crops.append(None)
+                continue
+            box = shape_filter.GetBoundingBox(component)
+            index = [max(box[i] - pad, 0) for i in range(3)]
+            upper = [min(box[i] + box[i + 3] + pad, full_size[i]) for i in range(3)]
+            size = [upper[i] - index[i] for i in range(3)]
+            crops.append(
+                (
+                    index,
+                    sitk.RegionOfInterest(img, size, index),
+                    sitk.RegionOfInterest(img_conn, size, index),
+                    component,
+                )
+            )
+        del img_conn
+
+        jobs = [crop for crop in crops if crop is not None]
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+                results = list(
+                    executor.map(
+                        _component_periosteal_mask,
+                        [self] * len(jobs),
+                        [job[1] for job in jobs],
+                        [job[2] for job in jobs],
+                        [job[3] for job in jobs],
+                        [job[0] for job in jobs],
+                        [full_size] * len(jobs),
+                    )
+                )
+        else:
+            results = [
+                self._component_periosteal_mask(*job[1:], job[0], full_size)
+                for job in jobs
+            ]
+
+        # paste each mask back into the full image, a mask that reaches out of
+        # its crop is computed on the whole scan, get_periosteal_mask clears
+        # the gaussian cache it fills
+        masks = []
+        for crop in crops:
+            mask = sitk.Image(img.GetSize(), sitk.sitkUInt8)
+            mask.CopyInformation(img)
+            if crop is not None:
+                crop_mask = results.pop(0)
+                if crop_mask is None:
+                    masks.append(self.get_periosteal_mask(img, crop[3]))
+                    continue
+                mask = sitk.Paste(
+                    sitk.Cast(mask, crop_mask.GetPixelID()),
+                    crop_mask,
+                    crop_mask.GetSize(),
+                    [0, 0, 0],
+                    crop[0],
+                )
+            masks.append(mask)
+
+        return masks
+
+    def _component_rough_mask(self, img_conn, component, crop_index=None, full_size=None):
+        """
+        Step 1 rough mask of one bone: dilate the bone and fill the background
+        that the dilated bone encloses. The morphology only runs on the bounding
+        box of the bone padded by the dilation radius, and the result is pasted
+        back into an image of the full size.
+
+        Parameters
+        ----------
+        img_conn : sitk.Image
+            The step 1 label image, from _label_components.
+
+        component : int
+            The bone to compute the mask of, 1 is the largest.
+
+        crop_index : list of int
+            If img_conn is cropped from the scan, the index of the crop in the
+            scan. Default is None.
+
+        full_size : list of int
+            If img_conn is cropped from the scan, the size of the scan.
+            Default is None.
+
+        Returns
+        -------
+        sitk.Image
+            A binary image that is the rough mask. None if img_conn is cropped
+            and the rough mask reaches out of the crop.
+        """
+
         img_segmented = self.in_value * (img_conn == component)
         # img_segmented = self._get_largest_connected_component(img_segmented)
 
-        # dilation
-        # !!!NOTE: I'm using a Euclidean metric for the structirng element,
-        # the IPL implementation uses the 3-4-5 chamfer metric. Feel free to
-        # swap out the code if you can figure out how to get the 3-4-5
-        # chamfer metric in SimpleITK
+        shape_filter = sitk.LabelShapeStatisticsImageFilter()
+        shape_filter.ComputePerimeterOff()
+        shape_filter.Execute(img_segmented)
+        if not shape_filter.HasLabel(self.in_value):
+            # no bone to dilate, so no background is enclosed either
+            return img_segmented
+
+        # bounding box padded by the dilation radius and a layer of background
+        box = shape_filter.GetBoundingBox(self.in_value)
+        crop_size = img_segmented.GetSize()
+        pad = self.peri_s1_radius + 1
+        index = [max(box[i] - pad, 0) for i in range(3)]
+        upper = [min(box[i] + box[i + 3] + pad, crop_size[i]) for i in range(3)]
+        size = [upper[i] - index[i] for i in range(3)]
+        boxes = [(index, size)]
+
+        # when the rough mask fills background outside of the box, e.g. a bone
+        # that splits the background in two, the whole scan is the box
+        if crop_index is None:
+            crop_index, full_size = [0, 0, 0], crop_size
+            boxes.append(([0, 0, 0], list(crop_size)))
+
+        for index, size in boxes:
+            img_box = sitk.RegionOfInterest(img_segmented, size, index)
+
+            # dilation
+            # !!!NOTE: I'm using a Euclidean metric for the structirng element,
+            # the IPL implementation uses the 3-4-5 chamfer metric. Feel free to
+            # swap out the code if you can figure out how to get the 3-4-5
+            # chamfer metric in SimpleITK
+
+            img_box = sitk.BinaryDilate(
+                img_box,
+                [self.peri_s1_radius] * 3,
+                sitk.sitkBall,
+                self.out_value,
+                self.in_value,
+            )
+
+            # invert the image to get the background
+            img_box = self._invert_binary_image(img_box)
+
+            # connected components on the background, the background outside of
+            # the box joins the components on the faces of the box inside the scan
+            img_box = self._get_largest_connected_component(
+                img_box, [crop_index[i] + index[i] for i in range(3)], full_size
+            )
+            if img_box is not None:
+                break
+        else:
+            return None
 
-        img_segmented = sitk.BinaryDilate(
-            img_segmented,
-            [self.peri_s1_radius] * 3,
-            sitk.sitkBall,
-            self.out_value,
-            self.in_value,
+        # invert back to foreground
+        img_box = self._invert_binary_image(img_box)
+
+        img_segmented = sitk.Paste(
+            sitk.Image(crop_size, img_box.GetPixelID()), img_box, size, [0, 0, 0], index
         )
+        img_segmented.CopyInformation(img_conn)
 
-        # invert the image to get the background
-        img_segmented = self._invert_binary_image(img_segmented)
+        return img_segmented
 
-        # connected components on the background
-        img_segmented = self._get_largest_connected_component(img_segmented)
+    def _component_periosteal_mask(
+        self, img, img_conn, component, crop_index=None, full_size=None
+    ):
+        """
+        Steps 1-4 of the periosteal mask of one bone, from the step 1 labelling.
 
-        # invert back to foreground
-        img_segmented = self._invert_binary_image(img_segmented)
+        Parameters
+        ----------
+        img : sitk.Image
+            The gray-scale AIM.
+
+        img_conn : sitk.Image
+            The step 1 label image, from _label_components.
 
-        # mask the original image using this segmentation
-        img_masked = sitk.Mask(img, img_segmented)
+        component : int
+            The bone to compute the mask of, 1 is the largest.
+
+        crop_index : list of int
+            If img and img_conn are cropped from the scan, the index of the
+            crop in the scan. Default is None.
+
+        full_size : list of int
+            If img and img_conn are cropped from the scan, the size of the
+            scan. Default is None.
+
+        Returns
+        -------
+        sitk.Image
+            A binary image that is the periosteal mask. None if img is cropped
+            and the mask reaches out of the crop.
+        """
+        # STEP 1: Mask out the largest bone only
+
+        img_segmented = self._component_rough_mask(
+            img_conn, component, crop_index, full_size
+        )
+        if img_segmented is None:
+            return None
 
         # and save the segmentation to use later
         img_segmented_s1 = img_segmented
 
         # STEP 2: create a mask with a low threshold
 
-        # threshold using low threshold
-        img_segmented = self._gaussian_and_threshold(
-            img_masked,
+        # threshold the image masked with the step 1 segmentation using low threshold
+        img_segmented = self._masked_gaussian_and_threshold(
+            img,
+            img_segmented_s1,
             self.peri_s2_sigma,
             self.peri_s2_support,
             self.peri_s2_lower,
@@ -533,20 +1021,21 @@ class AutocontourKnee:
 
         # dilate/conn comp/erode to close holes in cortex
         img_segmented = self._close_with_connected_components(
-            img_segmented, self.peri_s2_radius
+            img_segmented, self.peri_s2_radius, crop_index, full_size
         )
-
-        # now mask the image using the latest segmentation
-        img_masked = sitk.Mask(img, img_segmented)
+        if img_segmented is None:
+            return None
 
         # save the final segmentation from step 2
         img_segmented_s2 = img_segmented
 
         # STEP 3: create another mask with a slightly higher threshold
 
-        # gaussian blur and segment with higher threshold
-        img_segmented = self._gaussian_and_threshold(
-            img_masked,
+        # gaussian blur the image masked with the latest segmentation and
+        # segment with higher threshold
+        img_segmented = self._masked_gaussian_and_threshold(
+            img,
+            img_segmented_s2,
             self.peri_s3_sigma,
             self.peri_s3_support,
             self.peri_s3_lower,
@@ -555,11 +1044,10 @@ class AutocontourKnee:
 
         # dilate/conn comp/erode to close holes in cortex
         img_segmented = self._close_with_connected_components(
-            img_segmented, self.peri_s3_radius
+            img_segmented, self.peri_s3_radius, crop_index, full_size
         )
-
-        # again, mask the image with the new segmentation
-        img_masked = sitk.Mask(img, img_segmented)
+        if img_segmented is None:
+            return None
 
         # save the final segmentation from step 3
         img_segmented_s3 = img_segmented
@@ -622,12 +1110,11 @@ class AutocontourKnee:
             A binary image that is the endosteal mask.
         """
 
-        # first, mask the image with the periosteal mask
-        img_masked = sitk.Mask(img, peri)
-
-        # next, do a gaussian and binarization to get a cortical mask
-        cort = self._gaussian_and_threshold(
-            img_masked,
+        # mask the image with the periosteal mask, and do a gaussian and
+        # binarization to get a cortical mask
+        cort = self._masked_gaussian_and_threshold(
+            img,
+            peri,
             self.endo_sigma,
             self.endo_support,
             self.endo_lower,
@@ -751,7 +1238,12 @@ class AutocontourKnee:
             Tuple of two binary images. The first image is the periosteal mask
             and the second image is the endosteal mask.
         """
-        pass
+
+        peri = self.get_periosteal_mask(img, 1)
+        endo = self.get_endosteal_mask(img, peri)
+        self.clear_gaussian_cache()
+
+        return peri, endo
 
     def __str__(self):
         return f"Autocontour object (--str to be implemented--)."
@@ -770,3 +1262,13 @@ class AutocontourKnee:
         To be implemented
         """
         pass
+
+
+def _component_periosteal_mask(contour, img, img_conn, component, crop_index, full_size):
+    """
+    Worker process entry of AutocontourKnee.get_periosteal_masks.
+    """
+
+    return contour._component_periosteal_mask(
+        img, img_conn, component, crop_index, full_size
+    )
@@ -14,8 +14,7 @@ def autocontour(
     img = convert_hu_to_bmd(img, mu_water, rescale_slope, rescale_intercept)
 
     auto_contour = AutocontourKnee()
-    prx_mask = auto_contour.get_periosteal_mask(img, 1)
-    dst_mask = auto_contour.get_periosteal_mask(img, 2)
+    prx_mask, dst_mask = auto_contour.get_periosteal_masks(img, [1, 2])
 
     # Create a mask for the entire joint
     mask = prx_mask + dst_mask
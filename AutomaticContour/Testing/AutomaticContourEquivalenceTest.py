@@ -0,0 +1,235 @@
+#-----------------------------------------------------
+# AutomaticContourEquivalenceTest.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module checks that the optimised code paths of the
+#              AutomaticContour module give the same output as the plain
+#              ones. It runs on synthetic scans without 3D Slicer.
+#
+#-----------------------------------------------------
+# Usage:       python -m unittest AutomaticContourEquivalenceTest
+#
+#-----------------------------------------------------
+import SimpleITK as sitk
+import numpy as np
+import contextlib, io, os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AutomaticContourLib'))
+from AutocontourKnee import AutocontourKnee
+from FillHole import fillHoleSlices
+# ContourLogic imports its modules relative to the AutomaticContourLib package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from AutomaticContourLib.ContourLogic import ContourLogic
+
+def makeScan(bone, seed=0):
+    """
+    Noisy scan of a binary bone model.
+
+    Args:
+        bone (ndarray): bool array in z,y,x order
+        seed (int): random seed of the noise
+
+    Returns:
+        Image: scan
+    """
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(0, 60, bone.shape).astype(np.float32)
+    arr[bone] += 1000
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.0607] * 3)
+    img.SetOrigin([3.0, -2.0, 10.0])
+    return img
+
+def makeTubes():
+    """
+    A wide hollow tube and a rod through all slices. The hollow of the tube
+    holds more background than the margin around its bounding box.
+    """
+    z, y, x = np.mgrid[0:20, 0:120, 0:120]
+    r = np.sqrt((y - 60)**2 + (x - 56)**2)
+    return makeScan(((r < 48) & (r >= 45)) | ((y - 110)**2 + (x - 112)**2 < 9))
+
+def makePlate():
+    """
+    A plate that spans the scan on two axes and splits the background.
+    """
+    bone = np.zeros((40, 40, 60), dtype=bool)
+    bone[12:16] = True
+    return makeScan(bone)
+
+def makeBlobs():
+    """
+    Smooth random bones of all shapes, away from the scan borders.
+    """
+    noise = np.random.default_rng(3).normal(size=(50, 60, 60)).astype(np.float32)
+    blob = sitk.GetArrayFromImage(sitk.SmoothingRecursiveGaussian(sitk.GetImageFromArray(noise), 3)) > 0.02
+    blob[:4] = blob[-4:] = blob[:, :4] = blob[:, -4:] = blob[:, :, :4] = blob[:, :, -4:] = False
+    return makeScan(blob)
+
+def makeBones():
+    """
+    A hollow bone, a rod and a ball, with their labels from the biggest bone.
+
+    Returns:
+        tuple: scan, rough mask
+    """
+    z, y, x = np.mgrid[0:30, 0:80, 0:90]
+    r = np.sqrt((y - 35)**2 + (x - 30)**2)
+    bones = [(r < 22) & (r >= 16) & (z >= 3) & (z < 27),
+             ((y - 60)**2 + (x - 75)**2 < 36) & (z >= 5) & (z < 25),
+             (y - 15)**2 + (x - 72)**2 + (z - 15)**2 < 64]
+    img = makeScan(bones[0] | bones[1] | bones[2])
+    rough = np.zeros(z.shape, dtype=np.uint8)
+    rough[:, :, :56] = 1
+    rough[:, 45:, 56:] = 2
+    rough[:, :45, 56:] = 3
+    rough[:2] = rough[-2:] = 0
+    rough_img = sitk.GetImageFromArray(rough)
+    rough_img.CopyInformation(img)
+    return img, rough_img
+
+def fillHoleReference(img, foreground):
+    """
+    Fill holes with BinaryFillholeImageFilter on each slice along z, y and x,
+    and combine the three directions with a bitwise or.
+    """
+    fill_hole_filter = sitk.BinaryFillholeImageFilter()
+    fill_hole_filter.SetForegroundValue(foreground)
+    width, height, depth = img.GetSize()
+    fill_hole_img = sitk.JoinSeries([fill_hole_filter.Execute(img[:, :, i]) for i in range(depth)])
+    fill_hole_img.CopyInformation(img)
+    fill_hole_img2 = sitk.JoinSeries([fill_hole_filter.Execute(img[:, j, :]) for j in range(height)])
+    fill_hole_img2 = sitk.PermuteAxes(fill_hole_img2, (0, 2, 1))
+    fill_hole_img2.CopyInformation(img)
+    fill_hole_img3 = sitk.JoinSeries([fill_hole_filter.Execute(img[k, :, :]) for k in range(width)])
+    fill_hole_img3 = sitk.PermuteAxes(fill_hole_img3, (2, 0, 1))
+    fill_hole_img3.CopyInformation(img)
+    return fill_hole_img | fill_hole_img2 | fill_hole_img3
+
+def makeContour():
+    return AutocontourKnee(
+        peri_s1_radius=3,
+        peri_s2_radius=2,
+        peri_s3_radius=2,
+        peri_s4_open_radius=2,
+        peri_s4_close_radius=3,
+    )
+
+class AutomaticContourEquivalenceTest(unittest.TestCase):
+
+    def test_RoughMask(self):
+        '''
+        The step 1 morphology on the bounding box of a bone gives the same rough
+        mask as the morphology on the whole scan, also when the bone splits the
+        background.
+        '''
+        contour = makeContour()
+        for img in (makeTubes(), makePlate(), makeBlobs()):
+            img_conn = contour._label_components(img)
+            for component in (1, 2):
+                # the whole scan morphology of get_periosteal_mask
+                reference = sitk.BinaryDilate(contour.in_value * (img_conn == component),
+                                              [contour.peri_s1_radius] * 3, sitk.sitkBall,
+                                              contour.out_value, contour.in_value)
+                reference = contour._invert_binary_image(reference)
+                reference = contour._get_largest_connected_component(reference)
+                reference = contour._invert_binary_image(reference)
+                np.testing.assert_array_equal(
+                    sitk.GetArrayFromImage(contour._component_rough_mask(img_conn, component)),
+                    sitk.GetArrayFromImage(reference))
+
+    def test_PeriostealMasks(self):
+        '''
+        The periosteal masks of all bones from the cropped bones match the mask
+        of each bone from the whole scan, serial and in worker processes.
+        '''
+        contour = makeContour()
+        for img in (makeTubes(), makePlate(), makeBlobs()):
+            references = [sitk.GetArrayFromImage(contour.get_periosteal_mask(img, component))
+                          for component in (1, 2, 3)]
+            self.assertGreater(np.count_nonzero(references[0]), 0)
+            for workers in (1, 2):
+                masks = contour.get_periosteal_masks(img, (1, 2, 3), workers)
+                for mask, reference in zip(masks, references):
+                    np.testing.assert_array_equal(sitk.GetArrayFromImage(mask), reference)
+                    self.assertEqual(mask.GetOrigin(), img.GetOrigin())
+                # the smoothed scan and the scan are not kept alive
+                self.assertEqual(contour._gaussian_cache, {})
+                self.assertIsNone(contour._gaussian_cache_img)
+
+    def test_FillHole(self):
+        '''
+        Filling the holes of all slices along an axis at once gives the same image
+        as the fill hole filter on each slice, on random binary and label images.
+        '''
+        rng = np.random.default_rng(0)
+        for shape in ((12, 30, 25), (20, 16, 40)):
+            smooth = sitk.GetArrayFromImage(sitk.SmoothingRecursiveGaussian(
+                sitk.GetImageFromArray(rng.normal(size=shape).astype(np.float32)), 1.5))
+            binary = (smooth > 0).astype(np.uint8)
+            labels = np.digitize(smooth, np.quantile(smooth, [0.3, 0.6, 0.8])).astype(np.uint8)
+            noise = rng.integers(0, 4, shape).astype(np.uint8)
+            for array, foregrounds in ((binary, (1,)), (labels, (1, 2, 3)), (noise, (1, 3))):
+                img = sitk.GetImageFromArray(array)
+                img.SetSpacing([0.0607] * 3)
+                img.SetOrigin([3.0, -2.0, 10.0])
+                for foreground in foregrounds:
+                    reference = fillHoleReference(img, foreground)
+                    for threads in (1, 3):
+                        fill_hole_img = fillHoleSlices(img, foreground, threads)
+                        np.testing.assert_array_equal(sitk.GetArrayFromImage(fill_hole_img),
+                                                      sitk.GetArrayFromImage(reference))
+                        self.assertEqual(fill_hole_img.GetOrigin(), img.GetOrigin())
+
+    def test_BoneWorkers(self):
+        '''
+        Contouring the bones in worker processes gives the same masks as contouring
+        one bone after the other, with and without a rough mask, and the progress
+        still advances by one increment at each step.
+        '''
+        img, rough_img = makeBones()
+        for roughMask in (None, rough_img):
+            outputs = []
+            for boneWorkers in (0, 2):
+                contour = ContourLogic(img, lower=500, upper=4000, sigma=1, boneNum=3,
+                                       dilateErodeRadius=3, roughMask=roughMask)
+                contour.setBoneWorkers(boneWorkers)
+                # the progress loop of AutomaticContourLogic.getContour
+                increment = 100 // contour.getStepNum()
+                progress = [0]
+                with contextlib.redirect_stdout(io.StringIO()):
+                    step = 1
+                    while contour.execute(step, 1):
+                        progress.append(progress[-1] + increment)
+                        step += 1
+                self.assertEqual(len(progress), contour.getStepNum())
+                self.assertGreater(increment, 0)
+                outputs.append([sitk.GetArrayFromImage(mask) for mask in
+                                [contour.getMask()] + contour.getIndividualMasks()])
+            self.assertEqual(len(outputs[0]), 4)
+            self.assertEqual(set(np.unique(outputs[0][0])), {0, 1, 2, 3})
+            for output, reference in zip(outputs[1], outputs[0]):
+                np.testing.assert_array_equal(output, reference)
+
+    def test_MaskedGaussian(self):
+        '''
+        Smoothing and binarizing the padded bounding box of the mask gives the
+        same image as smoothing and binarizing the masked scan, for several
+        sigmas and supports, with and without zero inside the thresholds.
+        '''
+        contour = makeContour()
+        for img in (makeTubes(), makeBlobs()):
+            for component in (1, 2):
+                mask = contour._label_components(img) == component
+                for sigma, support in ((0.8, 1), (1.5, 3), (2, 4), (3, 2)):
+                    for lower, upper in ((300, 4000), (-100, 500)):
+                        reference = contour._gaussian_and_threshold(sitk.Mask(img, mask), sigma, support,
+                                                                    lower, upper)
+                        np.testing.assert_array_equal(
+                            sitk.GetArrayFromImage(contour._masked_gaussian_and_threshold(
+                                img, mask, sigma, support, lower, upper)),
+                            sitk.GetArrayFromImage(reference))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -729,6 +729,7 @@ class CorticalBreakDetectionTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_CortBreak()
+    self.test_CortBreakCoarse()
     self.test_CortBreakFailure()
 
   def test_CortBreak(self):
@@ -798,6 +799,64 @@ class CorticalBreakDetectionTest(ScriptedLoadableModuleTest):
 
     # failure message
     self.assertTrue(passed, 'Incorrect results, check testing log')
+
+  def test_CortBreakCoarse(self):
+    '''
+    Coarse-to-fine Tests: Runs the cortical break detection with a candidate search 
+    at 2x and 4x downsampling on the 3 sample images, and compares the results to
+    the whole volume run and to the pre-generated masks
+
+    Test Requires:
+
+      mha files: 'SAMPLE_MHA1.mha', 'SAMPLE_MHA2.mha', 'SAMPLE_MHA3.mha'
+      contour masks: 'SAMPLE_MASK1.mha', 'SAMPLE_MASK2.mha', 'SAMPLE_MASK3.mha'
+      cortical break masks: 'SAMPLE_BREAKS1.nrrd', 'SAMPLE_BREAKS2.nrrd', 'SAMPLE_BREAKS3.nrrd'
+    
+    Success Conditions:
+      1. Cortical breaks mask and seeds are the same as in the whole volume run
+      2. Output cortical breaks mask differs by less than 0.5% from the comparison mask
+    '''
+    import numpy as np
+    from Testing.CorticalBreakDetectionTestLogic import CorticalBreakDetectionTestLogic
+    from CorticalBreakDetectionLib.CorticalBreakDetectionLogic import CorticalBreakDetectionLogic
+
+    self.delayDisplay("Starting the test")
+
+    # setup logic
+    logic = CorticalBreakDetectionLogic()
+    testLogic = CorticalBreakDetectionTestLogic()
+    scene = slicer.mrmlScene
+
+    for i in range(1, 4):
+      index = str(i)
+      print('\n*----------------------Test ' + index + '----------------------*')
+
+      # setup input file
+      inputVolume = testLogic.newNode(scene, filename='SAMPLE_MHA' + index + '.mha', name='testInputVolume' + index)
+      processVolume = testLogic.newNode(scene, name='testProcessVolume' + index, type='labelmap')
+      logic.setSegmentParameters(inputVolume, 0.8, lower=686, upper=4000)
+      self.assertTrue(logic.segment(processVolume), 'segmenting Failed')
+      maskVolume = testLogic.newNode(scene, filename='SAMPLE_MASK' + index + '.mha', name='testMaskVolume' + index, type='labelmap', display=False)
+
+      # whole volume run, then the candidate search at each factor
+      outputs = []
+      seeds = []
+      for coarseFactor in (0, 2, 4):
+        outputVolume = testLogic.newNode(scene, name='testOutputNode' + index + '_' + str(coarseFactor), type='labelmap')
+        logic.setCorticalBreaksParameters(686, 4000, inputVolume, processVolume, maskVolume, outputVolume, None, 7, 3, 0.0607, False)
+        logic.CorticalBreakDetection.setCoarseFactor(coarseFactor)
+        self.assertTrue(logic.getCorticalBreaks(outputVolume, None, noProgress=True), 'Cortical break detection operation failed')
+        outputs.append(slicer.util.arrayFromVolume(outputVolume).copy())
+        seeds.append(logic.CorticalBreakDetection.getSeeds())
+        self.assertTrue(testLogic.verifyBreaks(outputVolume, i), 'Output mask is incorrect for test ' + index)
+
+      # every break of the whole volume run is found
+      for output, coarseSeeds in zip(outputs[1:], seeds[1:]):
+        self.assertTrue(np.array_equal(output, outputs[0]), 'Breaks differ from the whole volume run in test ' + index)
+        self.assertEqual(coarseSeeds, seeds[0], 'Seeds differ from the whole volume run in test ' + index)
+      self.delayDisplay('Test ' + index + ' complete')
+
+    self.delayDisplay('Test passed')
   
   def test_CortBreakFailure(self):
     from Testing.CorticalBreakDetectionTestLogic import CorticalBreakDetectionTestLogic
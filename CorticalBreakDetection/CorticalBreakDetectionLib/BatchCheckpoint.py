@@ -0,0 +1,140 @@
+#-----------------------------------------------------
+# BatchCheckpoint.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module records finished scans of a batch run in a
+#              checkpoint manifest, a JSON lines file in the output folder.
+#              Each line stores the input file hashes, the parameters and the
+#              output file hashes of one scan. When the batch is restarted,
+#              scans whose inputs and parameters are unchanged and whose
+#              outputs are still valid are skipped.
+#
+#-----------------------------------------------------
+# Usage:       checkpoint = BatchCheckpoint(output_dir)
+#              if not checkpoint.isDone(key, input_files, params):
+#                  ...
+#                  checkpoint.record(key, input_files, params, output_files)
+#
+#-----------------------------------------------------
+import os, json, hashlib
+
+class BatchCheckpoint:
+    def __init__(self, output_dir, filename='checkpoint.jsonl'):
+        self.path = os.path.join(output_dir, filename)
+        self._records = {}         # latest record of each scan, by key
+        self._hashes = {}          # file hashes computed in this run, by (path, size, mtime)
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._records[record['key']] = record
+                    except (ValueError, KeyError):
+                        # ignore a line cut off by a crash
+                        continue
+
+    def fileHash(self, path):
+        """
+        Get the SHA-1 of a file, reusing the hash computed earlier in this run
+        if the size and modification time have not changed.
+
+        Args:
+            path (str)
+
+        Returns:
+            str
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        if key not in self._hashes:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            self._hashes[key] = sha.hexdigest()
+        return self._hashes[key]
+
+    def _fileInfo(self, paths):
+        """
+        Args:
+            paths (list of str)
+
+        Returns:
+            dict: {path: {'size', 'mtime', 'sha1'}}
+        """
+        info = {}
+        for path in paths:
+            stat = os.stat(path)
+            info[path] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                          'sha1': self.fileHash(path)}
+        return info
+
+    def _isUnchanged(self, path, info):
+        """
+        Check a file against its recorded size, modification time and hash.
+        The hash is only computed if the size matches but the time does not.
+
+        Args:
+            path (str)
+            info (dict): recorded file info
+
+        Returns:
+            bool
+        """
+        if not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != info['size']:
+            return False
+        if stat.st_mtime == info['mtime']:
+            return True
+        return self.fileHash(path) == info['sha1']
+
+    def isDone(self, key, input_files, params):
+        """
+        Check if a scan has been processed with the same inputs and parameters,
+        and its outputs are still valid.
+
+        Args:
+            key (str): identifies the scan, e.g. the contour file path
+            input_files (list of str)
+            params (dict): must be JSON serializable
+
+        Returns:
+            bool
+        """
+        record = self._records.get(key)
+        if record is None:
+            return False
+        if record['params'] != json.loads(json.dumps(params)):
+            return False
+        if sorted(record['inputs']) != sorted(input_files):
+            return False
+        for path, info in record['inputs'].items():
+            if not self._isUnchanged(path, info):
+                return False
+        for path, info in record['outputs'].items():
+            if not self._isUnchanged(path, info):
+                return False
+        return True
+
+    def record(self, key, input_files, params, output_files):
+        """
+        Append a finished scan to the checkpoint manifest.
+
+        Args:
+            key (str): identifies the scan, e.g. the contour file path
+            input_files (list of str)
+            params (dict): must be JSON serializable
+            output_files (list of str)
+        """
+        record = {'key': key,
+                  'inputs': self._fileInfo(input_files),
+                  'params': params,
+                  'outputs': self._fileInfo(output_files)}
+        self._records[key] = json.loads(json.dumps(record))
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,152 @@
+#-----------------------------------------------------
+# BoundedDistance.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module deflates a binary object by a radius, i.e. keeps the
+#              object voxels whose Euclidean distance to the object boundary is
+#              at least the radius. Distances are only propagated up to the
+#              radius, with separable passes along x, y and z over a small
+#              integer array, instead of computing the full float distance map.
+#              The result equals thresholding the SignedMaurerDistanceMap.
+#              The Peters method deflates with the approximate
+#              SignedDanielssonDistanceMap, which keeps about 1% more voxels
+#              of curved masks. It is computed on the bounding box of the
+#              object with a margin of one voxel, which gives the same result
+#              as the whole image.
+#
+#-----------------------------------------------------
+# Usage:       deflate_img = boundedDeflate(img, radius, foreground)
+#              deflate_img = danielssonDeflate(img, radius, foreground)
+#
+#-----------------------------------------------------
+import SimpleITK as sitk
+import numpy as np
+import math
+
+def boundaryVoxels(obj):
+    """
+    Find the object voxels next to the background, including diagonal neighbours.
+    Voxels outside the image are not background.
+
+    Args:
+        obj (ndarray): bool
+
+    Returns:
+        ndarray: bool
+    """
+    near = ~obj
+    for axis in range(obj.ndim):
+        lower, upper = _shifted(obj.ndim, axis, 1)
+        grown = near.copy()
+        grown[lower] |= near[upper]
+        grown[upper] |= near[lower]
+        near = grown
+    near &= obj
+
+    return near
+
+def boundedSquaredDistance(seeds, radius):
+    """
+    Squared Euclidean distance to the nearest seed voxel, in voxels.
+    Distances of radius or more are not computed exactly.
+
+    Args:
+        seeds (ndarray): bool
+        radius (float): in voxels
+
+    Returns:
+        ndarray: distances below radius**2 are exact, the others are at least radius**2
+    """
+    steps = math.ceil(radius)
+    cap = steps * steps
+    dtype = np.uint16 if 2 * cap < 2**16 else np.uint32
+    dist = np.where(seeds, 0, cap).astype(dtype)
+
+    # minimum of the distance along each axis plus the squared step (Saito's passes),
+    #  only for steps within the radius
+    for axis in reversed(range(seeds.ndim)):
+        passed = dist.copy()
+        for step in range(1, min(steps, seeds.shape[axis] - 1) + 1):
+            lower, upper = _shifted(seeds.ndim, axis, step)
+            np.minimum(passed[lower], dist[upper] + step * step, out=passed[lower])
+            np.minimum(passed[upper], dist[lower] + step * step, out=passed[upper])
+        np.minimum(passed, cap, out=passed)
+        dist = passed
+
+    return dist
+
+def boundedDeflate(img, radius, foreground):
+    """
+    Deflate the object in the image by the radius. Non-zero voxels are the object.
+
+    Args:
+        img (Image)
+        radius (float): Deflate steps, in voxels
+        foreground (int): Value of the deflated object.
+
+    Returns:
+        Image: UInt8
+    """
+    obj = sitk.GetArrayViewFromImage(img) != 0
+    if radius > 0:
+        dist = boundedSquaredDistance(boundaryVoxels(obj), radius)
+        obj &= dist >= radius * radius
+        del dist
+
+    deflate_img = sitk.GetImageFromArray(obj.astype(np.uint8) * np.uint8(foreground))
+    deflate_img.CopyInformation(img)
+
+    return deflate_img
+
+def danielssonDeflate(img, radius, foreground):
+    """
+    Deflate the object in the image by thresholding the SignedDanielssonDistanceMap,
+    on the bounding box of the object with a margin of one voxel. The margin is 
+    background, so the distances inside the object are the same as on the 
+    whole image. Non-zero voxels are the object.
+
+    Args:
+        img (Image)
+        radius (float): Deflate steps, in voxels
+        foreground (int): Value of the deflated object.
+
+    Returns:
+        Image: UInt8
+    """
+    obj = sitk.GetArrayViewFromImage(img) != 0
+    if not obj.any():
+        return sitk.Cast(img * 0, sitk.sitkUInt8)
+    # bounding box in x,y,z order
+    lower, upper = [], []
+    for axis in reversed(range(obj.ndim)):
+        other = tuple(i for i in range(obj.ndim) if i != axis)
+        index = np.flatnonzero(obj.any(axis=other))
+        lower.append(max(int(index[0]) - 1, 0))
+        upper.append(min(int(index[-1]) + 2, obj.shape[axis]))
+    del obj
+    region = tuple(slice(lower[i], upper[i]) for i in range(len(lower)))
+
+    distance_filter = sitk.SignedDanielssonDistanceMapImageFilter()
+    distance_filter.SetSquaredDistance(False)
+    distance_filter.SetInsideIsPositive(True)
+    distance_img = distance_filter.Execute(img[region])
+    box_img = sitk.BinaryThreshold(distance_img, 
+                                   lowerThreshold=radius,
+                                   insideValue=foreground)
+    del distance_img
+
+    deflate_img = sitk.Image(img.GetSize(), sitk.sitkUInt8)
+    deflate_img.CopyInformation(img)
+    return sitk.Paste(deflate_img, box_img, box_img.GetSize(), [0] * len(lower), lower)
+
+def _shifted(ndim, axis, step):
+    """
+    Returns:
+        tuple: slices of the voxels before and after a shift of step along the axis
+    """
+    lower = [slice(None)] * ndim
+    upper = [slice(None)] * ndim
+    lower[axis] = slice(None, -step)
+    upper[axis] = slice(step, None)
+    return tuple(lower), tuple(upper)
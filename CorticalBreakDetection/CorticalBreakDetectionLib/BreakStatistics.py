@@ -0,0 +1,106 @@
+#-----------------------------------------------------
+# BreakStatistics.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module converts labeled cortical breaks to seed points and
+#              per-break metadata, i.e. the label, voxel count, centroid and
+#              bounding box of each break. The statistics of all breaks come
+#              from one shape statistics pass, and the centroids are converted
+#              to voxel indices of the reference image with one matrix operation.
+#
+#-----------------------------------------------------
+# Usage:       seeds, breaks = breakSeeds(label_img, ref_img)
+#
+#-----------------------------------------------------
+import SimpleITK as sitk
+import numpy as np
+
+def indexToPhysical(indices, img):
+    """
+    Convert continuous indices to physical points, like
+    img.TransformContinuousIndexToPhysicalPoint for each row.
+
+    Args:
+        indices (ndarray): (N, 3) continuous (x,y,z) indices
+        img (Image)
+
+    Returns:
+        ndarray: (N, 3) physical points
+    """
+    direction = np.array(img.GetDirection()).reshape(3, 3)
+    index_to_physical = direction * np.array(img.GetSpacing())
+    return np.asarray(indices, dtype=float) @ index_to_physical.T + np.array(img.GetOrigin())
+
+def physicalToIndex(points, img):
+    """
+    Convert physical points to the nearest indices, like
+    img.TransformPhysicalPointToIndex for each row.
+
+    Args:
+        points (ndarray): (N, 3) physical points
+        img (Image)
+
+    Returns:
+        ndarray: (N, 3) (x,y,z) indices
+    """
+    direction = np.array(img.GetDirection()).reshape(3, 3)
+    physical_to_index = np.linalg.inv(direction * np.array(img.GetSpacing()))
+    indices = (np.asarray(points, dtype=float) - np.array(img.GetOrigin())) @ physical_to_index.T
+
+    # round half up, as ITK does
+    return np.floor(indices + 0.5).astype(np.int64)
+
+def breakSeeds(label_img, ref_img):
+    """
+    Get the seed point and the metadata of each labeled break.
+
+    Args:
+        label_img (Image): breaks labeled 1 to N
+        ref_img (Image): image of the seed indices, on the same grid as label_img
+
+    Returns:
+        tuple: list of (x,y,z) seed indices, list of dict with the metadata of each break
+    """
+    shape_filter = sitk.LabelShapeStatisticsImageFilter()
+    shape_filter.ComputePerimeterOff()
+    shape_filter.Execute(label_img)
+    labels = shape_filter.GetLabels()
+
+    sizes = np.array([shape_filter.GetNumberOfPixels(label) for label in labels], dtype=np.int64)
+    centroids = np.array([shape_filter.GetCentroid(label) for label in labels]).reshape(-1, 3)
+    boxes = np.array([shape_filter.GetBoundingBox(label) for label in labels],
+                     dtype=np.int64).reshape(-1, 6)
+
+    return breakTable(labels, sizes, centroids, boxes, label_img, ref_img)
+
+def breakTable(labels, sizes, centroids, boxes, label_img, ref_img):
+    """
+    Convert the statistics of the breaks to seed points and metadata.
+
+    Args:
+        labels (list of int)
+        sizes (ndarray): (N,) voxel count of each break
+        centroids (ndarray): (N, 3) physical centroid of each break
+        boxes (ndarray): (N, 6) (x,y,z) index and size of the bounding box of
+                         each break, in label_img
+        label_img (Image)
+        ref_img (Image): image of the seed indices, on the same grid as label_img
+
+    Returns:
+        tuple: list of (x,y,z) seed indices, list of dict with the metadata of each break
+    """
+    seeds = physicalToIndex(centroids, ref_img)
+    offset = physicalToIndex([label_img.GetOrigin()], ref_img)[0]
+
+    seeds_list = [tuple(int(v) for v in seed) for seed in seeds]
+    breaks = []
+    for i, label in enumerate(labels):
+        breaks.append({'label': int(label),
+                       'seed': seeds_list[i],
+                       'size': int(sizes[i]),
+                       'centroid': tuple(float(v) for v in centroids[i]),
+                       'boundingBox': tuple(int(v) for v in boxes[i, :3] + offset) +
+                                      tuple(int(v) for v in boxes[i, 3:])})
+
+    return seeds_list, breaks
@@ -31,6 +31,12 @@
 #
 #-----------------------------------------------------
 import SimpleITK as sitk
+try:
+    from .BoundedDistance import boundedDeflate
+    from .BreakStatistics import breakSeeds
+except ImportError: # run as a script
+    from BoundedDistance import boundedDeflate
+    from BreakStatistics import breakSeeds
 
 class CBCTCorticalBreakDetectionLogic:
     def __init__(self, img=None, contour_img=None, voxelSize=250, lower=600, upper=10000, 
@@ -54,6 +60,7 @@ class CBCTCorticalBreakDetectionLogic:
         self.corticalThickness = corticaThickness       # thickness of cortical shell in voxels
         self.dilateErodeDistance = dilateErodeDistance  # morphological kernel radius in voxels
         self.seeds = []                       # seed point inside each cortical break, will modified
+        self.breaks = []                      # label, seed, size, centroid and bounding box of each break
         self.stepNum = 7
     
     def smoothen(self, img, sigma, lower, upper): # step 1
@@ -96,16 +103,10 @@ class CBCTCorticalBreakDetectionLogic:
         Returns:
             Image
         """
-        # deflate with Maurer distance map filter
+        # deflate with a distance transform bounded by the radius,
+        #  same as thresholding the Maurer distance map
         print("Applying distance map filter")
-        distance_filter = sitk.SignedMaurerDistanceMapImageFilter()
-        distance_filter.SetSquaredDistance(False)
-        distance_filter.SetInsideIsPositive(True)
-        distance_img = distance_filter.Execute(img)
-
-        deflate_img = sitk.BinaryThreshold(distance_img, 
-                                           lowerThreshold=radius,
-                                           insideValue=foreground)
+        deflate_img = boundedDeflate(img, radius, foreground)
 
         return deflate_img
 
@@ -293,7 +294,7 @@ class CBCTCorticalBreakDetectionLogic:
     
     def maskToSeeds(self, breaks_img):
         """
-        Convert cortical break mask to seed points.
+        Convert cortical break mask to seed points and the metadata of each break.
 
         Args:
             breaks_img (Image)
@@ -302,14 +303,9 @@ class CBCTCorticalBreakDetectionLogic:
         label_img = sitk.ConnectedComponent(breaks_img)
         label_img = sitk.RelabelComponent(label_img)
 
-        stats_filter = sitk.LabelIntensityStatisticsImageFilter()
-        stats_filter.Execute(label_img, self.model_img)
-        labelNum = stats_filter.GetNumberOfLabels()
-
-        for i in range(labelNum):
-            seed = stats_filter.GetCentroid(i+1)
-            seed = self.img.TransformPhysicalPointToIndex(seed)
-            self.seeds.append(seed)
+        seeds, breaks = breakSeeds(label_img, self.img)
+        self.seeds.extend(seeds)
+        self.breaks.extend(breaks)
 
     def execute(self, step):
         """
@@ -348,7 +344,9 @@ class CBCTCorticalBreakDetectionLogic:
 
     def _boundingBoxCut(self, img):
         """
-        Crop the image so that it occupies the same physcial space as the mask.
+        Crop the image so that it occupies the same physical space as the mask.
+        The crop is a single region of interest when the mask lies inside the image,
+        otherwise the image is pasted into a zero image on the grid of the mask.
 
         Args:
             img (Image)
@@ -357,18 +355,14 @@ class CBCTCorticalBreakDetectionLogic:
             Image
         """
         # image info
-        width = self.peri_contour.GetWidth()
-        height = self.peri_contour.GetHeight()
-        depth = self.peri_contour.GetDepth()
+        size = self.peri_contour.GetSize()
         spacing = img.GetSpacing()[0]
         contour_origin = self.peri_contour.GetOrigin()
         model_origin = img.GetOrigin()
         model_size = img.GetSize()
         direction = img.GetDirection()
 
-        # crop image
-        cropped_img = sitk.Image(width, height, depth, img.GetPixelID())
-        cropped_img.CopyInformation(self.peri_contour)
+        # index of the image origin in the mask
         destination_x = round((model_origin[0] - contour_origin[0]) / spacing)
         destination_y = round((model_origin[1] - contour_origin[1]) / spacing)
         destination_z = round((model_origin[2] - contour_origin[2]) / spacing)
@@ -376,17 +370,25 @@ class CBCTCorticalBreakDetectionLogic:
         r.SetMatrix(direction)
         destination_index = r.TransformPoint((destination_x, destination_y, destination_z))
         destination_index = (round(destination_index[0]), round(destination_index[1]), round(destination_index[2]))
-        paste_filter = sitk.PasteImageFilter()
-        paste_filter.SetDestinationIndex(destination_index)
-        paste_filter.SetSourceSize(model_size)
-        cropped_img = paste_filter.Execute(cropped_img, img)
+
+        # crop image
+        if all(destination_index[i] <= 0 and size[i] - destination_index[i] <= model_size[i] for i in range(3)):
+            cropped_img = sitk.RegionOfInterest(img, size, [-i for i in destination_index])
+        else:
+            cropped_img = sitk.Image(size, img.GetPixelID())
+            cropped_img.CopyInformation(self.peri_contour)
+            paste_filter = sitk.PasteImageFilter()
+            paste_filter.SetDestinationIndex(destination_index)
+            paste_filter.SetSourceSize(model_size)
+            cropped_img = paste_filter.Execute(cropped_img, img)
+        cropped_img.CopyInformation(self.peri_contour)
 
         return cropped_img
 
     def _initializeParams(self):
         """
         Crop the preprocessed bone segmentation and the greyscale scan so that 
-        they occupy the same physcial space as the mask.
+        they occupy the same physical space as the mask.
         """
         # crop preprocessed bone segmentation to the same size as the mask
         self.seg_img = self._boundingBoxCut(self.seg_img)
@@ -501,6 +503,14 @@ class CBCTCorticalBreakDetectionLogic:
     def getSeeds(self):
         return self.seeds
 
+    def getBreaks(self):
+        """
+        Returns:
+            list of dict: label, seed, size, centroid and bounding box of each
+                          cortical break, from maskToSeeds
+        """
+        return self.breaks
+
 
 # run this script on command line
 if __name__ == "__main__":
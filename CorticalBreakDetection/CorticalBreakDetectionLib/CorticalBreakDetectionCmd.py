@@ -12,13 +12,19 @@
 # Usage:       python PetersCorticalBreakDetectionLogicCommandLine.py inputImage [--inputContour] [--outputImage]
 #                                                 [--voxelSize] [--lowerThreshold] [--upperThreshold]
 #                                                 [--corticalThickness] [--dilateErodeDistance] [--preset]
+#                                                 [--restart] [--slabDepth] [--commonVoxelSize]
+#                                                 [--coarseFactor] [--boneWorkers] [--seedsFormat]
+#                                                 [--erosionFolder] [--minimumRadius]
+#                                                 [--erosionDilateErodeDistance]
 #              Images and contours must be in separate folders
-#              Contour filenames must contain the full name of their corresponding image
+#              Contour filenames must start with the name of their corresponding image, followed by '_'
+#              Finished scans are recorded in [outputFolder]/checkpoint.jsonl, and
+#              skipped when the batch is run again with the same inputs and parameters
 #
 # Param:       inputImage: The input image file path
 #              inputContour: The input contour file path, default=[inputImage]_MASK
 #              outputImage: The output image file path, default=[inputImage]_BREAKS
-#              outputSeeds: The output seeds csv file path, default=[inputImage]_SEEDS
+#              outputSeeds: The output seeds folder path, default=[outputFolder]
 #              voxelSize: Isotropic voxel size in micrometres, default=82
 #              lowerThreshold: default=686
 #              upperThreshold: default=4000
@@ -30,13 +36,45 @@
 #              dilateErodeDistance: kernel radius for morphological dilation and
 #                                   erosion, default=1
 #              preset: Preset configuration for scanners: 1 - XCT I, 2 - XCT II
+#              restart: Ignore the checkpoint manifest and process all scans
+#              slabDepth: Number of slices in each z-slab for scans that do not fit
+#                         in memory, default=0 (whole volume)
+#              commonVoxelSize: Isotropic voxel size in micrometres of a common grid,
+#                               for cohorts scanned at different voxel sizes. Each scan
+#                               is resampled to the common grid, the parameters are in
+#                               voxels of the common grid, and the outputs are mapped
+#                               back to the native grid of the scan. default=0 (native grid)
+#              coarseFactor: Downsampling factor of a first pass that searches candidate
+#                            cortical breaks, e.g. 2 or 4. The full resolution steps then
+#                            run around the candidates only. default=0 (whole volume)
+#              boneWorkers: Number of worker processes that run the erosion steps for
+#                           each bone of a mask with several bones in its own bounding box,
+#                           default=0 (all bones at once)
+#              seedsFormat: Format of the seeds file: csv - one 'id,x,y,z' line of voxel
+#                           indices per seed point, json - Slicer markups, fcsv - Slicer
+#                           fiducials, default=csv
+#              erosionFolder: Folder to store the erosion volume output in. The erosion
+#                             volume script runs in the same process on the seed points
+#                             of each scan, with the same thresholds and sigma,
+#                             default=None (no erosion volume)
+#              minimumRadius: Minimum erosion radius in voxels for the erosion volume, default=3
+#              erosionDilateErodeDistance: Morphological kernel radius in voxels for the
+#                                          erosion volume, default=4
 #
-# Notes:       Contour files must contain the name of the corresponding grayscale file
+# Notes:       Contour filenames must start with the name of the corresponding grayscale file,
+#              followed by '_', e.g. SAMPLE1_MASK.mha for SAMPLE1.mha
 #
 #-----------------------------------------------------
 import SimpleITK as sitk
-import os, csv
+import os, sys
 import PetersCorticalBreakDetectionLogic
+from BatchCheckpoint import BatchCheckpoint
+from MultiScale import toCommonGrid, toNativeGrid, seedsToNative
+from SeedIO import writeSeeds
+# the erosion volume library is imported as a package, so that it uses its own
+# modules rather than the modules of the same name in this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ErosionVolume'))
+from ErosionVolumeLib import ErosionVolumeCmd
 
 class PetersCorticalBreakDetectionLogicCmd:
     def __init__(self):
@@ -51,7 +89,7 @@ if __name__ == "__main__":
     parser.add_argument('inputImages', help='The file path for the directory containing grayscale scans')
     parser.add_argument('inputContours', help='The file path for the directory containing contour masks')
     parser.add_argument('outputFolder', help='The output folder file path')
-    parser.add_argument('-os', '--outputSeeds', help='The output seeds csv file path, default=[same as output folder]', default=None, metavar='')
+    parser.add_argument('-os', '--outputSeeds', help='The output seeds folder path, default=[same as output folder]', default=None, metavar='')
     parser.add_argument('-vs', '--voxelSize', type=float, help='Isotropic voxel size in micrometres, default=82', default=82, metavar='')
     parser.add_argument('-lt', '--lowerThreshold', help='default=686', type=int, default=686, metavar='')
     parser.add_argument('-ut', '--upperThreshold', help='default=15000', type=int, default=4000, metavar='')
@@ -62,6 +100,23 @@ if __name__ == "__main__":
                         help='Kernel radius for morphological dilation and erosion, default=1', metavar='')
     parser.add_argument('-p', '--preset', type=int, help='Preset configuration for scanners: 1 - XCT I, 2 - XCT II', metavar='')
     parser.add_argument('-ot', '--outputTypes', type=int, help='Images to output: 0 - None, 1 - Breaks only, 2 - Erosions only, 3 - Both', default=1, metavar='')
+    parser.add_argument('-r', '--restart', action='store_true', help='Ignore the checkpoint manifest and process all scans')
+    parser.add_argument('-sd', '--slabDepth', type=int, default=0,
+                        help='Number of slices in each z-slab for scans that do not fit in memory, default=0 (whole volume)', metavar='')
+    parser.add_argument('-cv', '--commonVoxelSize', type=float, default=0,
+                        help='Isotropic voxel size in micrometres to resample all scans to, default=0 (native grid)', metavar='')
+    parser.add_argument('-cf', '--coarseFactor', type=int, default=0,
+                        help='Downsampling factor of the candidate search, e.g. 2 or 4, default=0 (whole volume)', metavar='')
+    parser.add_argument('-bw', '--boneWorkers', type=int, default=0,
+                        help='Number of worker processes for the separate bones of a mask, default=0 (all bones at once)', metavar='')
+    parser.add_argument('-sf', '--seedsFormat', choices=['csv', 'json', 'fcsv'], default='csv',
+                        help='Format of the seeds file: csv, json (Slicer markups) or fcsv, default=csv', metavar='')
+    parser.add_argument('-eo', '--erosionFolder', default=None,
+                        help='Folder to store the erosion volume output in, default=None (no erosion volume)', metavar='')
+    parser.add_argument('-mr', '--minimumRadius', type=int, default=3,
+                        help='Minimum erosion radius in voxels for the erosion volume, default=3', metavar='')
+    parser.add_argument('-eded', '--erosionDilateErodeDistance', type=int, default=4,
+                        help='Morphological kernel radius in voxels for the erosion volume, default=4', metavar='')
     args = parser.parse_args()
 
     input_dir = args.inputImages
@@ -76,6 +131,13 @@ if __name__ == "__main__":
     dilateErodeDistance = args.dilateErodeDistance
     preset = args.preset
     outputTypes = args.outputTypes
+    resume = not args.restart
+    slabDepth = args.slabDepth
+    commonVoxelSize = args.commonVoxelSize
+    coarseFactor = args.coarseFactor
+    boneWorkers = args.boneWorkers
+    seedsFormat = args.seedsFormat
+    erosion_dir = args.erosionFolder
 
     #set seeds_dir if none
     if not seeds_dir:
@@ -90,33 +152,79 @@ if __name__ == "__main__":
         voxelSize = 60.7
         corticalThickness = 5
         dilateErodeDistance = 3
+    # the parameters apply to the common grid
+    if commonVoxelSize > 0:
+        voxelSize = commonVoxelSize
 
-    contour_list = os.listdir(contour_dir)
-    for file in os.listdir(input_dir):
+    # the output folders are part of the checkpoint key, so that a run with other
+    # output folders does not skip the scans whose outputs are in the old folders
+    params = {'voxelSize': voxelSize, 'lower': lower, 'upper': upper, 'sigma': sigma,
+              'corticalThickness': corticalThickness, 'dilateErodeDistance': dilateErodeDistance,
+              'outputTypes': outputTypes, 'seedsFolder': os.path.abspath(seeds_dir)}
+    if commonVoxelSize > 0:
+        params['commonVoxelSize'] = commonVoxelSize
+    if seedsFormat != 'csv':
+        params['seedsFormat'] = seedsFormat
 
-        # read image
-        try:
-            img = sitk.ReadImage(input_dir + '/' + file)
-        except:
-            print('Could not read in ' + file)
-            continue
+    # the erosion volume runs on the seed points in memory, without reading them back
+    if erosion_dir:
+        erosion_params = {'lower': lower,
+                          'upper': upper,
+                          'sigma': sigma,
+                          'minimumRadius': args.minimumRadius,
+                          'dilateErodeDistance': args.erosionDilateErodeDistance,
+                          'localLevelSet': False,
+                          'levelSetWorkers': 1,
+                          'intermediate_dir': None,
+                          'lowMemory': False}
+        params['erosion'] = {'minimumRadius': args.minimumRadius,
+                             'dilateErodeDistance': args.erosionDilateErodeDistance,
+                             'folder': os.path.abspath(erosion_dir)}
+    checkpoint = BatchCheckpoint(output_dir)
 
+    contour_list = os.listdir(contour_dir)
+    for file in os.listdir(input_dir):
         filename = os.path.splitext(file)[0]
         
         #read mask(s)
         contours = []
         for contour_name in contour_list:
-            if filename in contour_name:
+            if ErosionVolumeCmd._matchesName(contour_name, filename):
                 contours.append(contour_name)
         if len(contours) == 0:
             print("No contours found for " + file)
             continue
 
+        # skip contours that finished in a previous run
+        input_files = {}
+        for contour_name in reversed(contours):
+            input_files[contour_name] = [input_dir + '/' + file, contour_dir + '/' + contour_name]
+            if resume and checkpoint.isDone(contour_dir + '/' + contour_name, 
+                                            input_files[contour_name], params):
+                print(contour_name + " skipped, already done")
+                contours.remove(contour_name)
+        if len(contours) == 0:
+            continue
+
+        # read image
+        try:
+            img = sitk.ReadImage(input_dir + '/' + file)
+        except:
+            print('Could not read in ' + file)
+            continue
+
         for contour_name in contours:
             contour = sitk.ReadImage(contour_dir + '/' + contour_name)
+            if commonVoxelSize > 0:
+                run_img, run_contour = toCommonGrid(img, contour, commonVoxelSize / 1000)
+            else:
+                run_img, run_contour = img, contour
             # create erosion logic object
-            erosion = PetersCorticalBreakDetectionLogic.PetersCorticalBreakDetectionLogic(img, contour, voxelSize, lower, upper,
+            erosion = PetersCorticalBreakDetectionLogic.PetersCorticalBreakDetectionLogic(run_img, run_contour, voxelSize, lower, upper,
                                             sigma, corticalThickness, dilateErodeDistance)
+            erosion.setSlabDepth(slabDepth)
+            erosion.setCoarseFactor(coarseFactor)
+            erosion.setBoneWorkers(boneWorkers)
 
             # identify erosions
             step = 1
@@ -126,17 +234,34 @@ if __name__ == "__main__":
             break_img = erosion.getOutputBreaks()
             erosion_img = erosion.getOutputErosions()
             seeds_list = erosion.getSeeds()
+            if commonVoxelSize > 0:
+                # map the outputs back to the native grid of the scan
+                break_img = toNativeGrid(break_img, contour)
+                erosion_img = toNativeGrid(erosion_img, contour)
+                seeds_list = seedsToNative(seeds_list, run_img, img)
+                del run_img, run_contour
 
             print("Saving output files")
             contour_filename = os.path.splitext(contour_name)[0]
+            output_files = []
             # store erosion_img in output_dir
             if outputTypes == 1 or outputTypes == 3:
-                sitk.WriteImage(break_img, output_dir + '/' + contour_filename + '_BREAKS.mha')
+                output_files.append(output_dir + '/' + contour_filename + '_BREAKS.mha')
+                sitk.WriteImage(break_img, output_files[-1])
             if outputTypes == 2 or outputTypes == 3:
-                sitk.WriteImage(erosion_img, output_dir + '/' + contour_filename + '_EROSIONS.mha')
+                output_files.append(output_dir + '/' + contour_filename + '_EROSIONS.mha')
+                sitk.WriteImage(erosion_img, output_files[-1])
 
             #store erosion seeds
-            with open(seeds_dir + '/' + contour_filename + '_SEEDS.csv', 'w', newline='') as f:
-                writer = csv.writer(f)
-                for i in range(len(seeds_list)):
-                    writer.writerow([i] + list(seeds_list[i]))
+            output_files.append(seeds_dir + '/' + contour_filename + '_SEEDS.' + seedsFormat)
+            writeSeeds(output_files[-1], seeds_list, img)
+
+            # erosion volume of the seed points
+            if erosion_dir:
+                output_files.append(ErosionVolumeCmd.processSeeds(img, sitk.Cast(contour, sitk.sitkUInt8), 
+                                                                  seeds_list, contour_filename, 
+                                                                  erosion_dir, erosion_params))
+
+            # record the finished scan in the checkpoint manifest
+            checkpoint.record(contour_dir + '/' + contour_name, input_files[contour_name], 
+                              params, output_files)
@@ -33,6 +33,9 @@ class CorticalBreakDetectionLogic(ScriptedLoadableModuleLogic):
     self.progressCallBack = None
 
     self.CorticalBreakDetection = PetersCorticalBreakDetectionLogic()
+    # keep up to 2 GB of smoothed and binarized scans in the preprocessing cache
+    #  shared with the erosion volume module, so that it does not recompute them
+    self.CorticalBreakDetection.setCacheLimit(2 * 1024**3)
 
   def IJKToRASCoords(self, ijk_3coords, ijk2ras):
     """
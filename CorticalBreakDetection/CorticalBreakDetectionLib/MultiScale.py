@@ -0,0 +1,137 @@
+#-----------------------------------------------------
+# MultiScale.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module resamples scans of different voxel sizes to a common
+#              isotropic grid, so that a mixed cohort can run the cortical break
+#              detection with one set of parameters, and maps the outputs back
+#              to the native grid of each scan.
+#
+#-----------------------------------------------------
+# Usage:       common_img, common_contour = toCommonGrid(img, contour, spacing)
+#              ...
+#              break_img = toNativeGrid(common_break_img, contour)
+#              seeds = seedsToNative(common_seeds, common_img, img)
+#
+#-----------------------------------------------------
+import SimpleITK as sitk
+try:
+    from .BreakStatistics import indexToPhysical, physicalToIndex
+except ImportError: # run as a script, e.g. from CorticalBreakDetectionCmd
+    from BreakStatistics import indexToPhysical, physicalToIndex
+
+def commonGridInfo(img, spacing):
+    """
+    Isotropic grid with the given spacing that covers the same physical space as the image.
+
+    Args:
+        img (Image)
+        spacing (float): in millimetres
+
+    Returns:
+        tuple: size, origin
+    """
+    # keep the outer corner of the first voxel in place
+    size = [max(round(img.GetSize()[i] * img.GetSpacing()[i] / spacing), 1) for i in range(3)]
+    origin = img.TransformContinuousIndexToPhysicalPoint(
+        [0.5 * spacing / img.GetSpacing()[i] - 0.5 for i in range(3)])
+
+    return size, origin
+
+def resample(img, size, origin, spacing, direction, interpolator):
+    """
+    Args:
+        img (Image)
+        size (list of int)
+        origin (tuple)
+        spacing (float): in millimetres
+        direction (tuple)
+        interpolator (int): e.g. sitk.sitkLinear
+
+    Returns:
+        Image: same pixel type as img
+    """
+    resample_filter = sitk.ResampleImageFilter()
+    resample_filter.SetSize([int(n) for n in size])
+    resample_filter.SetOutputOrigin(origin)
+    resample_filter.SetOutputSpacing([spacing] * 3)
+    resample_filter.SetOutputDirection(direction)
+    resample_filter.SetInterpolator(interpolator)
+    resample_filter.SetDefaultPixelValue(0)
+    resample_filter.SetOutputPixelType(img.GetPixelID())
+    return resample_filter.Execute(img)
+
+def toCommonGrid(img, contour_img, spacing):
+    """
+    Resample the scan and its contour to an isotropic grid. The contour grid is
+    aligned with the scan grid, so that the contour can be cut out of the scan.
+
+    Args:
+        img (Image): greyscale scan
+        contour_img (Image): periosteal mask
+        spacing (float): in millimetres
+
+    Returns:
+        tuple of Image: scan with linear interpolation, contour with nearest neighbour
+    """
+    print("Resampling to a common grid")
+    size, origin = commonGridInfo(img, spacing)
+    direction = img.GetDirection()
+    common_img = resample(img, size, origin, spacing, direction, sitk.sitkLinear)
+
+    # snap the contour grid to the nearest voxel of the common scan grid
+    contour_size, contour_origin = commonGridInfo(contour_img, spacing)
+    index = common_img.TransformPhysicalPointToIndex(contour_origin)
+    contour_origin = common_img.TransformIndexToPhysicalPoint(index)
+    common_contour = resample(contour_img, contour_size, contour_origin, spacing, direction,
+                              sitk.sitkNearestNeighbor)
+
+    return common_img, common_contour
+
+def toNativeGrid(img, native_img):
+    """
+    Resample a label image on the common grid back to the grid of a native image,
+    cropped to the physical space of the label image.
+
+    Args:
+        img (Image): labels on the common grid
+        native_img (Image): image on the native grid, e.g. the contour
+
+    Returns:
+        Image
+    """
+    # native voxels nearest to the corner voxels of the label image
+    corners = [[(n - 1 if i >> axis & 1 else 0) for axis, n in enumerate(img.GetSize())]
+               for i in range(8)]
+    native_corners = physicalToIndex(indexToPhysical(corners, img), native_img)
+    lower = [max(int(native_corners[:, i].min()), 0) for i in range(3)]
+    upper = [min(int(native_corners[:, i].max()) + 1, native_img.GetSize()[i]) for i in range(3)]
+    size = [max(upper[i] - lower[i], 1) for i in range(3)]
+
+    origin = native_img.TransformIndexToPhysicalPoint(lower)
+    resample_filter = sitk.ResampleImageFilter()
+    resample_filter.SetSize(size)
+    resample_filter.SetOutputOrigin(origin)
+    resample_filter.SetOutputSpacing(native_img.GetSpacing())
+    resample_filter.SetOutputDirection(native_img.GetDirection())
+    resample_filter.SetInterpolator(sitk.sitkNearestNeighbor)
+    resample_filter.SetDefaultPixelValue(0)
+    return resample_filter.Execute(img)
+
+def seedsToNative(seeds, common_img, native_img):
+    """
+    Convert seed indices on the common grid to indices on the native grid.
+
+    Args:
+        seeds (list of tuple): (x,y,z) indices of common_img
+        common_img (Image)
+        native_img (Image)
+
+    Returns:
+        list of tuple: (x,y,z) indices of native_img
+    """
+    if len(seeds) == 0:
+        return []
+    native_seeds = physicalToIndex(indexToPhysical(seeds, common_img), native_img)
+    return [tuple(int(v) for v in seed) for seed in native_seeds]
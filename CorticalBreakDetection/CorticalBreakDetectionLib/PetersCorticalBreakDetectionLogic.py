@@ -26,8 +26,64 @@
 #              dilateErodeDistance: kernel radius for morphological dilation and 
 #                                   erosion, default=1
 #
+# Notes:       For very tall scans, the steps can run on overlapping z-slabs of 
+#              slabDepth slices, so that only the inputs and outputs of each step 
+#              are held as whole volumes. Connected components are merged across 
+#              the slab boundaries with SlabComponents.
+#              Cortical breaks are sparse, so steps 4 and 5 can also run in two passes:
+#              a search for candidate breaks on the output of step 3 downsampled by 
+#              coarseFactor, then the full resolution steps in boxes around the 
+#              candidates only.
+#              If the mask contains several bones, steps 6 to 10 can run for each 
+#              bone in its own bounding box, in parallel worker processes.
+#
 #-----------------------------------------------------
 import SimpleITK as sitk
+import numpy as np
+import math, os
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from .Preprocessing import sharedPreprocessing, gaussianRegion
+    from .SlabComponents import SlabComponents
+    from .BoundedDistance import danielssonDeflate
+    from .BreakStatistics import breakSeeds, breakTable, indexToPhysical, physicalToIndex
+except ImportError: # run as a script, e.g. from CorticalBreakDetectionCmd
+    from Preprocessing import sharedPreprocessing, gaussianRegion
+    from SlabComponents import SlabComponents
+    from BoundedDistance import danielssonDeflate
+    from BreakStatistics import breakSeeds, breakTable, indexToPhysical, physicalToIndex
+
+def _initWorker(threads):
+    """
+    Limit the number of ITK threads in each worker process.
+    """
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+def _detectBone(seg_img, contour_img, breaks_img, params):
+    """
+    Run steps 6 to 10 on one bone. This is a module function, so that it can 
+    run in a worker process.
+
+    Args:
+        seg_img (Image): bone segmentation around the bone
+        contour_img (Image): periosteal mask around the bone
+        breaks_img (Image): cortical breaks from step 5 around the bone
+        params (dict): corticalThickness and slabDepth
+
+    Returns:
+        Image: output_img, the erosions around the bone
+    """
+    logic = PetersCorticalBreakDetectionLogic(corticaThickness=params['corticalThickness'])
+    logic.setSlabDepth(params['slabDepth'])
+    # the box is on the grid of the mask already, so it is not cropped again
+    logic.peri_contour = contour_img
+    logic.seg_img = seg_img
+    logic.breaks_img = breaks_img
+    logic.background_img = logic._background(contour_img)
+    for step in range(6, 11):
+        logic.execute(step)
+
+    return logic.output_img
 
 class PetersCorticalBreakDetectionLogic:
     def __init__(self, img=None, contour_img=None, voxelSize=61, lower=686, upper=15000, 
@@ -50,9 +106,20 @@ class PetersCorticalBreakDetectionLogic:
         self.corticalThickness = corticaThickness       # thickness of cortical shell in voxels
         self.dilateErodeDistance = dilateErodeDistance  # morphological kernel radius in voxels
         self.seeds = []                       # seed point inside each cortical break, will modified
+        self.breaks = []                      # label, seed, size, centroid and bounding box of each break
         self.stepNum = 11
         self.auto_thresh = False
         self.method = 0
+        self.preprocessing = sharedPreprocessing() # Gaussian and threshold shared between modules
+        self.slabDepth = 0                    # number of slices in each z-slab, 0 runs on the whole volume
+        self._breaksLabels = None             # output of dilateBreaks and its labels, reused by maskToSeeds
+        self._breaksComponents = None         # output of dilateBreaks on slabs, the components of its breaks
+                                              #  and the number of breaks
+        self.coarseFactor = 0                 # downsampling factor of the candidate search, 0 runs steps 4 and 5
+                                              #  on the whole volume
+        self._candidateBoxes = None           # (index, size) of the boxes around the candidate breaks
+        self.boneWorkers = 0                  # number of worker processes for separate bones, 
+                                              #  0 runs the steps on all bones at once
     
     def smoothen(self, img, sigma, lower, upper): # step 1
         """
@@ -67,47 +134,12 @@ class PetersCorticalBreakDetectionLogic:
         Returns:
             Image: bone is labeled with 1, and background is labeled with 0.
         """
-        sigma_over_spacing = sigma * img.GetSpacing()[0]
-
-        # gaussian smoothing filter
-        print("Applying Gaussian filter")
-        gaussian_filter = sitk.SmoothingRecursiveGaussianImageFilter()
-        gaussian_filter.SetSigma(sigma_over_spacing)
-        gaussian_img = gaussian_filter.Execute(img)
-
-        thresh_img = sitk.BinaryThreshold(gaussian_img, 
-                                          lowerThreshold=lower, 
-                                          upperThreshold=upper, 
-                                          insideValue=1)
-
-        return thresh_img
+        # memoised, so that the erosion volume module can reuse it
+        return self.preprocessing.threshold(img, sigma, lower, upper)
     
     def auto_smoothen(self, img:sitk.Image, sigma:float, method:int) -> sitk.Image:
         '''Denoise and binarize with an automatic thresholding method'''
-        sigma_over_spacing = sigma * img.GetSpacing()[0]
-
-        # gaussian smoothing filter
-        print("Applying Gaussian filter")
-        gaussian_filter = sitk.SmoothingRecursiveGaussianImageFilter()
-        gaussian_filter.SetSigma(sigma_over_spacing)
-        gaussian_img = gaussian_filter.Execute(img)
-
-        #set thresholding method
-        if method == 0:
-            thresh = sitk.OtsuThresholdImageFilter()
-        elif method == 1:
-            thresh = sitk.HuangThresholdImageFilter()
-        elif method == 2:
-            thresh = sitk.MaximumEntropyThresholdImageFilter()
-        elif method == 3:
-            thresh = sitk.MomentsThresholdImageFilter()
-        elif method == 4:
-            thresh = sitk.YenThresholdImageFilter()
-
-        #get threshold
-        thresh.SetOutsideValue(1)
-        thresh.SetInsideValue(0)
-        return thresh.Execute(gaussian_img)
+        return self.preprocessing.autoThreshold(img, sigma, method)
 
     def deflate(self, img, radius, foreground):
         """
@@ -121,16 +153,9 @@ class PetersCorticalBreakDetectionLogic:
         Returns:
             Image
         """
-        # deflate with Maurer distance map filter
+        # deflate with Danielsson distance map filter, on the bounding box of the object
         print("Applying distance map filter")
-        distance_filter = sitk.SignedDanielssonDistanceMapImageFilter()
-        distance_filter.SetSquaredDistance(False)
-        distance_filter.SetInsideIsPositive(True)
-        distance_img = distance_filter.Execute(img)
-
-        deflate_img = sitk.BinaryThreshold(distance_img, 
-                                           lowerThreshold=radius,
-                                           insideValue=foreground)
+        deflate_img = danielssonDeflate(img, radius, foreground)
 
         return deflate_img
 
@@ -146,20 +171,40 @@ class PetersCorticalBreakDetectionLogic:
         # erode peri_contour by [6] voxels to get the endosteal boundary, 
         #  which is [6] voxels away from the periosteal boundary/mask
         #  default thickness is 6 (6 * 0.061mm = 0.366mm)
+        self.endo_contour, self.cortical_mask, self.background_img = self._masks(self.peri_contour)
+
+    def _masks(self, peri_contour):
+        """
+        Args:
+            peri_contour (Image)
+
+        Returns:
+            tuple of Image: endo_contour, cortical_mask, and background_img
+        """
         print("Applying erode filter")
         #erode_filter = sitk.BinaryErodeImageFilter()
         #erode_filter.SetForegroundValue(1)
         #erode_filter.SetKernelRadius(self._corticalThickness)
-        #self.endo_contour = erode_filter.Execute(self.peri_contour)
-        self.endo_contour = self.deflate(self.peri_contour, self.corticalThickness, 1)
+        #endo_contour = erode_filter.Execute(peri_contour)
+        endo_contour = self.deflate(peri_contour, self.corticalThickness, 1)
 
         # subtract inner contour from contour to get cortical mask
-        self.cortical_mask = self.peri_contour - self.endo_contour
+        cortical_mask = peri_contour - endo_contour
+
+        return endo_contour, cortical_mask, self._background(peri_contour)
+
+    def _background(self, peri_contour):
+        """
+        Args:
+            peri_contour (Image)
 
+        Returns:
+            Image: background_img
+        """
         # invert to get the background
         invert_filter = sitk.InvertIntensityImageFilter()
         invert_filter.SetMaximum(1)
-        self.background_img = invert_filter.Execute(self.peri_contour)
+        return invert_filter.Execute(peri_contour)
 
     def erodeBreaks(self, thresh_img, radius): # step 3
         """
@@ -196,13 +241,7 @@ class PetersCorticalBreakDetectionLogic:
         Returns:
             Image
         """
-        # invert to select breaks, background, and trabecular region
-        invert_filter = sitk.InvertIntensityImageFilter()
-        invert_filter.SetMaximum(1)
-        invert_img = invert_filter.Execute(breaks_img)
-
-        # label breaks and background only
-        breaks_background = sitk.Mask(invert_img, self.endo_contour, outsideValue=0, maskingValue=1)
+        breaks_background = self._breaksBackground(breaks_img)
 
         # connectivity filter to select background and breaks connected to periosteal surface
         background_seed = [0,0,0]
@@ -213,8 +252,18 @@ class PetersCorticalBreakDetectionLogic:
         connected_thr_filter.SetReplaceValue(1)
         breaks_background = connected_thr_filter.Execute(breaks_background)
         
+        return self._connectTrabecular(breaks_background * self.peri_contour)
+
+    def _connectTrabecular(self, breaks_img):
+        """
+        Args:
+            breaks_img (Image): cortical breaks connected to the background
+
+        Returns:
+            Image: cortical breaks connected to the trabecular region
+        """
         # label breaks and trabecular region only
-        breaks_trabecular = (breaks_background * self.peri_contour) | self.endo_contour
+        breaks_trabecular = breaks_img | self.endo_contour
 
         # connectivity filter to select trabecular region and breaks connected to trabecular region
         connected_filter = sitk.ConnectedComponentImageFilter()
@@ -228,12 +277,60 @@ class PetersCorticalBreakDetectionLogic:
 
         return breaks_img
 
+    def _breaksBackground(self, breaks_img):
+        """
+        Args:
+            breaks_img (Image)
+
+        Returns:
+            Image: breaks and background are labeled with 1.
+        """
+        # invert to select breaks, background, and trabecular region
+        invert_filter = sitk.InvertIntensityImageFilter()
+        invert_filter.SetMaximum(1)
+        invert_img = invert_filter.Execute(breaks_img)
+
+        # label breaks and background only
+        return sitk.Mask(invert_img, self.endo_contour, outsideValue=0, maskingValue=1)
+
     def dilateBreaks(self, breaks_img, radius): # step 5
         """
         Morphologically dilates cortical breaks back to their original size,
         and filters out tiny breaks. The erode distance will be specified by 
         dilateErodeDistance.
 
+        Args:
+            breaks_img (Image)
+            radius (Int): dilate distance in voxels
+
+        Returns:
+            Image
+        """
+        breaks_img = self._dilateBreaksMasked(breaks_img, radius)
+
+        return self._filterBreaks(breaks_img)
+
+    def _filterBreaks(self, breaks_img):
+        """
+        Args:
+            breaks_img (Image): dilated cortical breaks
+
+        Returns:
+            Image
+        """
+        # remove breaks less than 20*0.061^3 mm3 in size
+        breaks_label = sitk.ConnectedComponent(breaks_img)
+        breaks_label = sitk.RelabelComponent(breaks_label, minimumObjectSize=self._minimumBreakSize())
+        breaks_img = sitk.BinaryThreshold(breaks_label, lowerThreshold=1)
+
+        # the remaining breaks are the components of breaks_img, labeled from 
+        #  large to small, so maskToSeeds can reuse the labels
+        #  (the threshold keeps labels up to 255 only)
+        self._breaksLabels = (breaks_img, sitk.Mask(breaks_label, breaks_img))
+        return breaks_img
+
+    def _dilateBreaksMasked(self, breaks_img, radius):
+        """
         Args:
             breaks_img (Image)
             radius (Int): dilate distance in voxels
@@ -251,16 +348,16 @@ class PetersCorticalBreakDetectionLogic:
         breaks_img = dilate_filter.Execute(breaks_img)
 
         # apply cortical_mask to breaks
-        breaks_img = breaks_img * self.cortical_mask
+        return breaks_img * self.cortical_mask
 
-        # remove breaks less than 20*0.061^3 mm3 in size
+    def _minimumBreakSize(self):
+        """
+        Returns:
+            int: minimum cortical break size in voxels, 20 voxels at 82 micrometres
+        """
         scale = 82 / self.voxelSize
-        breaks_label = sitk.ConnectedComponent(breaks_img)
         minimumObjectSize_voxel = 20
-        minimumObjectSize = round(minimumObjectSize_voxel * scale**3)
-        breaks_label = sitk.RelabelComponent(breaks_label, minimumObjectSize=minimumObjectSize)
-        breaks_img = sitk.BinaryThreshold(breaks_label, lowerThreshold=1)
-        return breaks_img
+        return round(minimumObjectSize_voxel * scale**3)
 
     def createROI(self, thresh_img): # step 6
         """
@@ -354,14 +451,7 @@ class PetersCorticalBreakDetectionLogic:
         Returns:
             Image
         """
-        dilate_filter = sitk.BinaryDilateImageFilter()
-        dilate_filter.SetForegroundValue(1)
-        dilate_filter.SetKernelRadius(distance)
-        dilated_breaks = dilate_filter.Execute(breaks_img)
-        dilated_breaks = sitk.Mask(dilated_breaks, self.seg_img, outsideValue=0, maskingValue=1)
-
-        # erosion_background consists of (voids + dilated cortical breaks + background)
-        erosion_background = erode_img | dilated_breaks | self.background_img
+        erosion_background = self._erosionBackground(erode_img, breaks_img, distance)
 
         # connectivity filter
         connected_filter = sitk.ConnectedComponentImageFilter()
@@ -378,6 +468,25 @@ class PetersCorticalBreakDetectionLogic:
 
         return connect_img
 
+    def _erosionBackground(self, erode_img, breaks_img, distance):
+        """
+        Args:
+            erode_img (Image)
+            breaks_img (Image)
+            distance (int)
+
+        Returns:
+            Image: voids, dilated cortical breaks and background are labeled with 1.
+        """
+        dilate_filter = sitk.BinaryDilateImageFilter()
+        dilate_filter.SetForegroundValue(1)
+        dilate_filter.SetKernelRadius(distance)
+        dilated_breaks = dilate_filter.Execute(breaks_img)
+        dilated_breaks = sitk.Mask(dilated_breaks, self.seg_img, outsideValue=0, maskingValue=1)
+
+        # erosion_background consists of (voids + dilated cortical breaks + background)
+        return erode_img | dilated_breaks | self.background_img
+
     def dilateVoidVolume(self, connect_img, radius): # step 10
         """
         Morphologically dilate voids back to their original size.
@@ -420,23 +529,34 @@ class PetersCorticalBreakDetectionLogic:
 
     def maskToSeeds(self, breaks_img): # step 12
         """
-        Convert cortical break mask to seed points.
+        Convert cortical break mask to seed points and the metadata of each break.
 
         Args:
             breaks_img (Image)
         """
-        # label each cortical break with a different label
-        label_img = sitk.ConnectedComponent(breaks_img)
-        label_img = sitk.RelabelComponent(label_img)
+        label_img = self._breakLabels(breaks_img)
 
-        stats_filter = sitk.LabelIntensityStatisticsImageFilter()
-        stats_filter.Execute(label_img, self.seg_img)
-        labelNum = stats_filter.GetNumberOfLabels()
+        seeds, breaks = breakSeeds(label_img, self.model_img)
+        self.seeds.extend(seeds)
+        self.breaks.extend(breaks)
 
-        for i in range(labelNum):
-            seed = stats_filter.GetCentroid(i+1)
-            seed = self.model_img.TransformPhysicalPointToIndex(seed)
-            self.seeds.append(seed)
+    def _breakLabels(self, breaks_img):
+        """
+        Label each cortical break with a different label, from large to small.
+        The labels from dilateBreaks are reused if breaks_img is its output.
+
+        Args:
+            breaks_img (Image)
+
+        Returns:
+            Image
+        """
+        if self._breaksLabels is not None and self._breaksLabels[0] is breaks_img:
+            return self._breaksLabels[1]
+
+        # label each cortical break with a different label
+        label_img = sitk.ConnectedComponent(breaks_img)
+        return sitk.RelabelComponent(label_img)
 
     def execute(self, step):
         """
@@ -448,6 +568,14 @@ class PetersCorticalBreakDetectionLogic:
         Returns:
             bool: False if reached the end of the algorithm, True otherwise.
         """
+        # _boneNum also counts the background label
+        if self.boneWorkers > 0 and self._boneNum > 2 and 6 <= step <= 10:
+            return self._executeBones(step)
+        if self.slabDepth > 0:
+            return self._executeSlabs(step)
+        if self.coarseFactor > 1 and 3 <= step <= 5:
+            return self._executeCoarse(step)
+
         if step == 1:
             if self.auto_thresh:
                 self.seg_img = self.auto_smoothen(self.model_img, self.sigma, self.method)
@@ -480,9 +608,628 @@ class PetersCorticalBreakDetectionLogic:
             return False
         return True
 
+    def _executeSlabs(self, step):
+        """
+        Executes the specified step in the algorithm on z-slabs. Each slab is 
+        processed with a halo of slices derived from the kernel radii of the step, 
+        so the output is the same as on the whole volume. Steps with connected 
+        components run twice over the slabs: first to merge the components 
+        across the slab boundaries, then to select them.
+        The masks from step 2 are computed for each slab and not kept.
+
+        Args:
+            step(int): 1 <= step <= self.stepNum
+
+        Returns:
+            bool: False if reached the end of the algorithm, True otherwise.
+        """
+        radius = self.corticalThickness
+        if step == 1:
+            if self.auto_thresh:
+                # automatic thresholds depend on the histogram of the whole scan
+                self.seg_img = self.auto_smoothen(self.model_img, self.sigma, self.method)
+            else:
+                self.seg_img = self._smoothenSlabs(self.model_img, self.sigma, 
+                                                   self.lower_threshold, self.upper_threshold)
+        elif step == 2:
+            self._initializeParams()
+        elif step == 3:
+            self.breaks_img = self._runSlabs(lambda slab: self.erodeBreaks(slab, self.dilateErodeDistance),
+                                             self.seg_img, self.dilateErodeDistance, masks=True)
+        elif step == 4:
+            self.breaks_img = self._connectBreaksSlabs(self.breaks_img)
+        elif step == 5:
+            self.breaks_img = self._dilateBreaksSlabs(self.breaks_img, self.dilateErodeDistance)
+        elif step == 6:
+            self.output_img = self._runSlabs(self.createROI, self.seg_img, 0)
+        elif step == 7:
+            # the inner voids need a halo of the radius, and the outer voids 
+            #  need the inner voids in a halo of the radius
+            self.output_img = self._runSlabs(lambda slab: self.distanceVoidVolume(slab, radius),
+                                             self.output_img, 2 * (radius + 1))
+        elif step == 8:
+            self.output_img = self._runSlabs(lambda slab: self.erodeVoidVolume(slab, radius),
+                                             self.output_img, radius)
+        elif step == 9:
+            self.output_img = self._connectVoidVolumeSlabs(self.output_img, self.breaks_img, radius)
+        elif step == 10:
+            self.output_img = self._runSlabs(lambda slab: self.dilateVoidVolume(slab, radius),
+                                             self.output_img, radius)
+        elif step == 11:
+            self._maskToSeedsSlabs(self.breaks_img)
+            print(self.seeds)
+        else:
+            return False
+        return True
+
+    def _slabRanges(self, depth):
+        """
+        Args:
+            depth (int): number of slices in the volume
+
+        Returns:
+            list of tuple: first and last+1 slice of each slab
+        """
+        return [(z, min(z + self.slabDepth, depth)) for z in range(0, depth, self.slabDepth)]
+
+    def _useSlab(self, first, last, masks=False):
+        """
+        Replace the periosteal mask, the bone segmentation and the masks from 
+        step 2 with the slices first to last of them, so that the steps can run 
+        on a slab. The endosteal mask is computed with a halo of corticalThickness.
+
+        Args:
+            first (int)
+            last (int)
+            masks (bool): If False, only the background mask is computed.
+
+        Returns:
+            tuple of Image: the whole periosteal mask and bone segmentation, 
+                            to be restored with _restoreSlab
+        """
+        whole = (self.peri_contour, self.seg_img)
+        depth = self.peri_contour.GetDepth()
+        if masks:
+            halo = math.ceil(self.corticalThickness) + 1
+            halo_first = max(first - halo, 0)
+            halo_last = min(last + halo, depth)
+            self.endo_contour, self.cortical_mask, self.background_img = \
+                [mask[:, :, first-halo_first:last-halo_first] 
+                 for mask in self._masks(self.peri_contour[:, :, halo_first:halo_last])]
+        else:
+            self.background_img = self._background(self.peri_contour[:, :, first:last])
+        self.peri_contour = self.peri_contour[:, :, first:last]
+        self.seg_img = self.seg_img[:, :, first:last]
+
+        return whole
+
+    def _restoreSlab(self, whole):
+        """
+        Args:
+            whole (tuple of Image): from _useSlab
+        """
+        self.peri_contour, self.seg_img = whole
+        self.endo_contour = None
+        self.cortical_mask = None
+        self.background_img = None
+
+    def _runSlabs(self, compute, img, halo, masks=False):
+        """
+        Run a step without connected components on each slab with a halo of 
+        slices, and keep the core of each result.
+
+        Args:
+            compute (function): runs the step on a slab of img
+            img (Image): input of the step
+            halo (int): number of slices on each side of the slab
+            masks (bool): If True, the step uses the endosteal or cortical mask.
+
+        Returns:
+            Image
+        """
+        depth = img.GetDepth()
+        output = None
+        for first, last in self._slabRanges(depth):
+            halo_first = max(first - halo, 0)
+            halo_last = min(last + halo, depth)
+            whole = self._useSlab(halo_first, halo_last, masks)
+            try:
+                slab_img = compute(img[:, :, halo_first:halo_last])
+            finally:
+                self._restoreSlab(whole)
+            output = self._pasteSlab(output, slab_img[:, :, first-halo_first:last-halo_first], first, depth)
+
+        return self._arrayToImage(output, img)
+
+    def _pasteSlab(self, array, slab_img, first, depth):
+        """
+        Args:
+            array (ndarray): whole volume, None to allocate it
+            slab_img (Image)
+            first (int): first slice of the slab in the volume
+            depth (int): number of slices in the volume
+
+        Returns:
+            ndarray
+        """
+        slab = sitk.GetArrayViewFromImage(slab_img)
+        if array is None:
+            array = np.zeros((depth,) + slab.shape[1:], dtype=slab.dtype)
+        array[first:first+slab.shape[0]] = slab
+        return array
+
+    def _arrayToImage(self, array, reference_img):
+        img = sitk.GetImageFromArray(array)
+        img.CopyInformation(reference_img)
+        return img
+
+    def _smoothenSlabs(self, img, sigma, lower, upper):
+        """
+        Step 1 on slabs of the scan, see smoothen. Each slab is smoothed with a 
+        halo of GAUSSIAN_MARGIN sigmas, see gaussianRegion, so that it matches the 
+        whole scan up to float rounding. The shared preprocessing cache is bypassed.
+
+        Args:
+            img (Image)
+            sigma (Float)
+            lower (int)
+            upper (int)
+
+        Returns:
+            Image
+        """
+        depth = img.GetDepth()
+        output = None
+        for first, last in self._slabRanges(depth):
+            region = ((0, 0, first), (img.GetWidth(), img.GetHeight(), last - first))
+            thresh_img = sitk.BinaryThreshold(gaussianRegion(img, sigma, region), 
+                                              lowerThreshold=lower, 
+                                              upperThreshold=upper, 
+                                              insideValue=1)
+            output = self._pasteSlab(output, thresh_img, first, depth)
+
+        return self._arrayToImage(output, img)
+
+    def _connectBreaksSlabs(self, breaks_img):
+        """
+        Step 4 on slabs, see connectBreaks.
+
+        Args:
+            breaks_img (Image)
+
+        Returns:
+            Image
+        """
+        depth = breaks_img.GetDepth()
+        slabs = self._slabRanges(depth)
+
+        # label breaks and background only, 
+        #  keep the endosteal mask in the second bit so that it is computed once
+        background_components = SlabComponents()
+        stage = None
+        for first, last in slabs:
+            whole = self._useSlab(first, last, masks=True)
+            try:
+                breaks_background = self._breaksBackground(breaks_img[:, :, first:last])
+                stage_img = breaks_background | (self.endo_contour * 2)
+            finally:
+                self._restoreSlab(whole)
+            background_components.add(sitk.ConnectedComponent(breaks_background), first)
+            stage = self._pasteSlab(stage, stage_img, first, depth)
+        background_components.resolve()
+
+        # select background and breaks connected to the corner of the volume,
+        #  and label breaks and trabecular region only
+        trabecular_components = SlabComponents()
+        background_label = None
+        for first, last in slabs:
+            endo_contour, breaks_background = self._splitStage(stage[first:last], 
+                                                               self.peri_contour[:, :, first:last])
+            label_img = background_components.relabel(sitk.ConnectedComponent(breaks_background), first)
+            if background_label is None:
+                background_label = label_img[0, 0, 0]
+            if background_label > 0:
+                breaks_background = sitk.BinaryThreshold(label_img, 
+                                                         lowerThreshold=background_label,
+                                                         upperThreshold=background_label)
+            else: # the corner of the volume is not background
+                breaks_background = breaks_background * 0
+            breaks_trabecular = ((breaks_background * self.peri_contour[:, :, first:last]) | 
+                                 endo_contour)
+            trabecular_components.add(sitk.ConnectedComponent(breaks_trabecular), first)
+            stage = self._pasteSlab(stage, breaks_trabecular | (endo_contour * 2), first, depth)
+        trabecular_components.resolve()
+
+        # select trabecular region and breaks connected to trabecular region, 
+        #  and label cortical breaks only
+        for first, last in slabs:
+            endo_contour, breaks_trabecular = self._splitStage(stage[first:last], 
+                                                               self.peri_contour[:, :, first:last])
+            breaks_trabecular = trabecular_components.relabel(sitk.ConnectedComponent(breaks_trabecular), first)
+            breaks_trabecular = sitk.BinaryThreshold(breaks_trabecular, 
+                                                     lowerThreshold=1, upperThreshold=self._boneNum)
+            stage = self._pasteSlab(stage, breaks_trabecular - endo_contour, first, depth)
+
+        return self._arrayToImage(stage, breaks_img)
+
+    def _splitStage(self, stage, reference_img):
+        """
+        Args:
+            stage (ndarray): slab with the endosteal mask in the second bit
+            reference_img (Image): slab of the periosteal mask
+
+        Returns:
+            tuple of Image: endosteal mask and the first bit of the slab
+        """
+        return (self._arrayToImage(stage >> 1, reference_img),
+                self._arrayToImage(stage & 1, reference_img))
+
+    def _dilateBreaksSlabs(self, breaks_img, radius):
+        """
+        Step 5 on slabs, see dilateBreaks.
+
+        Args:
+            breaks_img (Image)
+            radius (Int): dilate distance in voxels
+
+        Returns:
+            Image
+        """
+        depth = breaks_img.GetDepth()
+        slabs = self._slabRanges(depth)
+
+        components = SlabComponents(centroids=True)
+        stage = None
+        for first, last in slabs:
+            halo_first = max(first - radius, 0)
+            halo_last = min(last + radius, depth)
+            whole = self._useSlab(halo_first, halo_last, masks=True)
+            try:
+                slab_img = self._dilateBreaksMasked(breaks_img[:, :, halo_first:halo_last], radius)
+            finally:
+                self._restoreSlab(whole)
+            slab_img = slab_img[:, :, first-halo_first:last-halo_first]
+            components.add(sitk.ConnectedComponent(slab_img), first)
+            stage = self._pasteSlab(stage, slab_img, first, depth)
+        components.resolve()
+
+        # remove breaks less than 20*0.061^3 mm3 in size
+        breakNum = int(np.count_nonzero(components.sizes >= self._minimumBreakSize()))
+        # like dilateBreaks, which thresholds the labels with the default upper threshold
+        breakNum = min(breakNum, 255)
+        for first, last in slabs:
+            slab_img = self._arrayToImage(stage[first:last], breaks_img[:, :, first:last])
+            breaks_label = components.relabel(sitk.ConnectedComponent(slab_img), first)
+            if breakNum > 0:
+                slab_img = sitk.BinaryThreshold(breaks_label, lowerThreshold=1, upperThreshold=breakNum)
+            else:
+                slab_img = slab_img * 0
+            stage = self._pasteSlab(stage, slab_img, first, depth)
+
+        # the remaining breaks are ranked first, so maskToSeeds can reuse their statistics
+        breaks_img = self._arrayToImage(stage, breaks_img)
+        self._breaksComponents = (breaks_img, components, breakNum)
+        return breaks_img
+
+    def _connectVoidVolumeSlabs(self, erode_img, breaks_img, distance):
+        """
+        Step 9 on slabs, see connectVoidVolume.
+
+        Args:
+            erode_img (Image)
+            breaks_img (Image)
+            distance (int)
+
+        Returns:
+            Image
+        """
+        depth = erode_img.GetDepth()
+        slabs = self._slabRanges(depth)
+
+        components = SlabComponents()
+        stage = None
+        for first, last in slabs:
+            halo_first = max(first - distance, 0)
+            halo_last = min(last + distance, depth)
+            whole = self._useSlab(halo_first, halo_last)
+            try:
+                slab_img = self._erosionBackground(erode_img[:, :, halo_first:halo_last], 
+                                                   breaks_img[:, :, halo_first:halo_last], distance)
+            finally:
+                self._restoreSlab(whole)
+            slab_img = slab_img[:, :, first-halo_first:last-halo_first]
+            components.add(sitk.ConnectedComponent(slab_img), first)
+            stage = self._pasteSlab(stage, slab_img, first, depth)
+        components.resolve()
+
+        # select the largest object, which consists of erosion and background,
+        #  and extract voids from it
+        for first, last in slabs:
+            slab_img = self._arrayToImage(stage[first:last], erode_img[:, :, first:last])
+            relabeled_img = components.relabel(sitk.ConnectedComponent(slab_img), first)
+            erosion_background = sitk.BinaryThreshold(relabeled_img, lowerThreshold=1, upperThreshold=1)
+            stage = self._pasteSlab(stage, erosion_background * erode_img[:, :, first:last], first, depth)
+
+        return self._arrayToImage(stage, erode_img)
+
+    def _maskToSeedsSlabs(self, breaks_img):
+        """
+        Step 11 on slabs, see maskToSeeds.
+
+        Args:
+            breaks_img (Image)
+        """
+        if self._breaksComponents is not None and self._breaksComponents[0] is breaks_img:
+            components, breakNum = self._breaksComponents[1:]
+        else:
+            depth = breaks_img.GetDepth()
+            components = SlabComponents(centroids=True)
+            for first, last in self._slabRanges(depth):
+                components.add(sitk.ConnectedComponent(breaks_img[:, :, first:last]), first)
+            components.resolve()
+            breakNum = len(components.sizes)
+
+        seeds, breaks = breakTable(range(1, breakNum+1),
+                                   components.sizes[:breakNum],
+                                   indexToPhysical(components.centroids[:breakNum], breaks_img),
+                                   components.boundingBoxes[:breakNum],
+                                   breaks_img, self.model_img)
+        self.seeds.extend(seeds)
+        self.breaks.extend(breaks)
+
+    def _executeBones(self, step):
+        """
+        Executes steps 6 to 10 for each bone in the mask, in the bounding box 
+        of the bone, in up to boneWorkers worker processes. The results are 
+        merged at step 6, the later steps have nothing left to do.
+        Steps 2 to 5 run on all bones at once, since connectBreaks ranks the 
+        breaks of all bones together.
+
+        Args:
+            step(int): 6 <= step <= 10
+
+        Returns:
+            bool: True
+        """
+        if step == 6:
+            self._detectBones()
+        return True
+
+    def _detectBones(self):
+        """
+        Run steps 6 to 10 for each bone, and merge the erosions into the mask.
+        """
+        label_img = sitk.ConnectedComponent(self.peri_contour)
+        boxes = self._boneBoxes(label_img)
+        params = {'corticalThickness': self.corticalThickness,
+                  'slabDepth': self.slabDepth}
+        inputs = [[sitk.RegionOfInterest(img, size, index) 
+                   for img in (self.seg_img, self.peri_contour, self.breaks_img)]
+                  for label, index, size in boxes]
+        print("Running " + str(len(boxes)) + " bones separately")
+
+        if self.boneWorkers > 1:
+            # split the ITK threads between the worker processes
+            workers = min(self.boneWorkers, len(boxes))
+            threads = max((os.cpu_count() or 1) // workers, 1)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker,
+                                     initargs=(threads,)) as executor:
+                futures = [executor.submit(_detectBone, *bone_inputs, params) for bone_inputs in inputs]
+                results = [future.result() for future in futures]
+        else:
+            results = [_detectBone(*bone_inputs, params) for bone_inputs in inputs]
+        del inputs
+
+        # each box keeps the erosions of its own bone, the boxes of
+        #  neighbouring bones can overlap
+        labels = sitk.GetArrayViewFromImage(label_img)
+        erosions = np.zeros(labels.shape, dtype=np.uint8)
+        for (label, index, size), output_img in zip(boxes, results):
+            box = (slice(index[2], index[2]+size[2]), 
+                   slice(index[1], index[1]+size[1]), 
+                   slice(index[0], index[0]+size[0]))
+            erosions[box] |= (sitk.GetArrayViewFromImage(output_img) > 0) & (labels[box] == label)
+        self.output_img = self._arrayToImage(erosions, self.peri_contour)
+
+    def _boneBoxes(self, label_img):
+        """
+        Args:
+            label_img (Image): bones of the periosteal mask
+
+        Returns:
+            list of tuple: label, index and size of the bounding box of each bone,
+                           with a margin for steps 6 to 10
+        """
+        shape_filter = sitk.LabelShapeStatisticsImageFilter()
+        shape_filter.ComputePerimeterOff()
+        shape_filter.Execute(label_img)
+        # the distance maps of step 7 look 2 * (radius + 1) voxels away, 
+        #  and steps 8 to 10 radius voxels each, see _executeSlabs
+        margin = 5 * (math.ceil(self.corticalThickness) + 1)
+        size = label_img.GetSize()
+        boxes = []
+        for label in shape_filter.GetLabels():
+            box = shape_filter.GetBoundingBox(label)
+            lower = [max(box[i] - margin, 0) for i in range(3)]
+            upper = [min(box[i] + box[i+3] + margin, size[i]) for i in range(3)]
+            boxes.append((label, lower, [upper[i] - lower[i] for i in range(3)]))
+
+        return boxes
+
+    def _executeCoarse(self, step):
+        """
+        Executes steps 4 and 5 in boxes around the candidate cortical breaks, 
+        which are found on the output of step 3 downsampled by coarseFactor. 
+        Every cortical break of the whole volume run lies in a box, and the 
+        breaks are ranked as in connectBreaks on the whole volume, so the 
+        output is the same, unless the mask encloses background that is not
+        connected to the corner of the volume.
+
+        Args:
+            step(int): 3 <= step <= 5
+
+        Returns:
+            bool: True
+        """
+        radius = self.dilateErodeDistance
+        if step == 3:
+            self.breaks_img = self.erodeBreaks(self.seg_img, radius)
+            self._candidateBoxes = self._findCandidates(self.coarseFactor)
+        elif step == 4:
+            breaks_img = self._runBoxes(self._breaksBackgroundBox, self.breaks_img)
+            self.breaks_img = self._connectTrabecular(breaks_img)
+        elif step == 5:
+            breaks_img = self._runBoxes(lambda box: self._dilateBreaksMasked(box, radius), self.breaks_img)
+            self.breaks_img = self._filterBreaks(breaks_img)
+        return True
+
+    def _findCandidates(self, factor):
+        """
+        Downsample the gaps left in the cortical mask by step 3 and the 
+        background by factor, and get the boxes around the gaps that touch 
+        the background. 
+        A coarse voxel is in a region if any of its voxels is, so every gap 
+        connected to the background is inside a coarse candidate, in every bone 
+        of the mask. The boxes are padded for the touching voxels and for the 
+        dilation of step 5.
+
+        Args:
+            factor (int): downsampling factor
+
+        Returns:
+            list of tuple: (index, size) of each box, at full resolution
+        """
+        print("Searching candidate cortical breaks")
+        gaps_img = self._shrinkAny(self.cortical_mask - self.breaks_img, factor)
+
+        # coarse voxels next to the background touch it. The gaps that do not
+        #  reach the endosteal region are kept too, connectBreaks ranks them 
+        #  with the trabecular regions
+        touching_img = self._touching(gaps_img, sitk.BinaryDilate(self._shrinkAny(self.background_img, factor), 
+                                                                  [1, 1, 1], sitk.sitkCross))
+
+        # full resolution box around each candidate
+        shape_filter = sitk.LabelShapeStatisticsImageFilter()
+        shape_filter.ComputePerimeterOff()
+        shape_filter.Execute(sitk.ConnectedComponent(touching_img))
+        margin = self.dilateErodeDistance + 1
+        size = self.peri_contour.GetSize()
+        boxes = []
+        for label in shape_filter.GetLabels():
+            box = shape_filter.GetBoundingBox(label)
+            lower = [max(box[i]*factor - margin, 0) for i in range(3)]
+            upper = [min((box[i] + box[i+3])*factor + margin, size[i]) for i in range(3)]
+            boxes.append((lower, [upper[i] - lower[i] for i in range(3)]))
+        print(str(len(boxes)) + " candidate boxes")
+
+        return boxes
+
+    def _shrinkAny(self, img, factor):
+        """
+        Args:
+            img (Image): binary image
+            factor (int): downsampling factor
+
+        Returns:
+            Image: a voxel is labeled with 1 if any of its voxels in img is
+        """
+        # pad to a multiple of factor, BinShrink drops the incomplete blocks
+        size = img.GetSize()
+        img = sitk.ConstantPad(sitk.Cast(img, sitk.sitkFloat32), [0, 0, 0], 
+                               [-size[i] % factor for i in range(3)])
+        return sitk.BinaryThreshold(sitk.BinShrink(img, [factor] * 3), lowerThreshold=0, upperThreshold=0,
+                                    insideValue=0, outsideValue=1)
+
+    def _runBoxes(self, compute, img):
+        """
+        Run a step in each candidate box, the output is empty outside the boxes.
+        The outputs of overlapping boxes are combined, a box only labels
+        the parts of the breaks of the whole volume that it contains.
+
+        Args:
+            compute (function): runs the step on a box of img
+            img (Image): input of the step
+
+        Returns:
+            Image
+        """
+        output = np.zeros(sitk.GetArrayViewFromImage(img).shape, dtype=np.uint8)
+        for index, size in self._candidateBoxes:
+            whole = self._useBox(index, size)
+            try:
+                box_img = compute(sitk.RegionOfInterest(img, size, index))
+            finally:
+                self._restoreBox(whole)
+            output[index[2]:index[2]+size[2], 
+                   index[1]:index[1]+size[1], 
+                   index[0]:index[0]+size[0]] |= sitk.GetArrayViewFromImage(box_img)
+
+        return self._arrayToImage(output, img)
+
+    def _useBox(self, index, size):
+        """
+        Replace the periosteal mask, the bone segmentation and the masks from 
+        step 2 with a box of them, so that the steps can run in the box.
+
+        Args:
+            index (list of int)
+            size (list of int)
+
+        Returns:
+            tuple of Image: the whole images, to be restored with _restoreBox
+        """
+        whole = (self.peri_contour, self.seg_img, 
+                 self.endo_contour, self.cortical_mask, self.background_img)
+        (self.peri_contour, self.seg_img, 
+         self.endo_contour, self.cortical_mask, self.background_img) = \
+            [sitk.RegionOfInterest(img, size, index) for img in whole]
+
+        return whole
+
+    def _restoreBox(self, whole):
+        """
+        Args:
+            whole (tuple of Image): from _useBox
+        """
+        (self.peri_contour, self.seg_img, 
+         self.endo_contour, self.cortical_mask, self.background_img) = whole
+
+    def _breaksBackgroundBox(self, breaks_img):
+        """
+        The first half of step 4 in a candidate box, see connectBreaks. The corner 
+        of a box is not necessarily background, so the breaks connected to the 
+        background outside the periosteal mask in the box are selected.
+
+        Args:
+            breaks_img (Image)
+
+        Returns:
+            Image: cortical breaks connected to the background
+        """
+        breaks_background = self._breaksBackground(breaks_img)
+        breaks_background = self._touching(breaks_background, self.background_img)
+
+        return breaks_background * self.cortical_mask
+
+    def _touching(self, img, mask_img):
+        """
+        Args:
+            img (Image)
+            mask_img (Image)
+
+        Returns:
+            Image: connected components of img that overlap mask_img are labeled with 1.
+        """
+        labels = sitk.GetArrayFromImage(sitk.ConnectedComponent(img))
+        touching = np.unique(labels[sitk.GetArrayViewFromImage(mask_img) > 0])
+        touching = touching[touching > 0]
+        return self._arrayToImage(np.isin(labels, touching).astype(np.uint8), img)
+
     def _boundingBoxCut(self, img):
         """
-        Crop the image so that it occupies the same physcial space as the mask.
+        Crop the image so that it occupies the same physical space as the mask.
+        The crop is a single region of interest when the mask lies inside the image,
+        otherwise the image is pasted into a zero image on the grid of the mask.
 
         Args:
             img (Image)
@@ -491,18 +1238,14 @@ class PetersCorticalBreakDetectionLogic:
             Image
         """
         # image info
-        width = self.peri_contour.GetWidth()
-        height = self.peri_contour.GetHeight()
-        depth = self.peri_contour.GetDepth()
+        size = self.peri_contour.GetSize()
         spacing = img.GetSpacing()[0]
         contour_origin = self.peri_contour.GetOrigin()
         model_origin = img.GetOrigin()
         model_size = img.GetSize()
         direction = img.GetDirection()
 
-        # crop image
-        cropped_img = sitk.Image(width, height, depth, img.GetPixelID())
-        cropped_img.CopyInformation(self.peri_contour)
+        # index of the image origin in the mask
         destination_x = round((model_origin[0] - contour_origin[0]) / spacing)
         destination_y = round((model_origin[1] - contour_origin[1]) / spacing)
         destination_z = round((model_origin[2] - contour_origin[2]) / spacing)
@@ -510,17 +1253,25 @@ class PetersCorticalBreakDetectionLogic:
         r.SetMatrix(direction)
         destination_index = r.TransformPoint((destination_x, destination_y, destination_z))
         destination_index = (round(destination_index[0]), round(destination_index[1]), round(destination_index[2]))
-        paste_filter = sitk.PasteImageFilter()
-        paste_filter.SetDestinationIndex(destination_index)
-        paste_filter.SetSourceSize(model_size)
-        cropped_img = paste_filter.Execute(cropped_img, img)
+
+        # crop image
+        if all(destination_index[i] <= 0 and size[i] - destination_index[i] <= model_size[i] for i in range(3)):
+            cropped_img = sitk.RegionOfInterest(img, size, [-i for i in destination_index])
+        else:
+            cropped_img = sitk.Image(size, img.GetPixelID())
+            cropped_img.CopyInformation(self.peri_contour)
+            paste_filter = sitk.PasteImageFilter()
+            paste_filter.SetDestinationIndex(destination_index)
+            paste_filter.SetSourceSize(model_size)
+            cropped_img = paste_filter.Execute(cropped_img, img)
+        cropped_img.CopyInformation(self.peri_contour)
 
         return cropped_img
 
     def _initializeParams(self):
         """
         Crop the preprocessed bone segmentation and the greyscale scan so that 
-        they occupy the same physcial space as the mask.
+        they occupy the same physical space as the mask.
         """
         # crop preprocessed bone segmentation to the same size as the mask
         self.seg_img = self._boundingBoxCut(self.seg_img)
@@ -621,6 +1372,42 @@ class PetersCorticalBreakDetectionLogic:
         """
         self.dilateErodeDistance = dilateErodeDistance
     
+    def setCacheLimit(self, memoryLimit):
+        """
+        Args:
+            memoryLimit (int): Memory limit of the shared preprocessing cache in bytes, 
+                               0 disables the cache.
+        """
+        self.preprocessing.setMemoryLimit(memoryLimit)
+
+    def setSlabDepth(self, slabDepth):
+        """
+        Args:
+            slabDepth (int): Number of slices in each z-slab for scans that do not 
+                             fit in memory, 0 runs the steps on the whole volume.
+        """
+        self.slabDepth = slabDepth
+
+    def setCoarseFactor(self, coarseFactor):
+        """
+        Args:
+            coarseFactor (int): Downsampling factor of a first pass that searches 
+                                candidate cortical breaks, e.g. 2 or 4. Steps 4 and 5 
+                                then run at full resolution around the candidates only.
+                                0 runs them on the whole volume. Ignored on slabs.
+        """
+        self.coarseFactor = coarseFactor
+
+    def setBoneWorkers(self, boneWorkers):
+        """
+        Args:
+            boneWorkers (int): Number of worker processes that run steps 6 to 10 
+                               for each bone of the mask in its own bounding box.
+                               1 runs the bones one after another in this process,
+                               0 runs the steps on all bones at once.
+        """
+        self.boneWorkers = boneWorkers
+
     def setMethod(self, method:int) -> None:
         self.auto_thresh = True
         self.method = method
@@ -634,3 +1421,11 @@ class PetersCorticalBreakDetectionLogic:
 
     def getSeeds(self):
         return self.seeds
+
+    def getBreaks(self):
+        """
+        Returns:
+            list of dict: label, seed, size, centroid and bounding box of each
+                          cortical break, from maskToSeeds
+        """
+        return self.breaks
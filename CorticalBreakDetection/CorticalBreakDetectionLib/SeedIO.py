@@ -0,0 +1,176 @@
+#-----------------------------------------------------
+# SeedIO.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module reads and writes seed points in the formats used by
+#              the command line scripts and by Slicer: Slicer markups JSON
+#              (e.g. TestFiles/SAMPLE_SEEDS1.json), Slicer FCSV, and compact CSV
+#              with one 'id,x,y,z' line of voxel indices per seed point.
+#              Seed points are written one at a time as they are converted, so
+#              the file is never built in memory. JSON and FCSV store physical
+#              points, which need the image of the seed indices.
+#              The format is chosen by the file extension.
+#
+#-----------------------------------------------------
+# Usage:       writeSeeds(seeds_file, seeds, img)
+#              seeds = readSeeds(seeds_file, img)
+#
+#-----------------------------------------------------
+import os, json
+
+MARKUPS_SCHEMA = ('https://raw.githubusercontent.com/slicer/slicer/master/Modules/Loadable/'
+                  'Markups/Resources/Schema/markups-schema-v1.0.0.json#')
+FCSV_COLUMNS = 'id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID'
+
+def seedsFormat(seeds_file):
+    """
+    Args:
+        seeds_file (str)
+
+    Returns:
+        str: 'json', 'fcsv' or 'csv'
+    """
+    extension = os.path.splitext(seeds_file)[1].lower()
+    if extension in ('.json', '.fcsv'):
+        return extension[1:]
+    return 'csv'
+
+def writeSeeds(seeds_file, seeds, img=None, name=None):
+    """
+    Write seed points, in the format given by the file extension.
+
+    Args:
+        seeds_file (str)
+        seeds (iterable of tuple of int): (x,y,z) indices of img
+        img (Image): required for JSON and FCSV
+        name (str): prefix of the seed point labels, default is the file name
+    """
+    file_format = seedsFormat(seeds_file)
+    if file_format != 'csv' and img is None:
+        raise ValueError('An image is required to write seed points to ' + seeds_file)
+    if name is None:
+        name = os.path.splitext(os.path.basename(seeds_file))[0]
+
+    with open(seeds_file, 'w', newline='') as f:
+        if file_format == 'json':
+            _writeMarkups(f, seeds, img, name)
+        elif file_format == 'fcsv':
+            _writeFcsv(f, seeds, img, name)
+        else:
+            for i, seed in enumerate(seeds):
+                f.write('{},{},{},{}\n'.format(i, *(int(v) for v in seed)))
+
+def readSeeds(seeds_file, img=None):
+    """
+    Read seed points, in the format given by the file extension.
+    In compact CSV files, lines starting with '#' and header lines are skipped.
+
+    Args:
+        seeds_file (str)
+        img (Image): required for JSON and FCSV
+
+    Returns:
+        list of tuple of int: (x,y,z) indices of img
+    """
+    file_format = seedsFormat(seeds_file)
+    if file_format != 'csv' and img is None:
+        raise ValueError('An image is required to read seed points from ' + seeds_file)
+
+    if file_format == 'json':
+        return [_toIndex(point, lps, img) for point, lps in _readMarkups(seeds_file)]
+    if file_format == 'fcsv':
+        return [_toIndex(point, lps, img) for point, lps in _readFcsv(seeds_file)]
+
+    seeds = []
+    with open(seeds_file) as f:
+        for line in f:
+            # line = 'id,x,y,z'
+            if line.startswith('#') or not line.strip():
+                continue
+            seed = line.split(',')
+            try:
+                seeds.append((int(float(seed[1])), int(float(seed[2])), int(float(seed[3]))))
+            except (ValueError, IndexError):
+                # header, e.g. 'Label,X,Y,Z'
+                continue
+    return seeds
+
+def _writeMarkups(f, seeds, img, name):
+    """
+    Stream seed points to a Slicer markups JSON file, in LPS coordinates.
+    """
+    f.write('{\n')
+    f.write('    "@schema": "' + MARKUPS_SCHEMA + '",\n')
+    f.write('    "markups": [\n        {\n')
+    f.write('            "type": "Fiducial",\n')
+    f.write('            "coordinateSystem": "LPS",\n')
+    f.write('            "locked": false,\n')
+    f.write('            "labelFormat": "%N-%d",\n')
+    f.write('            "controlPoints": [')
+    for i, seed in enumerate(seeds):
+        point = {'id': str(i + 1),
+                 'label': '{}-{}'.format(name, i + 1),
+                 'description': '',
+                 'associatedNodeID': '',
+                 'position': list(img.TransformIndexToPhysicalPoint([int(v) for v in seed])),
+                 'orientation': [-1.0, -0.0, -0.0, -0.0, -1.0, -0.0, 0.0, 0.0, 1.0],
+                 'selected': True,
+                 'locked': False,
+                 'visibility': True,
+                 'positionStatus': 'defined'}
+        f.write((',' if i > 0 else '') + '\n                ' + json.dumps(point))
+    f.write('\n            ],\n')
+    f.write('            "measurements": []\n')
+    f.write('        }\n    ]\n}\n')
+
+def _writeFcsv(f, seeds, img, name):
+    """
+    Stream seed points to a Slicer FCSV file, in LPS coordinates.
+    """
+    f.write('# Markups fiducial file version = 4.11\n')
+    f.write('# CoordinateSystem = LPS\n')
+    f.write('# columns = ' + FCSV_COLUMNS + '\n')
+    for i, seed in enumerate(seeds):
+        x, y, z = img.TransformIndexToPhysicalPoint([int(v) for v in seed])
+        f.write('{},{},{},{},0,0,0,1,1,1,0,{}-{},,\n'.format(i + 1, x, y, z, name, i + 1))
+
+def _readMarkups(seeds_file):
+    """
+    Yields:
+        tuple: physical point, True if the point is in LPS coordinates
+    """
+    with open(seeds_file) as f:
+        markups = json.load(f)
+    for markup in markups.get('markups', []):
+        lps = markup.get('coordinateSystem', 'LPS') == 'LPS'
+        for point in markup.get('controlPoints', []):
+            if 'position' in point:
+                yield point['position'], lps
+
+def _readFcsv(seeds_file):
+    """
+    Yields:
+        tuple: physical point, True if the point is in LPS coordinates
+    """
+    lps = False            # Slicer writes RAS unless the header says otherwise
+    with open(seeds_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                if line.startswith('# CoordinateSystem'):
+                    system = line.split('=')[1].strip()
+                    lps = system in ('LPS', '1')
+                continue
+            if not line.strip():
+                continue
+            point = line.split(',')
+            yield [float(point[1]), float(point[2]), float(point[3])], lps
+
+def _toIndex(point, lps, img):
+    """
+    Returns:
+        tuple of int: (x,y,z) index of img nearest to the physical point
+    """
+    if not lps:
+        point = [-point[0], -point[1], point[2]]
+    return tuple(img.TransformPhysicalPointToIndex([float(v) for v in point]))
@@ -0,0 +1,193 @@
+#-----------------------------------------------------
+# SlabComponents.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module finds the connected components of a binary volume
+#              that is processed in z-slabs. Each slab is labeled on its own,
+#              and labels that touch across the slab boundaries are merged
+#              with a union-find. The merged components are ordered like the
+#              output of sitk.RelabelComponent, i.e. by size from large to small,
+#              and components of the same size in raster order.
+#
+#-----------------------------------------------------
+# Usage:       components = SlabComponents()
+#              for slab_img, z in slabs:
+#                  components.add(sitk.ConnectedComponent(slab_img), z)
+#              components.resolve()
+#              for slab_img, z in slabs:
+#                  label_img = components.relabel(sitk.ConnectedComponent(slab_img), z)
+#
+#-----------------------------------------------------
+import SimpleITK as sitk
+import numpy as np
+
+class SlabComponents:
+    def __init__(self, centroids=False):
+        self._centroids = centroids                   # compute the centroid of each component
+        self._parent = np.zeros(1, dtype=np.int64)    # union-find parent of each global label, 0 is the background
+        self._sizes = [np.zeros(1, dtype=np.int64)]   # number of voxels of each global label
+        self._sums = [np.zeros((1, 3))]               # sum of the (x,y,z) indices of each global label
+        self._lows = [np.zeros((1, 3), dtype=np.int64)]  # lowest (x,y,z) index of each global label
+        self._highs = [np.zeros((1, 3), dtype=np.int64)] # highest (x,y,z) index of each global label
+        self._offsets = {}                            # global label offset of each slab, by first slice
+        self._lastPlane = None                        # global labels of the last slice of the previous slab
+        self._count = 0                               # number of global labels
+        self._rank = None                             # rank of the component of each global label, 0 for the background
+        self.sizes = None                             # number of voxels of each component, by rank
+        self.centroids = None                         # mean (x,y,z) index of each component, by rank,
+                                                      #  if centroids is True
+        self.boundingBoxes = None                     # (x,y,z) index and size of the bounding box of
+                                                      #  each component, by rank, if centroids is True
+
+    def add(self, label_img, z):
+        """
+        Add the connected components of the next slab. Slabs must be added
+        in z order and must not overlap.
+
+        Args:
+            label_img (Image): labels of the slab from sitk.ConnectedComponent
+            z (int): index of the first slice of the slab
+        """
+        labels = sitk.GetArrayViewFromImage(label_img)
+        num = int(labels.max())
+        offset = self._count
+        self._offsets[z] = offset
+        self._parent = np.concatenate([self._parent, np.arange(offset+1, offset+num+1)])
+        self._count += num
+
+        # voxel count and index sums of each label
+        flat = labels.ravel().astype(np.int64)
+        self._sizes.append(np.bincount(flat, minlength=num+1)[1:])
+        if self._centroids:
+            zz, yy, xx = np.nonzero(labels)
+            foreground = labels[zz, yy, xx].astype(np.int64)
+            self._sums.append(np.stack([np.bincount(foreground, weights=xx, minlength=num+1)[1:],
+                                        np.bincount(foreground, weights=yy, minlength=num+1)[1:],
+                                        np.bincount(foreground, weights=zz + z, minlength=num+1)[1:]], 
+                                       axis=1))
+            lows, highs = self._bounds(foreground, (xx, yy, zz + z), num)
+            self._lows.append(lows)
+            self._highs.append(highs)
+        else:
+            self._sums.append(np.zeros((num, 3)))
+            self._lows.append(np.zeros((num, 3), dtype=np.int64))
+            self._highs.append(np.zeros((num, 3), dtype=np.int64))
+
+        # merge labels that touch across the boundary with the previous slab
+        global_labels = self._globalLabels(labels, offset)
+        if self._lastPlane is not None:
+            first_plane = global_labels[0]
+            touching = (self._lastPlane > 0) & (first_plane > 0)
+            pairs = np.unique(np.stack([self._lastPlane[touching], first_plane[touching]], axis=1), axis=0)
+            for a, b in pairs:
+                self._union(a, b)
+        self._lastPlane = global_labels[-1]
+
+    def resolve(self):
+        """
+        Merge the labels of all slabs into components and order them by size.
+        """
+        # point every label to its root
+        roots = self._parent
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+
+        sizes = np.concatenate(self._sizes)
+        sums = np.concatenate(self._sums)
+        component_roots = np.unique(roots[1:])
+        component_sizes = np.bincount(roots, weights=sizes)[component_roots]
+        component_sums = np.stack([np.bincount(roots, weights=sums[:,i])[component_roots]
+                                   for i in range(3)], axis=1)
+
+        # bounding box of each component from the boxes of its labels
+        position = np.searchsorted(component_roots, roots[1:])
+        component_lows = np.full((len(component_roots), 3), np.iinfo(np.int64).max)
+        component_highs = np.full((len(component_roots), 3), -1, dtype=np.int64)
+        np.minimum.at(component_lows, position, np.concatenate(self._lows)[1:])
+        np.maximum.at(component_highs, position, np.concatenate(self._highs)[1:])
+
+        # the root of a component is its first label in raster order,
+        #  so sort by size and then by root
+        order = np.lexsort((component_roots, -component_sizes))
+        rank_of_root = np.zeros(self._count+1, dtype=np.int64)
+        rank_of_root[component_roots[order]] = np.arange(1, len(order)+1)
+        self._rank = rank_of_root[roots]
+        self._rank[0] = 0
+        self.sizes = component_sizes[order].astype(np.int64)
+        self.centroids = (component_sums[order] /
+                          np.maximum(component_sizes[order], 1)[:, np.newaxis])
+        self.boundingBoxes = np.concatenate([component_lows[order],
+                                             component_highs[order] - component_lows[order] + 1],
+                                            axis=1)
+
+    def relabel(self, label_img, z):
+        """
+        Relabel a slab with the rank of each component, after resolve.
+        The slab must be labeled the same way as when it was added.
+
+        Args:
+            label_img (Image): labels of the slab from sitk.ConnectedComponent
+            z (int): index of the first slice of the slab
+
+        Returns:
+            Image: UInt32, components labeled from large to small
+        """
+        labels = sitk.GetArrayViewFromImage(label_img)
+        ranks = self._rank[self._globalLabels(labels, self._offsets[z])]
+        rank_img = sitk.GetImageFromArray(ranks.astype(np.uint32))
+        rank_img.CopyInformation(label_img)
+
+        return rank_img
+
+    def _bounds(self, foreground, coordinates, num):
+        """
+        Lowest and highest coordinates of each label.
+
+        Args:
+            foreground (ndarray): label of each foreground voxel
+            coordinates (tuple): (x,y,z) indices of each foreground voxel
+            num (int): number of labels
+
+        Returns:
+            tuple: (num, 3) arrays of the lowest and highest indices
+        """
+        lows = np.zeros((num, 3), dtype=np.int64)
+        highs = np.zeros((num, 3), dtype=np.int64)
+        if num == 0:
+            return lows, highs
+
+        # group the voxels by label, every label from ConnectedComponent has voxels
+        order = np.argsort(foreground, kind='stable')
+        starts = np.flatnonzero(np.diff(foreground[order], prepend=0))
+        for i, coordinate in enumerate(coordinates):
+            coordinate = coordinate[order]
+            lows[:, i] = np.minimum.reduceat(coordinate, starts)
+            highs[:, i] = np.maximum.reduceat(coordinate, starts)
+
+        return lows, highs
+
+    def _globalLabels(self, labels, offset):
+        global_labels = labels.astype(np.int64)
+        global_labels[global_labels > 0] += offset
+        return global_labels
+
+    def _find(self, a):
+        root = a
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[a] != root:
+            self._parent[a], a = root, self._parent[a]
+        return root
+
+    def _union(self, a, b):
+        # keep the smaller label as the root, which comes first in raster order
+        a = self._find(a)
+        b = self._find(b)
+        if a < b:
+            self._parent[b] = a
+        elif b < a:
+            self._parent[a] = b
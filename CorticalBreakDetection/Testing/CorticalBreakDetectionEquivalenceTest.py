@@ -0,0 +1,266 @@
+#-----------------------------------------------------
+# CorticalBreakDetectionEquivalenceTest.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module checks that the optimised code paths of the
+#              CorticalBreakDetection module give the same output as the plain
+#              ones. It runs on synthetic scans without 3D Slicer.
+#
+#-----------------------------------------------------
+# Usage:       python -m unittest CorticalBreakDetectionEquivalenceTest
+#
+#-----------------------------------------------------
+import SimpleITK as sitk
+import numpy as np
+import contextlib, io, os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'CorticalBreakDetectionLib'))
+from Preprocessing import Preprocessing, gaussian, gaussianRegion
+from PetersCorticalBreakDetectionLogic import PetersCorticalBreakDetectionLogic
+from BoundedDistance import boundedDeflate
+from MultiScale import toCommonGrid, toNativeGrid, seedsToNative
+
+def makePhantom(depth=50, width=120, twoBones=False, seed=0):
+    """
+    Noisy cortical shells with trabeculae, radial cortical breaks and erosions.
+
+    Args:
+        depth (int): number of slices
+        width (int): number of rows and columns
+        twoBones (bool): two bones side by side instead of one
+        seed (int): random seed of the noise and of the breaks
+
+    Returns:
+        tuple: scan, periosteal mask
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.mgrid[0:depth, 0:width, 0:width]
+    arr = rng.normal(0, 60, (depth, width, width)).astype(np.float32)
+    mask = np.zeros((depth, width, width), dtype=np.uint8)
+    if twoBones:
+        radius = width // 4 - 4
+        centres = [(width // 2, width // 4 + 1), (width // 2, 3 * width // 4 - 1)]
+    else:
+        radius = width // 2 - 12
+        centres = [(width // 2, width // 2)]
+    trabeculae = np.sin(x*0.9) + np.sin(y*0.9) + np.sin(z*0.9) > 0.8
+
+    for cy, cx in centres:
+        r = np.sqrt((y - cy)**2 + (x - cx)**2)
+        arr[(r < radius) & (r >= radius - 6)] += 1200
+        arr[(r < radius - 6) & trabeculae] += 900
+        mask[r <= radius + 1] = 1
+
+        # radial tubes through the cortex, and an erosion under some of them
+        for i in range(4):
+            angle = rng.uniform(0, 2*np.pi)
+            cz = rng.integers(4, depth - 4)
+            ux, uy = np.cos(angle), np.sin(angle)
+            along = (x - cx)*ux + (y - cy)*uy
+            across = ((x - cx)*uy - (y - cy)*ux)**2 + (z - cz)**2
+            tube = (along > radius - 9) & (along < radius + 3) & (across <= rng.uniform(2, 16))
+            if i % 2 == 0:
+                ex, ey = cx + (radius - 8)*ux, cy + (radius - 8)*uy
+                tube |= (x - ex)**2 + (y - ey)**2 + (z - cz)**2 < 20
+            arr[tube] = rng.normal(0, 60, tube.sum())
+
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.0607] * 3)
+    img.SetOrigin([3.0, -2.0, 10.0])
+    mask_img = sitk.GetImageFromArray(mask)
+    mask_img.CopyInformation(img)
+    return img, mask_img
+
+def makeBlob(seed=0):
+    """
+    Smooth random binary object, with curved boundaries of all orientations.
+
+    Returns:
+        Image: UInt8 mask
+    """
+    noise = np.random.default_rng(seed).normal(size=(50, 50, 50)).astype(np.float32)
+    blob_img = sitk.SmoothingRecursiveGaussian(sitk.GetImageFromArray(noise), 4)
+    return sitk.BinaryThreshold(blob_img, lowerThreshold=0, insideValue=1)
+
+def runPeters(img, mask_img, corticalThickness=4, dilateErodeDistance=1, slabDepth=0, coarseFactor=0,
+              boneWorkers=0):
+    """
+    Run all steps of the cortical break detection.
+
+    Returns:
+        PetersCorticalBreakDetectionLogic
+    """
+    logic = PetersCorticalBreakDetectionLogic(img, mask_img, 82, 686, 15000, 0.8, 
+                                              corticalThickness, dilateErodeDistance)
+    logic.setSlabDepth(slabDepth)
+    logic.setCoarseFactor(coarseFactor)
+    logic.setBoneWorkers(boneWorkers)
+    with contextlib.redirect_stdout(io.StringIO()):
+        step = 1
+        while logic.execute(step):
+            step += 1
+    return logic
+
+class CorticalBreakDetectionEquivalenceTest(unittest.TestCase):
+
+    def test_GaussianRegion(self):
+        '''
+        Smoothing and binarizing a region with its margin matches the region
+        of the smoothed and binarized scan, with and without the cache.
+        '''
+        img, mask_img = makePhantom()
+        region = ((10, 20, 5), (70, 50, 8))
+        for memoryLimit in (0, 1024**3):
+            preprocessing = Preprocessing(memoryLimit)
+            for sigma in (0.8, 1, 2):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    whole = sitk.GetArrayFromImage(gaussian(img, sigma))[5:13, 20:70, 10:80]
+                    np.testing.assert_allclose(sitk.GetArrayFromImage(gaussianRegion(img, sigma, region)),
+                                               whole, rtol=0, atol=1e-4)
+                    thresh = sitk.GetArrayFromImage(preprocessing.threshold(img, sigma, 686, 15000, region))
+                np.testing.assert_array_equal(thresh, (whole >= 686) & (whole <= 15000))
+
+    def test_Deflate(self):
+        '''
+        The Peters endosteal mask is the periosteal mask deflated with the Danielsson
+        distance map on the bounding box of the mask, the same as on the whole image,
+        also for a mask away from the image borders. The bounded deflate of the CBCT
+        method is the same as the Maurer distance map.
+        '''
+        for seed in range(2):
+            blob = sitk.GetArrayFromImage(makeBlob(seed))
+            blob[:3] = blob[-3:] = blob[:, :3] = blob[:, -3:] = blob[:, :, :3] = blob[:, :, -3:] = 0
+            inset = np.zeros((70, 90, 80), dtype=np.uint8)
+            inset[5:55, 30:80, 12:62] = blob
+            for mask_img in (makeBlob(seed), sitk.GetImageFromArray(inset)):
+                maurer_img = sitk.SignedMaurerDistanceMap(mask_img, insideIsPositive=True, 
+                                                          squaredDistance=False, useImageSpacing=False)
+                danielsson_img = sitk.SignedDanielssonDistanceMap(mask_img, insideIsPositive=True)
+                for radius in (4, 5):
+                    logic = PetersCorticalBreakDetectionLogic(corticaThickness=radius)
+                    logic.peri_contour = mask_img
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        logic.createMasks()
+                    endo = sitk.GetArrayFromImage(logic.endo_contour).astype(bool)
+                    self.assertGreater(np.count_nonzero(endo), 0)
+                    np.testing.assert_array_equal(endo, sitk.GetArrayFromImage(danielsson_img) >= radius)
+                    np.testing.assert_array_equal(sitk.GetArrayFromImage(boundedDeflate(mask_img, radius, 1)) > 0,
+                                                  sitk.GetArrayFromImage(maurer_img) >= radius)
+
+    def assertSameBreaks(self, logic, reference):
+        '''
+        Check that two runs have the same segmentation, breaks, erosions and seeds.
+        '''
+        for name in ('seg_img', 'breaks_img', 'output_img'):
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(getattr(logic, name)),
+                                          sitk.GetArrayFromImage(getattr(reference, name)), name)
+            self.assertEqual(getattr(logic, name).GetOrigin(), getattr(reference, name).GetOrigin())
+        self.assertEqual(logic.seeds, reference.seeds)
+        self.assertEqual([(b['seed'], b['size'], b['boundingBox']) for b in logic.breaks],
+                         [(b['seed'], b['size'], b['boundingBox']) for b in reference.breaks])
+
+    def test_CommonGrid(self):
+        '''
+        A common grid with the voxel size of the scan leaves the scan, the contour,
+        the outputs and the seeds unchanged.
+        '''
+        img, mask_img = makePhantom(depth=30, width=100)
+        reference = runPeters(img, mask_img)
+        self.assertGreater(len(reference.seeds), 0)
+        for contour_img in (mask_img, mask_img[4:96, 10:90, 3:27]):
+            with contextlib.redirect_stdout(io.StringIO()):
+                common_img, common_contour = toCommonGrid(img, contour_img, img.GetSpacing()[0])
+            for common, native in ((common_img, img), (common_contour, contour_img)):
+                np.testing.assert_array_equal(sitk.GetArrayFromImage(common), sitk.GetArrayFromImage(native))
+                np.testing.assert_allclose(common.GetOrigin(), native.GetOrigin(), rtol=0, atol=1e-9)
+
+        logic = runPeters(common_img, sitk.Resample(mask_img, common_img, sitk.Transform(), 
+                                                    sitk.sitkNearestNeighbor))
+        self.assertSameBreaks(logic, reference)
+        for name in ('breaks_img', 'output_img'):
+            native_img = toNativeGrid(getattr(logic, name), mask_img)
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(native_img), 
+                                          sitk.GetArrayFromImage(getattr(reference, name)))
+            np.testing.assert_allclose(native_img.GetOrigin(), getattr(reference, name).GetOrigin(), 
+                                       rtol=0, atol=1e-9)
+        self.assertEqual(seedsToNative(logic.seeds, common_img, img), 
+                         [tuple(seed) for seed in reference.seeds])
+
+    def test_NativeGrid(self):
+        '''
+        A contour resampled to a finer common grid and back to the native grid is
+        unchanged, and each seed on the common grid maps to the native voxel of
+        the same label.
+        '''
+        labels = np.random.default_rng(0).integers(0, 4, (10, 14, 12)).astype(np.uint8)
+        img = sitk.GetImageFromArray(labels)
+        img.SetSpacing([0.18] * 3)
+        img.SetOrigin([3.0, -2.0, 10.0])
+        contour_img = img[2:11, 3:12, 1:9]
+        with contextlib.redirect_stdout(io.StringIO()):
+            common_img, common_contour = toCommonGrid(img, contour_img, 0.06)
+        self.assertEqual(common_img.GetSize(), (36, 42, 30))
+        self.assertEqual(common_contour.GetSize(), (27, 27, 24))
+        native_img = toNativeGrid(common_contour, contour_img)
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(native_img), sitk.GetArrayFromImage(contour_img))
+        np.testing.assert_allclose(native_img.GetOrigin(), contour_img.GetOrigin(), rtol=0, atol=1e-9)
+
+        # seeds of the contour, as indices of the common scan
+        common = sitk.GetArrayFromImage(common_contour)
+        offset = common_img.TransformPhysicalPointToIndex(common_contour.GetOrigin())
+        seeds = [tuple(int(v) + offset[i] for i, v in enumerate(index[::-1])) 
+                 for index in np.argwhere(common > 0)]
+        native_seeds = seedsToNative(seeds, common_img, img)
+        self.assertEqual([labels[z, y, x] for x, y, z in native_seeds], 
+                         [common[z, y, x] for x, y, z in np.argwhere(common > 0)[:, ::-1]])
+
+    def test_Slabs(self):
+        '''
+        Slab-wise streaming gives the same output as the whole volume run.
+        '''
+        for twoBones, seed in ((False, 0), (True, 2)):
+            img, mask_img = makePhantom(twoBones=twoBones, seed=seed)
+            for corticalThickness, dilateErodeDistance in ((4, 1), (4, 2)):
+                reference = runPeters(img, mask_img, corticalThickness, dilateErodeDistance)
+                self.assertGreater(len(reference.seeds), 0)
+                for slabDepth in (7, 16):
+                    logic = runPeters(img, mask_img, corticalThickness, dilateErodeDistance, slabDepth)
+                    self.assertSameBreaks(logic, reference)
+
+    def test_Coarse(self):
+        '''
+        The candidate search on the downsampled scan finds every break of the
+        whole volume run, in every bone, and the full resolution steps in the
+        candidate boxes give the same output.
+        '''
+        for twoBones, seed in ((False, 0), (True, 1), (True, 2)):
+            img, mask_img = makePhantom(width=102 if twoBones else 120, twoBones=twoBones, seed=seed)
+            for corticalThickness, dilateErodeDistance in ((4, 1), (4, 2)):
+                reference = runPeters(img, mask_img, corticalThickness, dilateErodeDistance)
+                self.assertGreater(len(reference.seeds), 0)
+                for coarseFactor in (2, 4):
+                    logic = runPeters(img, mask_img, corticalThickness, dilateErodeDistance, 
+                                      coarseFactor=coarseFactor)
+                    self.assertSameBreaks(logic, reference)
+                    # the boxes leave most of the volume out
+                    boxes = sum(np.prod(size) for index, size in logic._candidateBoxes)
+                    self.assertLess(boxes, 0.3 * np.prod(mask_img.GetSize()))
+
+    def test_Bones(self):
+        '''
+        Running the erosion steps for each bone, in this process or in worker 
+        processes, gives the same output as running them on all bones at once.
+        '''
+        for seed in (1, 2):
+            img, mask_img = makePhantom(width=102, twoBones=True, seed=seed)
+            for corticalThickness, dilateErodeDistance in ((4, 1), (5, 3)):
+                reference = runPeters(img, mask_img, corticalThickness, dilateErodeDistance)
+                self.assertGreater(len(reference.seeds), 0)
+                for boneWorkers, slabDepth in ((1, 0), (2, 0), (1, 16)):
+                    logic = runPeters(img, mask_img, corticalThickness, dilateErodeDistance, 
+                                      slabDepth, boneWorkers=boneWorkers)
+                    self.assertSameBreaks(logic, reference)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,9 +10,20 @@
 # Usage:       This module is designed to be run on command Line or terminal
 #              python VoidVolume.py inputImages inputContours inputSeeds outputFolder
 #                                   [--lowerThreshold] [--upperThreshold] [--sigma]
-#                                   [--minimumRadius] [--dilateErodeDistance]
+#                                   [--minimumRadius] [--dilateErodeDistance] [--localLevelSet]
+#                                   [--levelSetWorkers] [--intermediateFolder] [--lowMemory]
+#                                   [--workers] [--threads] [--log] [--restart]
 #              Images, contours, and seeds, must be in separate folders
-#              Contour and seed filenames must contain the full name of their corresponding image
+#              Contour and seed filenames must start with the name of their corresponding image,
+#              followed by '_', e.g. SAMPLE1_MASK.mha and SAMPLE1_MASK_SEEDS.json for SAMPLE1.mha
+#              Each contour uses the seed file named after the contour if there is one,
+#              otherwise the seed file named after the image if the image has only one contour
+#              Seed files can be Slicer markups JSON (.json), Slicer FCSV (.fcsv),
+#              or compact CSV with one 'id,x,y,z' line of voxel indices per seed point
+#              Image, contour and seed files are paired once into a manifest, 
+#              then the scans are processed in a pool of worker processes
+#              Finished scans are recorded in [outputFolder]/checkpoint.jsonl, and
+#              skipped when the batch is run again with the same inputs and parameters
 #
 # Param:       inputImage: The file path for the directory containing grayscale scans
 #              inputContours: The file path for the directory containing contour masks
@@ -23,15 +34,268 @@
 #              sigma: Standard deviation for the Gaussian smoothing filter, default=1
 #              minimumRadius: Minimum erosion radius in voxels, default=3
 #              dilateErodeDistance: Morphological kernel radius in voxels, default=5
+#              localLevelSet: Run the level set only around each erosion, the output
+#                             is approximate, a few voxels at the erosion boundaries change
+#              levelSetWorkers: Number of worker processes for the local level set, default=1
+#              intermediateFolder: Folder to write intermediate images to, default=None
+#              lowMemory: Reduce peak memory and report the peak memory of each step
+#              workers: Number of scans processed in parallel, default=1
+#              threads: Number of ITK threads in each worker, default=[number of cores / workers]
+#              log: The per-scan timing and status csv file path, default=[outputFolder]/ErosionVolumeLog.csv
+#              restart: Ignore the checkpoint manifest and process all scans
 #
 #-----------------------------------------------------
-import SimpleITK as sitk, os
-import VoidVolumeLogic
+import SimpleITK as sitk, os, csv, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    from . import VoidVolumeLogic
+    from .BatchCheckpoint import BatchCheckpoint
+    from .SeedIO import readSeeds
+except ImportError: # run as a script
+    import VoidVolumeLogic
+    from BatchCheckpoint import BatchCheckpoint
+    from SeedIO import readSeeds
 
 class VoidVolumeLogicCmd:
     def __init__(self):
         pass
 
+def _matchesName(name, filename):
+    """
+    Args:
+        name (str): file name in a folder
+        filename (str): name of a scan or contour, without extension
+
+    Returns:
+        bool: True if the name is filename or starts with filename followed by '_'
+    """
+    name = os.path.splitext(name)[0]
+    return name == filename or name.startswith(filename + '_')
+
+def buildManifest(input_dir, contour_dir, seeds_dir):
+    """
+    Pair each greyscale scan with its contours and seed point files. 
+    Each folder is listed only once. A contour with several matching
+    seed point files is skipped, rather than merging their seed points.
+    The seed point files of the scan are only used for a contour without
+    its own seed point file if the scan has one contour, otherwise the 
+    contour is skipped.
+
+    Args:
+        input_dir (str)
+        contour_dir (str)
+        seeds_dir (str)
+
+    Returns:
+        list of dict: one entry per contour, with the keys 'image', 'contour' and 'seeds',
+                      the list of at most one seed point file
+    """
+    contour_list = sorted(os.listdir(contour_dir))
+    seeds_list = sorted(os.listdir(seeds_dir))
+    manifest = []
+    for file in sorted(os.listdir(input_dir)):
+        filename = os.path.splitext(file)[0]
+        contours = [name for name in contour_list if _matchesName(name, filename)]
+        if len(contours) == 0:
+            print("No contours found for " + file)
+            continue
+        # the seeds folder may also hold the cortical break images
+        scan_seeds = [name for name in seeds_list if _matchesName(name, filename)
+                      and os.path.splitext(name)[1].lower() in ('.csv', '.json', '.fcsv')]
+        for contour_name in contours:
+            # prefer the seeds of the contour, e.g. from CorticalBreakDetectionCmd
+            contour_filename = os.path.splitext(contour_name)[0]
+            seeds = [name for name in scan_seeds if _matchesName(name, contour_filename)]
+            if len(seeds) == 0:
+                if len(contours) > 1:
+                    print("No seed file found for " + contour_name + ", skipped")
+                    continue
+                seeds = scan_seeds
+            if len(seeds) > 1:
+                print("Several seed files found for " + contour_name + ", skipped: " + ', '.join(seeds))
+                continue
+            seeds = [os.path.join(seeds_dir, name) for name in seeds]
+            manifest.append({'image': os.path.join(input_dir, file),
+                             'contour': os.path.join(contour_dir, contour_name),
+                             'seeds': seeds})
+    return manifest
+
+def initWorker(threads):
+    """
+    Limit the number of ITK threads in each worker process.
+    """
+    if threads:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+def processScan(entry, output_dir, params):
+    """
+    Run the erosion volume algorithm on one manifest entry and store the output.
+
+    Args:
+        entry (dict): manifest entry
+        output_dir (str)
+        params (dict): algorithm parameters
+
+    Returns:
+        str: output file path
+    """
+    img = sitk.ReadImage(entry['image'])
+    contour = sitk.Cast(sitk.ReadImage(entry['contour']), sitk.sitkUInt8)
+    seeds = []
+    for seeds_file in entry['seeds']:
+        seeds += readSeeds(seeds_file, img)
+    if len(seeds) == 0:
+        print("No seeds found or 0 seeds set for " + entry['image'])
+
+    contour_filename = os.path.splitext(os.path.basename(entry['contour']))[0]
+    return processSeeds(img, contour, seeds, contour_filename, output_dir, params)
+
+def processSeeds(img, contour, seeds, contour_filename, output_dir, params):
+    """
+    Run the erosion volume algorithm on a scan that is already in memory and store
+    the output, e.g. with the seed points of the cortical break detection.
+
+    Args:
+        img (Image): greyscale scan
+        contour (Image): UInt8 mask
+        seeds (list of tuple of int): (x,y,z) indices of img
+        contour_filename (str): name of the output file, without extension
+        output_dir (str)
+        params (dict): algorithm parameters
+
+    Returns:
+        str: output file path
+    """
+    # create erosion logic object
+    erosion = VoidVolumeLogic.VoidVolumeLogic(img, contour, params['lower'], params['upper'], 
+                                              params['sigma'], seeds, params['minimumRadius'], 
+                                              params['dilateErodeDistance'])
+    erosion.setLocalLevelSet(params['localLevelSet'])
+    erosion.setLevelSetWorkers(params['levelSetWorkers'])
+    erosion.setLowMemory(params['lowMemory'])
+    if params['intermediate_dir']:
+        erosion.setIntermediateSink(VoidVolumeLogic.DirectorySink(
+            os.path.join(params['intermediate_dir'], contour_filename)))
+
+    # identify erosions
+    print("Running erosion detection script on " + contour_filename)
+    step = 1
+    while (erosion.execute(step)):
+        step += 1
+    erosion_img = erosion.getOutput()
+
+    print("Saving output files")
+    output_file = os.path.join(output_dir, contour_filename + '_ER.mha')
+    sitk.WriteImage(erosion_img, output_file)
+    return output_file
+
+def checkpointParams(params):
+    """
+    Parameters recorded in the checkpoint manifest. The execution settings
+    that do not change the output are left out, so that changing them does
+    not run the batch again.
+
+    Args:
+        params (dict): algorithm parameters
+
+    Returns:
+        dict
+    """
+    checkpoint_params = {key: value for key, value in params.items()
+                         if key not in ('levelSetWorkers', 'intermediate_dir')}
+    return checkpoint_params
+
+def _inputFiles(entry):
+    """
+    Args:
+        entry (dict): manifest entry
+
+    Returns:
+        list of str: all input files of the entry
+    """
+    return [entry['image'], entry['contour']] + entry['seeds']
+
+def _timedProcessScan(entry, output_dir, params):
+    """
+    Run processScan and time it, catching errors so that one bad scan
+    does not stop the batch.
+
+    Returns:
+        tuple: (output file path, status, seconds, message)
+    """
+    start = time.time()
+    try:
+        output_file = processScan(entry, output_dir, params)
+        return output_file, 'done', time.time() - start, ''
+    except Exception as e:
+        return '', 'failed', time.time() - start, str(e)
+
+def runBatch(manifest, output_dir, params, workers=1, threads=None, log_file=None, resume=True):
+    """
+    Process all manifest entries in a pool of worker processes and write
+    the timing and status of each scan to a csv file as they finish.
+    Finished scans are recorded in the checkpoint manifest of the output folder.
+
+    Args:
+        manifest (list of dict): from buildManifest
+        output_dir (str)
+        params (dict): algorithm parameters
+        workers (int): number of scans processed in parallel
+        threads (int): number of ITK threads in each worker,
+                       default is the number of cores divided by workers
+        log_file (str): csv file path, default=[output_dir]/ErosionVolumeLog.csv
+        resume (bool): skip scans that the checkpoint manifest records as done
+    """
+    if threads is None:
+        threads = max((os.cpu_count() or 1) // workers, 1)
+    if log_file is None:
+        log_file = os.path.join(output_dir, 'ErosionVolumeLog.csv')
+
+    checkpoint = BatchCheckpoint(output_dir)
+    checkpoint_params = checkpointParams(params)
+
+    with open(log_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['image', 'contour', 'output', 'status', 'seconds', 'message'])
+
+        # skip scans that finished in a previous run
+        remaining = []
+        for entry in manifest:
+            if resume and checkpoint.isDone(entry['contour'], _inputFiles(entry), checkpoint_params):
+                print("{} skipped, already done".format(entry['contour']))
+                writer.writerow([entry['image'], entry['contour'], '', 'skipped', '', ''])
+            else:
+                remaining.append(entry)
+
+        for entry, result in _processEntries(remaining, output_dir, params, workers, threads):
+            output_file, status, seconds, message = result
+            print("{} {} in {:.1f} s".format(entry['contour'], status, seconds))
+            if status == 'done':
+                checkpoint.record(entry['contour'], _inputFiles(entry), checkpoint_params, [output_file])
+            writer.writerow([entry['image'], entry['contour'], output_file, 
+                             status, '{:.1f}'.format(seconds), message])
+            f.flush()
+
+def _processEntries(entries, output_dir, params, workers, threads):
+    """
+    Run _timedProcessScan on the manifest entries, in this process if workers is 1,
+    otherwise in a pool of worker processes.
+
+    Yields:
+        tuple: manifest entry and the result of _timedProcessScan, as they finish
+    """
+    if workers == 1:
+        initWorker(threads)
+        for entry in entries:
+            yield entry, _timedProcessScan(entry, output_dir, params)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, 
+                             initargs=(threads,)) as executor:
+        futures = {executor.submit(_timedProcessScan, entry, output_dir, params): entry
+                   for entry in entries}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
 # execute this script on command line
 if __name__ == "__main__":
@@ -43,9 +307,6 @@ if __name__ == "__main__":
     parser.add_argument('inputContours', help='The file path for the directory containing contour masks')
     parser.add_argument('inputSeeds', help='The file path for the directory containing seed point files')
     parser.add_argument('outputFolder', help='The output folder path')
-    parser.add_argument('-im', '--inputMask', help='The input mask file path, default=[inputImage]_MASK', default="_MASK.mha", metavar='')
-    parser.add_argument('-oi', '--outputImage', help='The output image file path, default=[inputImage]_ER', default="_ER.nrrd", metavar='')
-    parser.add_argument('-sd', '--seeds', help='The seed points csv file path, default=[inputImage]_SEEDS', default="_SEEDS.csv", metavar='')
     parser.add_argument('-lt', '--lowerThreshold', help='default=530', type=int, default=530, metavar='')
     parser.add_argument('-ut', '--upperThreshold', help='default=15000', type=int, default=15000, metavar='')
     parser.add_argument('-sg', '--sigma', type=float, help='Standard deviation for the Gaussian smoothing filter, default=1', default=1, metavar='')
@@ -53,73 +314,38 @@ if __name__ == "__main__":
                         help='Minimum erosion radius in voxels, default=3', metavar='')
     parser.add_argument('-ded', '--dilateErodeDistance', type=int, default=4,
                         help='Morphological kernel radius in voxels, default=4', metavar='')
+    parser.add_argument('-ls', '--localLevelSet', action='store_true',
+                        help='Run the level set only inside the padded bounding box of each erosion, '
+                             'the output is approximate')
+    parser.add_argument('-lw', '--levelSetWorkers', type=int, default=1,
+                        help='Number of worker processes for the local level set, default=1', metavar='')
+    parser.add_argument('-if', '--intermediateFolder', default=None,
+                        help='Folder to write intermediate images to, default=None', metavar='')
+    parser.add_argument('-lm', '--lowMemory', action='store_true',
+                        help='Reduce peak memory and report the peak memory of each step')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of scans processed in parallel, default=1', metavar='')
+    parser.add_argument('-t', '--threads', type=int, default=None,
+                        help='Number of ITK threads in each worker, default=[number of cores / workers]', metavar='')
+    parser.add_argument('-l', '--log', default=None,
+                        help='The per-scan timing and status csv file path, default=[outputFolder]/ErosionVolumeLog.csv', metavar='')
+    parser.add_argument('-r', '--restart', action='store_true',
+                        help='Ignore the checkpoint manifest and process all scans')
     args = parser.parse_args()
 
     input_dir = args.inputImages
     contour_dir = args.inputContours
     seeds_dir = args.inputSeeds
     output_dir = args.outputFolder
-    lower = args.lowerThreshold
-    upper = args.upperThreshold
-    sigma = args.sigma
-    minimumRadius = args.minimumRadius
-    dilateErodeDistance = args.dilateErodeDistance
-
-    contour_list = os.listdir(contour_dir)
-    seeds_list = os.listdir(seeds_dir)
-    for file in os.listdir(input_dir):
-        # read image
-        try:
-            img = sitk.ReadImage(input_dir + '/' + file)
-        except:
-            print('Could not read in ' + file)
-            continue
-
-        filename = os.path.splitext(file)[0]
-        
-        #read mask(s)
-        contours = []
-        for contour_name in contour_list:
-            if filename in contour_name:
-                contours.append(contour_name)
-        if len(contours) == 0:
-            print("No contours found for " + file)
-            continue
+    params = {'lower': args.lowerThreshold,
+              'upper': args.upperThreshold,
+              'sigma': args.sigma,
+              'minimumRadius': args.minimumRadius,
+              'dilateErodeDistance': args.dilateErodeDistance,
+              'localLevelSet': args.localLevelSet,
+              'levelSetWorkers': args.levelSetWorkers,
+              'intermediate_dir': args.intermediateFolder,
+              'lowMemory': args.lowMemory}
 
-        #read seeds
-        seeds = []
-        HEADER = 3
-        lineCount = 0
-        for seeds_name in seeds_list:
-            if file in seeds_name:
-                with open(seeds_dir + file + '_SEEDS') as fcsv:
-                    for line in fcsv:
-                        # line = 'id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID'
-                        if lineCount >= HEADER:
-                            seed = line.split(',')
-                            x = int(float(seed[1]))
-                            y = int(float(seed[2]))
-                            z = int(float(seed[3]))
-                            seeds.append((x,y,z))
-                        lineCount += 1
-        if len(seeds) == 0:
-            print("No seeds found or 0 seeds set for " + file)
-
-        for contour_name in contours:
-            contour = sitk.Cast(sitk.ReadImage(contour_dir + '/' + contour_name), sitk.sitkUInt8)
-            
-
-            # create erosion logic object
-            erosion = VoidVolumeLogic.VoidVolumeLogic(img, contour, lower, upper, sigma, seeds,
-                                    minimumRadius, dilateErodeDistance)
-
-            # identify erosions
-            print("Running erosion detection script")
-            step = 1
-            while (erosion.execute(step)):
-                step += 1
-            erosion_img = erosion.getOutput()
-
-            print("Saving output files")
-            contour_filename = os.path.splitext(contour_name)[0]
-            sitk.WriteImage(erosion_img, output_dir + '/' + contour_filename + '_ER.mha')
+    manifest = buildManifest(input_dir, contour_dir, seeds_dir)
+    runBatch(manifest, output_dir, params, args.workers, args.threads, args.log, not args.restart)
@@ -35,6 +35,10 @@ class ErosionVolumeLogic(ScriptedLoadableModuleLogic):
     self.progressCallBack = None
 
     self.voidVolume = VoidVolumeLogic()
+    # keep up to 2 GB of intermediate images, so that changing a parameter
+    #  only reruns the steps that depend on it, and up to 2 GB of smoothed and 
+    #  binarized scans shared with the cortical break detection module
+    self.voidVolume.setCacheLimit(2 * 1024**3)
     self.erosionStatistics = ErosionStatisticsLogic()
 
   def RASToIJKCoords(self, ras_3coords:list, ras2ijk) -> tuple:
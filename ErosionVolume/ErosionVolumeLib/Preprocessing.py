@@ -0,0 +1,333 @@
+#-----------------------------------------------------
+# Preprocessing.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module memoises the preprocessing shared by the cortical
+#              break detection and the erosion volume modules, i.e. the Gaussian
+#              smoothing and the binarization of the greyscale scan.
+#              Results are keyed by the voxel values and the geometry of the scan
+#              and by sigma and the thresholds, so that the second module run on
+#              a scan reuses the volumes computed by the first one.
+#              The cortical break detection and the erosion volume modules each
+#              keep a copy of this file, the copies share one cache per process.
+#
+#-----------------------------------------------------
+# Usage:       preprocessing = sharedPreprocessing()
+#              preprocessing.setMemoryLimit(2 * 1024**3)
+#              thresh_img = preprocessing.threshold(img, sigma, lower, upper)
+#              gaussian_img = preprocessing.smooth(img, sigma, region)
+#
+#-----------------------------------------------------
+import SimpleITK as sitk
+import sys, math, types, hashlib
+from collections import OrderedDict
+
+_SHARED_MODULE = '_bone_analysis_preprocessing'
+GAUSSIAN_MARGIN = 20    # in sigmas, where the recursive Gaussian tail is below float rounding
+
+def imageHash(img):
+    """
+    Hash of the voxel values and the geometry of an image.
+
+    Args:
+        img (Image)
+
+    Returns:
+        str
+    """
+    sha = hashlib.sha1(sitk.GetArrayViewFromImage(img))
+    sha.update(str((img.GetPixelID(), img.GetSize(), img.GetSpacing(),
+                    img.GetOrigin(), img.GetDirection())).encode())
+    return sha.hexdigest()
+
+def gaussian(img, sigma):
+    """
+    Denoise with a Gaussian filter.
+
+    Args:
+        img (Image)
+        sigma (float): in voxels
+
+    Returns:
+        Image
+    """
+    sigma_over_spacing = sigma * img.GetSpacing()[0]
+
+    # gaussian smoothing filter
+    print("Applying Gaussian filter")
+    gaussian_filter = sitk.SmoothingRecursiveGaussianImageFilter()
+    gaussian_filter.SetSigma(sigma_over_spacing)
+    return gaussian_filter.Execute(img)
+
+def gaussianRegion(img, sigma, region):
+    """
+    Denoise a region of the image with a Gaussian filter. The region is padded
+    by GAUSSIAN_MARGIN sigmas. The recursive Gaussian has an infinite impulse
+    response, so the result equals the region of the smoothed image up to float
+    rounding only, e.g. differences below 1e-6 on scans in HU, against up to 1
+    with a margin of four sigmas.
+
+    Args:
+        img (Image)
+        sigma (float): in voxels
+        region (tuple): (index, size) of the region, in voxels
+
+    Returns:
+        Image
+    """
+    index, size = region
+    margin = math.ceil(GAUSSIAN_MARGIN * sigma)
+    lower = [max(index[i] - margin, 0) for i in range(3)]
+    upper = [min(index[i] + size[i] + margin, img.GetSize()[i]) for i in range(3)]
+    padded_img = sitk.RegionOfInterest(img, [upper[i] - lower[i] for i in range(3)], lower)
+    gaussian_img = gaussian(padded_img, sigma)
+    del padded_img
+
+    return sitk.RegionOfInterest(gaussian_img, size, [index[i] - lower[i] for i in range(3)])
+
+def autoThreshold(img, method):
+    """
+    Binarize the image with an automatic thresholding method.
+
+    Args:
+        img (Image)
+        method (int): 0 - Otsu, 1 - Huang, 2 - Max Entropy, 3 - Moments, 4 - Yen
+
+    Returns:
+        Image: bone is labeled with 1, and background is labeled with 0.
+    """
+    if method == 0:
+        thresh = sitk.OtsuThresholdImageFilter()
+    elif method == 1:
+        thresh = sitk.HuangThresholdImageFilter()
+    elif method == 2:
+        thresh = sitk.MaximumEntropyThresholdImageFilter()
+    elif method == 3:
+        thresh = sitk.MomentsThresholdImageFilter()
+    elif method == 4:
+        thresh = sitk.YenThresholdImageFilter()
+    thresh.SetOutsideValue(1)
+    thresh.SetInsideValue(0)
+    return thresh.Execute(img)
+
+def sharedPreprocessing():
+    """
+    Get the preprocessing cache of this process. It is kept in sys.modules,
+    so that the copies of this file in the module folders share it.
+
+    Returns:
+        Preprocessing
+    """
+    shared = sys.modules.get(_SHARED_MODULE)
+    if shared is None:
+        shared = types.ModuleType(_SHARED_MODULE)
+        shared.preprocessing = Preprocessing()
+        sys.modules[_SHARED_MODULE] = shared
+    return shared.preprocessing
+
+class StageCache:
+    """
+    Least recently used cache of intermediate images,
+    limited by the total memory of the images it holds.
+    """
+    def __init__(self, memoryLimit=0):
+        self.memoryLimit = memoryLimit  # in bytes, 0 disables the cache
+        self._entries = OrderedDict()
+        self._memory = 0
+
+    def get(self, key):
+        """
+        Args:
+            key (tuple)
+
+        Returns:
+            Image: None if the key is not in the cache
+        """
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, img):
+        """
+        Store the image, evicting the least recently used images to stay
+        within the memory limit. Images larger than the limit are not stored.
+
+        Args:
+            key (tuple)
+            img (Image)
+        """
+        size = self._imageMemory(img)
+        if size > self.memoryLimit:
+            return
+        if key in self._entries:
+            self._memory -= self._imageMemory(self._entries.pop(key))
+        while self._memory + size > self.memoryLimit:
+            _, evicted_img = self._entries.popitem(last=False)
+            self._memory -= self._imageMemory(evicted_img)
+        self._entries[key] = img
+        self._memory += size
+
+    def setMemoryLimit(self, memoryLimit):
+        """
+        Args:
+            memoryLimit (int): in bytes, 0 disables the cache
+        """
+        self.memoryLimit = memoryLimit
+        while self._memory > self.memoryLimit:
+            _, evicted_img = self._entries.popitem(last=False)
+            self._memory -= self._imageMemory(evicted_img)
+
+    def clear(self):
+        self._entries.clear()
+        self._memory = 0
+
+    def _imageMemory(self, img):
+        return (img.GetNumberOfPixels() * img.GetSizeOfPixelComponent() *
+                img.GetNumberOfComponentsPerPixel())
+
+class Preprocessing:
+    """
+    Memoised Gaussian smoothing and binarization of greyscale scans.
+    Each result is computed for the whole scan or for a region of it. A region
+    is served from the whole scan result if that is in the cache.
+    The returned images are shared with the cache and must not be modified in place.
+    """
+    def __init__(self, memoryLimit=0):
+        self.cache = StageCache(memoryLimit)
+
+    def imageKey(self, img):
+        """
+        Args:
+            img (Image)
+
+        Returns:
+            str: hash of the image, None if the cache is disabled
+        """
+        if self.cache.memoryLimit > 0:
+            return imageHash(img)
+        return None
+
+    def smooth(self, img, sigma, region=None, key=None):
+        """
+        Args:
+            img (Image)
+            sigma (float): in voxels
+            region (tuple): (index, size) of the region to smooth, in voxels.
+                            The whole image is smoothed if None.
+            key (str): hash of img from imageKey, computed if None
+
+        Returns:
+            Image
+        """
+        key = self._key(img, key)
+        whole_key = self._entryKey(key, 'gaussian', sigma)
+        if region is None:
+            return self._cached(whole_key, lambda: gaussian(img, sigma))
+        gaussian_img = self.cache.get(whole_key)
+        if gaussian_img is not None:
+            return self._regionOf(gaussian_img, region)
+        return self._cached(self._entryKey(whole_key, self._regionKey(region)),
+                            lambda: gaussianRegion(img, sigma, region))
+
+    def threshold(self, img, sigma, lower, upper, region=None, key=None):
+        """
+        Denoise with a Gaussian filter and binarize the image with a threshold filter.
+
+        Args:
+            img (Image)
+            sigma (float): in voxels
+            lower (int)
+            upper (int)
+            region (tuple): (index, size) of the region to binarize, in voxels.
+                            The whole image is binarized if None.
+            key (str): hash of img from imageKey, computed if None
+
+        Returns:
+            Image: bone is labeled with 1, and background is labeled with 0.
+        """
+        key = self._key(img, key)
+        whole_key = self._entryKey(key, 'threshold', sigma, lower, upper)
+        compute = lambda: sitk.BinaryThreshold(self.smooth(img, sigma, region, key),
+                                               lowerThreshold=lower,
+                                               upperThreshold=upper,
+                                               insideValue=1)
+        if region is None:
+            return self._cached(whole_key, compute)
+        thresh_img = self.cache.get(whole_key)
+        if thresh_img is not None:
+            return self._regionOf(thresh_img, region)
+        return self._cached(self._entryKey(whole_key, self._regionKey(region)), compute)
+
+    def autoThreshold(self, img, sigma, method, key=None):
+        """
+        Denoise with a Gaussian filter and binarize the whole image with an
+        automatic thresholding method. Automatic thresholds depend on the
+        histogram of the whole image, so regions are not supported.
+
+        Args:
+            img (Image)
+            sigma (float): in voxels
+            method (int): 0 - Otsu, 1 - Huang, 2 - Max Entropy, 3 - Moments, 4 - Yen
+            key (str): hash of img from imageKey, computed if None
+
+        Returns:
+            Image: bone is labeled with 1, and background is labeled with 0.
+        """
+        key = self._key(img, key)
+        return self._cached(self._entryKey(key, 'auto threshold', sigma, method),
+                            lambda: autoThreshold(self.smooth(img, sigma, key=key), method))
+
+    def setMemoryLimit(self, memoryLimit):
+        """
+        Args:
+            memoryLimit (int): Memory limit of the cache in bytes,
+                               0 disables the cache.
+        """
+        self.cache.setMemoryLimit(memoryLimit)
+
+    def clear(self):
+        self.cache.clear()
+
+    def _key(self, img, key):
+        if key is None:
+            return self.imageKey(img)
+        return key
+
+    def _entryKey(self, key, *params):
+        """
+        Returns:
+            tuple: None if key is None, i.e. the cache is disabled
+        """
+        if key is None:
+            return None
+        if isinstance(key, tuple):
+            return key + params
+        return (key,) + params
+
+    def _regionKey(self, region):
+        return (tuple(region[0]), tuple(region[1]))
+
+    def _regionOf(self, img, region):
+        return sitk.RegionOfInterest(img, list(region[1]), list(region[0]))
+
+    def _cached(self, key, compute):
+        """
+        Args:
+            key (tuple): None if the cache is disabled
+            compute (function)
+
+        Returns:
+            Image
+        """
+        if key is None:
+            return compute()
+        img = self.cache.get(key)
+        if img is None:
+            img = compute()
+            self.cache.put(key, img)
+        else:
+            print("Using cached preprocessing")
+
+        return img
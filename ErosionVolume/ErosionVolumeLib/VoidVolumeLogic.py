@@ -14,6 +14,19 @@
 #              to obtain the final erosion segmentation. 
 #              Lastly, each erosion is relabeled with the value that matches 
 #              the seed point name. 
+#              The Gaussian and the threshold are taken from the preprocessing
+#              cache shared with the cortical break detection module when it
+#              has already computed them for the same scan.
+#              Seed points are grouped by their minimum radius and 
+#              dilate/erode distance, the Gaussian, threshold and distance map
+#              are shared by all groups, and the morphological steps and the 
+#              level set are applied to each group with its own radii. The 
+#              erode and connect steps only run in the boxes of the voids 
+#              connected to the seed points. The output is the same as 
+#              running the algorithm once for each radii setting. 
+#              Optionally, the output of each step is cached, so that changing
+#              a parameter only reruns the steps that depend on it, and 
+#              intermediate images are passed to a sink for debugging. 
 #              There are 8 steps.
 #
 #-----------------------------------------------------
@@ -26,11 +39,172 @@
 #              lowerThreshold
 #              upperThreshold
 #              sigma: Standard deviation for the Gaussian smoothing filter
-#              minimumRadius: Minimum erosion radius in voxels, default=3
-#              dilateErodeDistance: Morphological kernel radius in voxels, default=5
+#              minimumRadius: Minimum erosion radius in voxels, default=3, 
+#                             either one value or one value per seed point
+#              dilateErodeDistance: Morphological kernel radius in voxels, default=5, 
+#                                   either one value or one value per seed point
 #
 #-----------------------------------------------------
 import SimpleITK as sitk
+import numpy as np
+import os, sys
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from .Preprocessing import StageCache, imageHash, gaussianRegion, sharedPreprocessing
+except ImportError: # run as a script, e.g. from ErosionVolumeCmd
+    from Preprocessing import StageCache, imageHash, gaussianRegion, sharedPreprocessing
+
+def _levelSet(ero1_img, model_img, lower_threshold, iterations):
+    """
+    Level set region growing of the erosion segmentation. Defined at module 
+    level so that it can run in worker processes.
+
+    Args:
+        ero1_img (Image)
+        model_img (Image): greyscale image occupying the same space as ero1_img
+        lower_threshold (int): voxels below this value are grown into
+        iterations (int): number of level set iterations
+
+    Returns:
+        Image: voxels inside the level set are marked with the value 1.
+    """
+    # distance map for level set filter
+    print("Applying distance map filter")
+    distance_filter = sitk.SignedMaurerDistanceMapImageFilter()
+    distance_filter.SetInsideIsPositive(True)
+    distance_filter.SetUseImageSpacing(False)
+    distance_filter.SetBackgroundValue(0)
+    distance_img = distance_filter.Execute(ero1_img)
+    
+    # level set requires spacing of [1,1,1] and float voxel type
+    distance_img.SetSpacing([1,1,1])
+    feature_img = sitk.Cast(model_img, sitk.sitkFloat32)
+    feature_img.SetSpacing([1,1,1])
+
+    # level set region growing
+    print("Applying level set filter")
+    ls_filter = sitk.ThresholdSegmentationLevelSetImageFilter()
+    ls_filter.SetLowerThreshold(-999999)
+    ls_filter.SetUpperThreshold(lower_threshold)
+    ls_filter.SetMaximumRMSError(0.02)
+    ls_filter.SetNumberOfIterations(iterations)
+    ls_filter.SetCurvatureScaling(1)
+    ls_filter.SetPropagationScaling(1)
+    ls_filter.SetReverseExpansionDirection(True)
+    ls_img = ls_filter.Execute(distance_img, feature_img)
+
+    # restore spacing
+    ls_img.SetSpacing(ero1_img.GetSpacing())
+
+    return sitk.BinaryThreshold(ls_img, lowerThreshold=1, insideValue=1)
+
+@lru_cache(maxsize=None)
+def _ballOffsets(radius):
+    """
+    Offsets of the voxels in a ball of the given radius, in (z,y,x) order. 
+
+    Args:
+        radius (int): in voxels
+
+    Returns:
+        ndarray: N by 3 array of int
+    """
+    r = int(radius)
+    grid = np.mgrid[-r:r+1, -r:r+1, -r:r+1].reshape(3, -1).T
+    return grid[np.sum(grid**2, axis=1) <= radius**2]
+
+def _mergeBoxes(boxes):
+    """
+    Merge overlapping boxes until none are left.
+
+    Args:
+        boxes (list of tuple): (lower, upper, items) of each box, lower and upper
+                               are (x,y,z) indices and items is a list
+
+    Returns:
+        list of tuple: (lower, upper, items) of each merged box, items holds
+                       the items of all boxes merged into it
+    """
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i+1, len(boxes)):
+                (lower1, upper1, items1), (lower2, upper2, items2) = boxes[i], boxes[j]
+                if all(lower1[k] < upper2[k] and lower2[k] < upper1[k] for k in range(3)):
+                    boxes[i] = ([min(lower1[k], lower2[k]) for k in range(3)],
+                                [max(upper1[k], upper2[k]) for k in range(3)],
+                                items1 + items2)
+                    boxes.pop(j)
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return boxes
+
+def _resetPeakRSS():
+    """
+    Reset the peak resident memory of this process, only supported on Linux.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _peakRSS():
+    """
+    Get the peak resident memory of this process.
+
+    Returns:
+        int: in bytes, None if not supported
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def _initWorker(threads):
+    """
+    Limit the number of ITK threads in each worker process.
+    """
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+class DirectorySink:
+    """
+    Intermediate image sink that writes each image to a directory.
+    """
+    def __init__(self, directory, extension='.nrrd'):
+        self.directory = directory
+        self.extension = extension
+        self._count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, name, img):
+        # number the files so that they are listed in the order they were created
+        self._count += 1
+        filename = '{:02d}_{}{}'.format(self._count, name, self.extension)
+        sitk.WriteImage(img, os.path.join(self.directory, filename))
+
+class MemorySink(dict):
+    """
+    Intermediate image sink that keeps each image in memory, by name.
+    """
+    def __call__(self, name, img):
+        self[name] = img
 
 class VoidVolumeLogic:
     def __init__(self, img=None, mask=None, lower=530, upper=15000, sigma=1,
@@ -43,6 +217,7 @@ class VoidVolumeLogic:
         self.sigma = sigma                    # Gaussian sigma
         self.minimalRadius = minimalRadius               # for distance transformation, default=3
         self.dilateErodeDistance = dilateErodeDistance   # for morphological operations, default=4
+                                                         #  both can be an int or a list with one value per seed
         self.seeds = seeds         # list of seed point coordinates (x,y,z)
         self.erosionIds = []       # erosion ids decide which value each erosion is labeled with
         if seeds is not None:      #  default = [1, 2, ..., len(seeds)+1]
@@ -51,27 +226,59 @@ class VoidVolumeLogic:
         self._step = 0             # number of steps done
         self.method = None
         self.auto_thresh = False
+        self.localLevelSet = False # run the level set only around each erosion
+        self.levelSetWorkers = 1   # number of worker processes for the level set
+        self._seedGroups = []      # (minimalRadius, dilateErodeDistance, seeds) for each radii setting
+        self._group_imgs = {}      # intermediate images of each seed group, will be modified
+        self._group_regions = {}   # boxes of the voids connected to the seeds of each group
+        self.cache = StageCache()  # outputs of previous runs, disabled by default
+        self.preprocessing = sharedPreprocessing() # Gaussian and threshold shared between modules
+        self._thresh_img = None    # binarized bone model from the preprocessing cache
+        self._region = None        # (index, size) of the bone model inside the mask
+        self.intermediateSink = None # receives intermediate images, disabled by default
+        self.lowMemory = False     # release and reuse images early
+        self.peakRSS = {}          # peak resident memory of each step in the low memory mode, in bytes
+        self._cacheKey = None      # input hashes and parameters consumed so far
     
-    def denoise(self, img, sigma):
+    def denoise(self, img, sigma, key=None):
         """
-        Denoise the bone model with a Gaussian filter.
+        Denoise the bone model with a Gaussian filter. Only the region of the 
+        bone model inside the mask is smoothed, with a margin so that the result 
+        equals smoothing the whole scan up to float rounding, see gaussianRegion. 
+        The Gaussian, and with fixed thresholds also the binarized bone model, 
+        are looked up in the shared preprocessing cache. The low memory mode 
+        bypasses the cache.
 
         Args:
             img (Image)
             sigma (float)
+            key (str): hash of img from the preprocessing cache, computed if None
 
         Returns:
-            Image
+            Image: cropped to the mask
         """
-        sigma_over_spacing = sigma * img.GetSpacing()[0]
-
-        # gaussian smoothing filter
-        print("Applying Gaussian filter")
-        gaussian_filter = sitk.SmoothingRecursiveGaussianImageFilter()
-        gaussian_filter.SetSigma(sigma_over_spacing)
-        gaussian_img = gaussian_filter.Execute(img)
-
-        return gaussian_img
+        self._thresh_img = None
+        if self._region is None: # the bone model does not overlap the mask
+            return self._pasteToMask(None, img.GetPixelID())
+
+        if self.lowMemory:
+            gaussian_img = gaussianRegion(img, sigma, self._region)
+            if gaussian_img.GetPixelID() == sitk.sitkFloat64:
+                # level set requires float, single precision is enough
+                gaussian_img = sitk.Cast(gaussian_img, sitk.sitkFloat32)
+            return self._pasteToMask(gaussian_img)
+
+        if key is None:
+            key = self.preprocessing.imageKey(img)
+        gaussian_img = self.preprocessing.smooth(img, sigma, self._region, key)
+        # automatic thresholds depend on the histogram of the cropped image, 
+        #  only fixed thresholds are shared
+        if key is not None and not self.auto_thresh:
+            self._thresh_img = self._pasteToMask(
+                self.preprocessing.threshold(img, sigma, self.lower_threshold, 
+                                             self.upper_threshold, self._region, key))
+
+        return self._pasteToMask(gaussian_img)
 
     def createROI(self, gaussian_img):
         """
@@ -86,7 +293,10 @@ class VoidVolumeLogic:
                    and all other regions are marked with 0.  
         """
         # binarize the bone
-        if self.auto_thresh:
+        if self._thresh_img is not None: # from the preprocessing cache
+            thresh_img = self._thresh_img
+            self._thresh_img = None
+        elif self.auto_thresh:
             index = self.method
             if index == 0:
                 thresh = sitk.OtsuThresholdImageFilter()
@@ -111,45 +321,61 @@ class VoidVolumeLogic:
         invert_filter = sitk.InvertIntensityImageFilter()
         invert_filter.SetMaximum(1)
         void_volume_img = invert_filter.Execute(thresh_img)
+        del thresh_img
 
-        void_volume_img = self.contour_img * void_volume_img
+        void_volume_img *= self.contour_img
 
         return void_volume_img
 
-    def distanceVoidVolume(self, void_volume_img, radius):
+    def distanceMapVoidVolume(self, void_volume_img):
+        """
+        Distance map of the bone measured from the voids. It does not depend on the 
+        minimum erosion radius and is shared by all seed groups.
+
+        Args:
+            void_volume_img (Image)
+
+        Returns:
+            Image
+        """
+        print("Applying distance map filter")
+        distance_filter = sitk.SignedMaurerDistanceMapImageFilter()
+        distance_filter.SetSquaredDistance(False)
+        distance_filter.SetBackgroundValue(1)
+        distance_img = distance_filter.Execute(void_volume_img)
+
+        return distance_img
+
+    def distanceVoidVolume(self, void_volume_img, radius, distance_img=None):
         """
         Label voids in the bone that are larger than the specified value in separation. 
 
         Args:
             void_volume_img (Image)
             radius (int): minimum radius of the erosions to be selected, in voxels
+            distance_img (Image): distance map from distanceMapVoidVolume, 
+                                  computed from void_volume_img if not given
 
         Returns:
             Image
         """
+        if distance_img is None:
+            distance_img = self.distanceMapVoidVolume(void_volume_img)
+        inner_img = distance_img
 
         distance_filter = sitk.SignedMaurerDistanceMapImageFilter()
         distance_filter.SetSquaredDistance(False)
-        distance_filter.SetBackgroundValue(1)
-        inner_img = distance_filter.Execute(void_volume_img)
-
-        image_viewer = sitk.ImageViewer()
-        image_viewer.SetCommand("Z:\Programs\ImageJ\ImageJ.exe")
 
         inner_img = sitk.BinaryThreshold(inner_img,
                                         lowerThreshold=1,
                                         upperThreshold=radius,
                                         insideValue=1)
-        image_viewer.SetTitle('innerimg using ImageViewer class')
-        image_viewer.Execute(inner_img)
-
-        image_viewer.SetTitle('volume using ImageViewer class')
-        image_viewer.Execute(void_volume_img)
+        self._emit('distance_r{}_inner'.format(radius), inner_img)
+        self._emit('distance_r{}_volume'.format(radius), void_volume_img)
 
         inner_img = void_volume_img - inner_img
 
-        image_viewer.SetTitle('grid using ImageViewer class')
-        image_viewer.Execute(inner_img)
+        self._emit('distance_r{}_grid'.format(radius), inner_img)
 
         distance_filter.SetBackgroundValue(0)
         outer_img = distance_filter.Execute(inner_img)
@@ -159,13 +385,11 @@ class VoidVolumeLogic:
                                          upperThreshold=radius,
                                          insideValue=1)
 
-        image_viewer.SetTitle('out using ImageViewer class')
-        image_viewer.Execute(outer_img)
+        self._emit('distance_r{}_outer'.format(radius), outer_img)
 
         distance_img = outer_img + inner_img
 
-        image_viewer.SetTitle('dist using ImageViewer class')
-        image_viewer.Execute(distance_img)
+        self._emit('distance_r{}_distance'.format(radius), distance_img)
 
         return distance_img
 
@@ -189,34 +413,27 @@ class VoidVolumeLogic:
 
         return erode_img
 
-    def connectVoidVolume(self, erode_img):
+    def connectVoidVolume(self, erode_img, seeds=None, distance=None):
         """
         Label voids that are connected to seed points.
 
         Args:
             erode_img (Image)
+            seeds (list of tuple of int): seed points in the cropped image, 
+                                          default is all seed points
+            distance (int): seed point inflation distance in voxels, 
+                            default is the dilate/erode distance of the first seed point
             
         Returns:
             Image
         """
-        seeds_img = sitk.Image(self.contour_img.GetSize(), sitk.sitkUInt8)
-        seeds_img.CopyInformation(self.contour_img)
-        for seed in self._seeds_crop:
-            seeds_img[seed] = 1
-
-        # apply distance transformation to the seed points
-        print("Applying distance map filter")
-        distance_filter = sitk.SignedMaurerDistanceMapImageFilter()
-        distance_filter.SetSquaredDistance(False)
-        distance_filter.SetBackgroundValue(0)
-        distance_img = distance_filter.Execute(seeds_img)
+        if seeds is None:
+            seeds = self._seeds_crop
+        if distance is None:
+            distance = self.dilateErodeDistance[0]
 
         # inflate seed points
-        upper = self.dilateErodeDistance[0] if self.dilateErodeDistance[0] != 0 else 1
-        seeds_img = sitk.BinaryThreshold(distance_img, 
-                                         lowerThreshold=0, 
-                                         upperThreshold=self.dilateErodeDistance[0], 
-                                         insideValue=1)
+        seeds_img = self.inflateSeeds(seeds, distance, erode_img)
 
         # combine inflated seed points and voids in the bone
         void_seeds_img = seeds_img | erode_img
@@ -225,15 +442,135 @@ class VoidVolumeLogic:
         connected_filter = sitk.ConnectedThresholdImageFilter()
         connected_filter.SetLower(1)
         connected_filter.SetUpper(1)
-        connected_filter.SetSeedList(self._seeds_crop)
+        connected_filter.SetSeedList(seeds)
         connected_filter.SetReplaceValue(1)
         connected_img = connected_filter.Execute(void_seeds_img)
         
         # remove inflated seed points from the voids
-        connected_img = erode_img * connected_img
+        connected_img *= erode_img
 
         return connected_img
 
+    def inflateSeeds(self, seeds, distance, reference_img=None):
+        """
+        Rasterize the seed points and inflate them to balls of the given radius.
+        Same as thresholding the distance map of the seed points at that distance,
+        but only the voxels around each seed point are written.
+
+        Args:
+            seeds (list of tuple of int): seed points in the cropped image
+            distance (int): inflation distance in voxels
+            reference_img (Image): image occupying the space of the output, 
+                                   default is the mask
+
+        Returns:
+            Image: voxels within the distance of a seed point are marked with the value 1.
+        """
+        if reference_img is None:
+            reference_img = self.contour_img
+        seeds_arr = np.zeros(reference_img.GetSize()[::-1], np.uint8)
+        if len(seeds) > 0:
+            # numpy index order is (z,y,x)
+            coords = np.array(seeds, dtype=int)[:, ::-1]
+            coords = (coords[:, np.newaxis, :] + _ballOffsets(distance)[np.newaxis]).reshape(-1, 3)
+            is_in_range = np.all((coords >= 0) & (coords < seeds_arr.shape), axis=1)
+            seeds_arr[tuple(coords[is_in_range].T)] = 1
+
+        seeds_img = sitk.GetImageFromArray(seeds_arr)
+        seeds_img.CopyInformation(reference_img)
+
+        return seeds_img
+
+    def seedRegions(self, void_volume_img, seeds, distance):
+        """
+        Boxes that hold the voids a group of seed points can select. The erosion
+        only removes voids, so each void connected to a seed point after the 
+        erode step is connected to it before. The box of the voids connected to 
+        the inflated seed point before the erosion therefore holds all voids 
+        that connectVoidVolume can select. Boxes that overlap once padded by 
+        the erode radius are merged, so that no voxel is eroded twice.
+
+        Args:
+            void_volume_img (Image): output of distanceVoidVolume
+            seeds (list of tuple of int): seed points in the cropped image
+            distance (int): erode radius and seed point inflation distance in voxels
+
+        Returns:
+            list of tuple: (lower, upper, seeds) of each box, lower and upper 
+                           are (x,y,z) indices of the mask
+        """
+        # same connectivity as the connected threshold filter in connectVoidVolume
+        seeds_img = self.inflateSeeds(seeds, distance, void_volume_img)
+        label_img = sitk.ConnectedComponent(seeds_img | (void_volume_img > 0))
+        lss_filter = sitk.LabelShapeStatisticsImageFilter()
+        lss_filter.ComputePerimeterOff()
+        lss_filter.Execute(label_img)
+
+        # merge on the padded boxes, which are not clipped to the image here
+        boxes = {}
+        for seed in seeds:
+            label = label_img[seed]
+            if label not in boxes:
+                bounds = lss_filter.GetBoundingBox(label)
+                boxes[label] = ([bounds[i] - distance for i in range(3)],
+                                [bounds[i] + bounds[i+3] + distance for i in range(3)], [])
+            boxes[label][2].append(seed)
+
+        return [([lower[i] + distance for i in range(3)], 
+                 [upper[i] - distance for i in range(3)], seeds)
+                for lower, upper, seeds in _mergeBoxes(boxes.values())]
+
+    def erodeSeedRegions(self, void_volume_img, regions, radius):
+        """
+        Erode the voids only inside the boxes from seedRegions. Each box is 
+        padded by the erode radius, so that the erosion inside the box is the 
+        same as eroding the whole image. Voxels outside of the boxes are 0.
+
+        Args:
+            void_volume_img (Image)
+            regions (list of tuple): from seedRegions
+            radius (int): erode steps, in voxels
+
+        Returns:
+            Image
+        """
+        erode_img = void_volume_img * 0
+        img_size = void_volume_img.GetSize()
+        for lower, upper, _ in regions:
+            padded_lower = [max(lower[i] - radius, 0) for i in range(3)]
+            padded_size = [min(upper[i] + radius, img_size[i]) - padded_lower[i] for i in range(3)]
+            size = [upper[i] - lower[i] for i in range(3)]
+            padded_img = self.erodeVoidVolume(
+                sitk.RegionOfInterest(void_volume_img, padded_size, padded_lower), radius)
+            region_img = sitk.RegionOfInterest(padded_img, size, 
+                                               [lower[i] - padded_lower[i] for i in range(3)])
+            erode_img = sitk.Paste(erode_img, region_img, size, [0,0,0], lower)
+
+        return erode_img
+
+    def connectSeedRegions(self, erode_img, regions, distance):
+        """
+        Label voids that are connected to seed points, inside each box from 
+        seedRegions with the seed points of that box. 
+
+        Args:
+            erode_img (Image)
+            regions (list of tuple): from seedRegions
+            distance (int): seed point inflation distance in voxels
+
+        Returns:
+            Image
+        """
+        connect_img = erode_img * 0
+        for lower, upper, seeds in regions:
+            size = [upper[i] - lower[i] for i in range(3)]
+            region_seeds = [tuple(seed[i] - lower[i] for i in range(3)) for seed in seeds]
+            region_img = self.connectVoidVolume(sitk.RegionOfInterest(erode_img, size, lower), 
+                                                region_seeds, distance)
+            connect_img = sitk.Paste(connect_img, region_img, size, [0,0,0], lower)
+
+        return connect_img
+
     def dilateVoidVolume(self, connect_img, radius):
         """
         Morphologically dilate voids back to their original size.
@@ -249,17 +586,53 @@ class VoidVolumeLogic:
         dilate_filter = sitk.BinaryDilateImageFilter()
         dilate_filter.SetForegroundValue(1)
         dilate_filter.SetKernelRadius([radius,radius,radius])
-        dilate_img = dilate_filter.Execute(connect_img)
+
+        # only dilate inside the bounding box of the connected voids,
+        #  padded by the kernel radius
+        lss_filter = sitk.LabelShapeStatisticsImageFilter()
+        lss_filter.Execute(connect_img)
+        if not lss_filter.HasLabel(1):
+            return connect_img * self.contour_img
+        bounds = lss_filter.GetBoundingBox(1)
+        size = connect_img.GetSize()
+        lower = [max(bounds[i] - radius, 0) for i in range(3)]
+        upper = [min(bounds[i] + bounds[i+3] + radius, size[i]) for i in range(3)]
+        roi_size = [upper[i] - lower[i] for i in range(3)]
+        dilate_img = dilate_filter.Execute(sitk.RegionOfInterest(connect_img, roi_size, lower))
 
         # apply mask to dilated voids to get volumes only inside the 
         #  endosteal boundary
-        void_volume_img = dilate_img * self.contour_img
+        dilate_img *= sitk.RegionOfInterest(self.contour_img, roi_size, lower)
+        void_volume_img = sitk.Paste(connect_img, dilate_img, roi_size, [0,0,0], lower)
 
         return void_volume_img
 
+    def levelSet(self, ero1_img, model_img, iterations):
+        """
+        Level set region growing of the erosion segmentation into voxels 
+        below the lower threshold. 
+
+        Args:
+            ero1_img (Image)
+            model_img (Image): greyscale image occupying the same space as ero1_img
+            iterations (int): number of level set iterations
+
+        Returns:
+            Image: voxels inside the level set are marked with the value 1.
+        """
+        return _levelSet(ero1_img, model_img, self.lower_threshold, iterations)
+
     def growVoidVolume(self, ero1_img, iterations):
         """
         Apply level set region growing filter to the erosion segmentation.
+        If localLevelSet is enabled, the level set only runs inside the padded 
+        bounding boxes of the erosions. If levelSetWorkers is greater than 1, 
+        the bounding boxes are processed in parallel worker processes. 
+        The local level set is approximate: the level set stops when the RMS 
+        change of its whole input drops below the maximum RMS error, so each 
+        bounding box can stop at a different iteration than the whole image. 
+        This changes a few voxels at the boundary of an erosion, less than 
+        2% of its voxels on the test phantom.
 
         Args:
             ero1_img (Image)
@@ -269,40 +642,77 @@ class VoidVolumeLogic:
         Returns:
             Image
         """
-        # distance map for level set filter
-        print("Applying distance map filter")
-        distance_filter = sitk.SignedMaurerDistanceMapImageFilter()
-        distance_filter.SetInsideIsPositive(True)
-        distance_filter.SetUseImageSpacing(False)
-        distance_filter.SetBackgroundValue(0)
-        distance_img = distance_filter.Execute(ero1_img)
-        
-        # level set requires spacing of [1,1,1] and float voxel type
-        distance_img.SetSpacing([1,1,1])
-        feature_img = sitk.Cast(self.model_img, sitk.sitkFloat32)
-        feature_img.SetSpacing([1,1,1])
-
-        # level set region growing
-        print("Applying level set filter")
-        ls_filter = sitk.ThresholdSegmentationLevelSetImageFilter()
-        ls_filter.SetLowerThreshold(-999999)
-        ls_filter.SetUpperThreshold(self.lower_threshold)
-        ls_filter.SetMaximumRMSError(0.02)
-        ls_filter.SetNumberOfIterations(iterations)
-        ls_filter.SetCurvatureScaling(1)
-        ls_filter.SetPropagationScaling(1)
-        ls_filter.SetReverseExpansionDirection(True)
-        ls_img = ls_filter.Execute(distance_img, feature_img)
-
-        # restore spacing
-        ls_img.SetSpacing(ero1_img.GetSpacing())
+        if self._useLocalLevelSet():
+            regions = self._erosionRegions(ero1_img, iterations + 2)
+            if self.levelSetWorkers > 1 and len(regions) > 1:
+                # split the ITK threads between the worker processes
+                workers = min(self.levelSetWorkers, len(regions))
+                threads = max((os.cpu_count() or 1) // workers, 1)
+                with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, 
+                                         initargs=(threads,)) as executor:
+                    futures = [executor.submit(_levelSet, 
+                                               sitk.RegionOfInterest(ero1_img, size, index),
+                                               sitk.RegionOfInterest(self.model_img, size, index),
+                                               self.lower_threshold, iterations)
+                               for index, size in regions]
+                    ls_imgs = [future.result() for future in futures]
+            else:
+                ls_imgs = [self.levelSet(sitk.RegionOfInterest(ero1_img, size, index),
+                                         sitk.RegionOfInterest(self.model_img, size, index), 
+                                         iterations)
+                           for index, size in regions]
+
+            # paste back in region order, so that the output is deterministic
+            output_img = ero1_img
+            for (index, size), ls_img in zip(regions, ls_imgs):
+                ls_img = ls_img | sitk.RegionOfInterest(output_img, size, index)
+                output_img = sitk.Paste(output_img, ls_img, size, [0,0,0], index)
+        else:
+            if self.levelSetWorkers > 1:
+                print("Level set workers are only used with the local level set")
+            output_img = self.levelSet(ero1_img, self.model_img, iterations)
 
         # mask the level set output with periosteal mask
-        output_img = sitk.BinaryThreshold(ls_img, lowerThreshold=1, insideValue=1)
         output_img = (output_img * self.contour_img) | ero1_img
 
         return output_img
 
+    def _useLocalLevelSet(self):
+        """
+        Returns:
+            bool: True if growVoidVolume runs the level set around each erosion
+        """
+        return self.localLevelSet
+
+    def _erosionRegions(self, ero1_img, padding):
+        """
+        Get the bounding boxes of the connected erosions, padded by the 
+        given distance and clipped to the image. Overlapping boxes are merged, 
+        so that each voxel is processed at most once. 
+
+        Args:
+            ero1_img (Image)
+            padding (int): in voxels, the level set front moves at most 
+                           one voxel per iteration
+
+        Returns:
+            list of tuple: (index, size) of each region
+        """
+        label_img = sitk.ConnectedComponent(ero1_img)
+        lss_filter = sitk.LabelShapeStatisticsImageFilter()
+        lss_filter.Execute(label_img)
+        img_size = ero1_img.GetSize()
+
+        boxes = []
+        for label in lss_filter.GetLabels():
+            bounds = lss_filter.GetBoundingBox(label)
+            lower = [max(bounds[i] - padding, 0) for i in range(3)]
+            upper = [min(bounds[i] + bounds[i+3] + padding, img_size[i]) for i in range(3)]
+            boxes.append((lower, upper, []))
+
+        return [(lower, [upper[k] - lower[k] for k in range(3)]) 
+                for lower, upper, _ in _mergeBoxes(boxes)]
+
     def labelVoidVolume(self, void_volume_img):
         """
         Label erosions with values that match the corresponding seed point numbers.
@@ -336,32 +746,175 @@ class VoidVolumeLogic:
         Executes the specified step in the algorithm, 
         returns false if reached the end of the algorithm, 
         returns true otherwise.
+        In the low memory mode, the peak resident memory of each step is 
+        recorded in peakRSS.
+
+        Args:
+            step(int): 1 <= step <= self.stepNum
+        """
+        if self.lowMemory:
+            _resetPeakRSS()
+        running = self._executeStep(step)
+        if self.lowMemory and running:
+            self.peakRSS[step] = _peakRSS()
+            if self.peakRSS[step] is not None:
+                print("Step {} peak RSS: {:.0f} MB".format(step, self.peakRSS[step] / 1024**2))
+        return running
+
+    def _executeStep(self, step):
+        """
+        Executes the specified step in the algorithm.
+        If the stage cache is enabled, the output of each step is looked up 
+        by the input images and the parameters consumed so far. The low memory
+        mode bypasses the cache.
 
         Args:
             step(int): 1 <= step <= self.stepNum
+
+        Returns:
+            bool: False if reached the end of the algorithm, True otherwise.
         """
         if step == 1:
+            model_key = None
+            self._cacheKey = None
+            if self.lowMemory:
+                self.peakRSS = {}
+            else:
+                # hash the scan once for both caches
+                model_key = self.preprocessing.imageKey(self.model_img)
+                if self.cache.memoryLimit > 0:
+                    self._cacheKey = ('denoise', model_key or imageHash(self.model_img), 
+                                      imageHash(self.contour_img), self.sigma)
             self._initializeParams()
-            self.model_img = self.denoise(self.model_img, self.sigma)
+            self.model_img = self.denoise(self.model_img, self.sigma, model_key)
         elif step == 2:
-            self.ero1_img = self.createROI(self.model_img)
+            self._cacheKey = self._extendKey(self._cacheKey, 'roi', self.auto_thresh, self.method,
+                                             self.lower_threshold, self.upper_threshold)
+            self.ero1_img = self._cached(self._cacheKey, lambda: self.createROI(self.model_img))
         elif step == 3:
-            self.ero1_img = self.distanceVoidVolume(self.ero1_img, self.minimalRadius[0])
+            # the distance map is shared, only the threshold depends on the radius
+            distance_img = self._cached(self._extendKey(self._cacheKey, 'distance map'),
+                                        lambda: self.distanceMapVoidVolume(self.ero1_img))
+            distance_imgs = {}
+            for radius in set(group[0] for group in self._seedGroups):
+                distance_imgs[radius] = self._cached(
+                    self._extendKey(self._cacheKey, 'distance', radius),
+                    lambda: self.distanceVoidVolume(self.ero1_img, radius, distance_img))
+            self._group_imgs = {(minimalRadius, dilateErodeDistance): distance_imgs[minimalRadius]
+                                for minimalRadius, dilateErodeDistance, _ in self._seedGroups}
         elif step == 4:
-            self.ero1_img = self.erodeVoidVolume(self.ero1_img, self.dilateErodeDistance[0])
+            # erode only the boxes of the voids connected to the seeds of each group
+            for minimalRadius, dilateErodeDistance, seeds in self._seedGroups:
+                key = (minimalRadius, dilateErodeDistance)
+                self._group_regions[key] = self.seedRegions(self._group_imgs[key], seeds, 
+                                                            dilateErodeDistance)
+                self._group_imgs[key] = self._cached(
+                    self._extendKey(self._cacheKey, 'distance', minimalRadius, 'erode', 
+                                    dilateErodeDistance, tuple(seeds)),
+                    lambda: self.erodeSeedRegions(self._group_imgs[key], self._group_regions[key], 
+                                                  dilateErodeDistance))
         elif step == 5:
-            self.ero1_img = self.connectVoidVolume(self.ero1_img)
+            for minimalRadius, dilateErodeDistance, seeds in self._seedGroups:
+                key = (minimalRadius, dilateErodeDistance)
+                self._group_imgs[key] = self._cached(
+                    self._extendKey(self._cacheKey, 'distance', minimalRadius, 'erode', 
+                                    dilateErodeDistance, tuple(seeds), 'connect'),
+                    lambda: self.connectSeedRegions(self._group_imgs[key], self._group_regions[key], 
+                                                    dilateErodeDistance))
+            self._group_regions = {}
         elif step == 6:
-            self.ero1_img = self.dilateVoidVolume(self.ero1_img, self.dilateErodeDistance[0])
+            for minimalRadius, dilateErodeDistance, seeds in self._seedGroups:
+                key = (minimalRadius, dilateErodeDistance)
+                self._group_imgs[key] = self._cached(
+                    self._extendKey(self._cacheKey, 'distance', minimalRadius, 'erode', 
+                                    dilateErodeDistance, tuple(seeds), 'connect', 'dilate'),
+                    lambda: self.dilateVoidVolume(self._group_imgs[key], dilateErodeDistance))
+            self._cacheKey = self._extendKey(self._cacheKey, 'dilate', 
+                                             tuple((minimalRadius, dilateErodeDistance, tuple(seeds))
+                                                   for minimalRadius, dilateErodeDistance, seeds 
+                                                   in self._seedGroups))
         elif step == 7:
             iterations = 100
-            self.output_img = self.growVoidVolume(self.ero1_img, iterations)
+            self._cacheKey = self._extendKey(self._cacheKey, 'grow', iterations, self._useLocalLevelSet())
+            self.output_img = self._cached(self._cacheKey, lambda: self._growGroups(iterations))
+            self._group_imgs = {}
         elif step == 8:
-            self.output_img = self.labelVoidVolume(self.output_img)
+            self._cacheKey = self._extendKey(self._cacheKey, 'label', tuple(self.erosionIds))
+            self.output_img = self._cached(self._cacheKey, 
+                                           lambda: self.labelVoidVolume(self.output_img))
         else: # the end of the algorithm
             return False
         return True
 
+    def _emit(self, name, img):
+        """
+        Pass an intermediate image to the intermediate sink, if one is set.
+
+        Args:
+            name (str)
+            img (Image)
+        """
+        if self.intermediateSink is not None:
+            self.intermediateSink(name, img)
+
+    def _growGroups(self, iterations):
+        """
+        Grow the dilated voids of each seed group with its own level set and 
+        merge the groups, so that the output is the same as running the 
+        algorithm once for each radii setting. The level set stops when the 
+        whole image has converged, so growing the merged groups at once would
+        change the output.
+
+        Args:
+            iterations (int): number of level set iterations
+
+        Returns:
+            Image
+        """
+        output_img = self.ero1_img * 0
+        # release the image of each group as soon as it is grown
+        while self._group_imgs:
+            key, void_volume_img = self._group_imgs.popitem()
+            output_img |= self.growVoidVolume(void_volume_img, iterations)
+
+        return output_img
+
+    def _cached(self, key, compute):
+        """
+        Get the output of a step from the stage cache, or compute and store it.
+
+        Args:
+            key (tuple): input image hashes and parameters consumed so far, 
+                         None if the cache is disabled
+            compute (function): computes the output of the step
+
+        Returns:
+            Image
+        """
+        if key is None:
+            return compute()
+        img = self.cache.get(key)
+        if img is None:
+            img = compute()
+            self.cache.put(key, img)
+        else:
+            print("Using cached result")
+
+        return img
+
+    def _extendKey(self, key, *params):
+        """
+        Args:
+            key (tuple): cache key of the previous step, None if the cache is disabled
+            params: parameters consumed by the next step
+
+        Returns:
+            tuple
+        """
+        if key is None:
+            return None
+        return key + params
+
     def setModelImage(self, img):
         """
         Args:
@@ -394,7 +947,8 @@ class VoidVolumeLogic:
 
     def _initializeParams(self):
         """
-        Crop the bone model so that it occupies the same physcial space as the mask.
+        Find the region of the bone model inside the bounding box of the mask,
+        which is cropped in denoise. 
         Update the seed point coordinates based on the cropped bone model, 
         and remove seed points that are outside the periosteal mask.
         """
@@ -407,9 +961,7 @@ class VoidVolumeLogic:
         model_size = self.model_img.GetSize()
         direction = self.model_img.GetDirection()
 
-        # crop bone model
-        model_img = sitk.Image(width, height, depth, self.model_img.GetPixelID())
-        model_img.CopyInformation(self.contour_img)
+        # index of the first bone model voxel in the mask
         destination_x = round((model_origin[0] - contour_origin[0]) / spacing)
         destination_y = round((model_origin[1] - contour_origin[1]) / spacing)
         destination_z = round((model_origin[2] - contour_origin[2]) / spacing)
@@ -419,11 +971,16 @@ class VoidVolumeLogic:
         r.SetMatrix(direction)
         destination_index = r.TransformPoint((destination_x, destination_y, destination_z))
         destination_index = (round(destination_index[0]), round(destination_index[1]), round(destination_index[2]))
-        paste_filter = sitk.PasteImageFilter()
-        paste_filter.SetDestinationIndex(destination_index)
-        paste_filter.SetSourceSize(model_size)
-        self.model_img = paste_filter.Execute(model_img, self.model_img)
-        print(model_img.GetOrigin())
+        self._destination_index = destination_index
+
+        # region of the bone model inside the mask bounding box
+        mask_size = (width, height, depth)
+        lower = [max(-destination_index[i], 0) for i in range(3)]
+        upper = [min(mask_size[i] - destination_index[i], model_size[i]) for i in range(3)]
+        if all(upper[i] > lower[i] for i in range(3)):
+            self._region = (tuple(lower), tuple(upper[i] - lower[i] for i in range(3)))
+        else: # the bone model does not overlap the mask
+            self._region = None
         
         # update seed points
         destination_x *= int(direction[0])
@@ -431,6 +988,10 @@ class VoidVolumeLogic:
         destination_z *= int(direction[8])
         self._seeds_crop = [(seed[0]+destination_x, seed[1]+destination_y, seed[2]+destination_z)
                             for seed in self.seeds]
+        if not isinstance(self.minimalRadius, list):
+            self.minimalRadius = [self.minimalRadius] * len(self.seeds)
+        if not isinstance(self.dilateErodeDistance, list):
+            self.dilateErodeDistance = [self.dilateErodeDistance] * len(self.seeds)
         for i, seed in reversed(list(enumerate(self._seeds_crop))):
             is_in_range = ((0 <= seed[0] < width) and 
                            (0 <= seed[1] < height) and 
@@ -438,6 +999,47 @@ class VoidVolumeLogic:
             if not is_in_range:
                 self._removeNthSeed(i)
 
+        self._seedGroups = self._groupSeeds()
+
+    def _groupSeeds(self):
+        """
+        Group the seed points by their minimum radius and dilate/erode distance,
+        so that the morphological steps run once for each radii setting.
+
+        Returns:
+            list of tuple: (minimalRadius, dilateErodeDistance, seeds) for each group, 
+                           in the order the settings first appear
+        """
+        groups = {}
+        for seed, minimalRadius, dilateErodeDistance in zip(self._seeds_crop, 
+                                                            self.minimalRadius, 
+                                                            self.dilateErodeDistance):
+            groups.setdefault((minimalRadius, dilateErodeDistance), []).append(seed)
+
+        return [(key[0], key[1], seeds) for key, seeds in groups.items()]
+
+    def _pasteToMask(self, img, pixelID=None):
+        """
+        Paste the region of the bone model from _initializeParams into an image 
+        of the size of the mask. Voxels of the mask outside the bone model are 0.
+
+        Args:
+            img (Image): region of the bone model, None for a blank image
+            pixelID (int): pixel type of the blank image
+
+        Returns:
+            Image
+        """
+        model_img = sitk.Image(self.contour_img.GetSize(), 
+                               img.GetPixelID() if img is not None else pixelID)
+        model_img.CopyInformation(self.contour_img)
+        if img is None:
+            return model_img
+
+        index, size = self._region
+        return sitk.Paste(model_img, img, size, [0, 0, 0],
+                          [index[i] + self._destination_index[i] for i in range(3)])
+
     def setThresholds(self, lower_threshold, upper_threshold):
         """
         Args:
@@ -468,8 +1070,10 @@ class VoidVolumeLogic:
     def setRadii(self, minimalRadius, dilateErodeDistance):
         """
         Args:
-            minimalRadius (int[]): minimum erosion radius, used in the distance map filter
-            dilateErodeDistance (int[]): kernel radius for dilate/erode filters
+            minimalRadius (int[]): minimum erosion radius of each seed point, 
+                                   used in the distance map filter
+            dilateErodeDistance (int[]): kernel radius for dilate/erode filters 
+                                         of each seed point
         """
         self.minimalRadius = minimalRadius
         self.dilateErodeDistance = dilateErodeDistance
@@ -507,6 +1111,49 @@ class VoidVolumeLogic:
     def getOutput(self):
         return self.output_img
 
+    def setLocalLevelSet(self, localLevelSet):
+        """
+        Args:
+            localLevelSet (bool): If True, the level set runs only inside the 
+                                  padded bounding box of each erosion. The 
+                                  output is approximate, see growVoidVolume.
+        """
+        self.localLevelSet = localLevelSet
+
+    def setLevelSetWorkers(self, levelSetWorkers):
+        """
+        Args:
+            levelSetWorkers (int): Number of worker processes for the local level set. 
+                                   Not used unless the local level set is enabled.
+        """
+        self.levelSetWorkers = levelSetWorkers
+
+    def setIntermediateSink(self, sink):
+        """
+        Args:
+            sink (callable): Called with (name, image) for each intermediate image,
+                             e.g. DirectorySink or MemorySink. None disables it.
+        """
+        self.intermediateSink = sink
+
+    def setLowMemory(self, lowMemory):
+        """
+        Args:
+            lowMemory (bool): If True, the greyscale image is kept in single precision,
+                              the stage cache is bypassed, and the peak memory 
+                              of each step is reported.
+        """
+        self.lowMemory = lowMemory
+
+    def setCacheLimit(self, memoryLimit):
+        """
+        Args:
+            memoryLimit (int): Memory limit of the stage cache and of the shared
+                               preprocessing cache in bytes, 0 disables the caches.
+        """
+        self.cache.setMemoryLimit(memoryLimit)
+        self.preprocessing.setMemoryLimit(memoryLimit)
+
     def setThreshMethod(self, method):
         '''Set automatic thresholding method'''
         self.auto_thresh = True
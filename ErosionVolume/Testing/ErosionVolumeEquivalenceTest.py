@@ -0,0 +1,233 @@
+#-----------------------------------------------------
+# ErosionVolumeEquivalenceTest.py
+#
+# Created on:  17-10-2026
+#
+# Description: This module checks that the optimised code paths of the
+#              ErosionVolume module give the same output as the plain ones.
+#              It runs on a synthetic scan without 3D Slicer.
+#
+#-----------------------------------------------------
+# Usage:       python -m unittest ErosionVolumeEquivalenceTest
+#
+#-----------------------------------------------------
+import SimpleITK as sitk
+import numpy as np
+import contextlib, io, os, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ErosionVolumeLib'))
+import Preprocessing
+from ErosionVolumeCmd import buildManifest
+from Preprocessing import gaussian, gaussianRegion
+from VoidVolumeLogic import VoidVolumeLogic
+
+def makePhantom(depth=40, width=100, seed=0):
+    """
+    Noisy cortical shell with trabeculae and two erosions, inside a mask
+    that does not reach the scan borders.
+
+    Returns:
+        tuple: scan, mask, (x,y,z) seed points of the erosions
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.mgrid[0:depth, 0:width, 0:width]
+    arr = rng.normal(0, 60, (depth, width, width)).astype(np.float32)
+    r = np.sqrt((y - width/2)**2 + (x - width/2)**2)
+    arr[(r < 30) & (r >= 24)] += 1200
+    arr[(r < 24) & (np.sin(x*0.9) + np.sin(y*0.9) + np.sin(z*0.9) > 0.8)] += 900
+    mask = ((r <= 31) & (z >= 5) & (z < depth - 5)).astype(np.uint8)
+
+    seeds = [(width//2 + 28, width//2, depth//2), (width//2, width//2 - 28, depth//3)]
+    for cx, cy, cz in seeds:
+        erosion = (x - cx)**2 + (y - cy)**2 + (z - cz)**2 < 36
+        arr[erosion] = rng.normal(0, 60, erosion.sum())
+
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.0607] * 3)
+    img.SetOrigin([3.0, -2.0, 10.0])
+    mask_img = sitk.GetImageFromArray(mask)
+    mask_img.CopyInformation(img)
+    return img, mask_img, seeds
+
+def makeBlock(depth=30, width=(300, 40), seed=0):
+    """
+    Noisy bone block with two erosions far apart, so that the bounding boxes
+    of the local level set do not cover the whole scan.
+
+    Returns:
+        tuple: scan, mask, (x,y,z) seed points of the erosions
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.mgrid[0:depth, 0:width[1], 0:width[0]]
+    arr = rng.normal(1200, 60, (depth, width[1], width[0])).astype(np.float32)
+    seeds = []
+    for cx, cy, cz, radius in ((20, 20, 15, 5), (280, 20, 15, 7)):
+        erosion = (x - cx)**2 + (y - cy)**2 + (z - cz)**2 < radius**2
+        # a channel along one side of the erosion
+        erosion |= ((x - cx)**2 + (y - cy + radius)**2 < 4) & (abs(z - cz) < radius)
+        arr[erosion] = rng.normal(0, 60, erosion.sum())
+        seeds.append((cx, cy, cz))
+
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing([0.0607] * 3)
+    mask = np.zeros(arr.shape, dtype=np.uint8)
+    mask[2:-2, 2:-2, 2:-2] = 1
+    mask_img = sitk.GetImageFromArray(mask)
+    mask_img.CopyInformation(img)
+    return img, mask_img, seeds
+
+def runVoidVolume(logic):
+    with contextlib.redirect_stdout(io.StringIO()):
+        step = 1
+        while logic.execute(step):
+            step += 1
+    return sitk.GetArrayFromImage(logic.getOutput())
+
+class ErosionVolumeEquivalenceTest(unittest.TestCase):
+
+    def test_GaussianRegion(self):
+        '''
+        Smoothing a region with its margin matches the region of the smoothed scan.
+        '''
+        img, mask_img, seeds = makePhantom()
+        for sigma in (0.8, 1, 2):
+            with contextlib.redirect_stdout(io.StringIO()):
+                whole = sitk.GetArrayFromImage(gaussian(img, sigma))
+                region = sitk.GetArrayFromImage(gaussianRegion(img, sigma, ((10, 20, 5), (70, 50, 8))))
+            np.testing.assert_allclose(region, whole[5:13, 20:70, 10:80], rtol=0, atol=1e-4)
+
+    def test_Denoise(self):
+        '''
+        Erosions are the same with the scan cropped to the mask box before smoothing
+        as with the whole scan smoothed, in the normal and the low memory modes.
+        '''
+        img, mask_img, seeds = makePhantom()
+
+        # the denoised bone model is the whole smoothed scan inside the mask
+        logic = VoidVolumeLogic(img, None, 530, 15000, 1, list(seeds), 3, 4)
+        logic.setContourImage(mask_img)
+        with contextlib.redirect_stdout(io.StringIO()):
+            logic.execute(1)
+            whole_img = gaussian(img, 1)
+        whole_img = sitk.Resample(whole_img, logic.model_img, sitk.Transform(), 
+                                  sitk.sitkNearestNeighbor, 0, whole_img.GetPixelID())
+        inside = sitk.GetArrayFromImage(logic.contour_img) > 0
+        np.testing.assert_allclose(sitk.GetArrayFromImage(logic.model_img)[inside], 
+                                   sitk.GetArrayFromImage(whole_img)[inside], rtol=0, atol=1e-4)
+
+        margin = Preprocessing.GAUSSIAN_MARGIN
+        for lowMemory in (False, True):
+            outputs = []
+            # a margin larger than the scan smooths the whole scan
+            for Preprocessing.GAUSSIAN_MARGIN in (margin, max(img.GetSize())):
+                logic = VoidVolumeLogic(img, None, 530, 15000, 1, list(seeds), 3, 4)
+                logic.setContourImage(mask_img)
+                logic.setLowMemory(lowMemory)
+                outputs.append(runVoidVolume(logic))
+            Preprocessing.GAUSSIAN_MARGIN = margin
+            self.assertGreater(np.count_nonzero(outputs[1]), 0)
+            np.testing.assert_array_equal(outputs[0], outputs[1])
+
+    def test_SeedGroups(self):
+        '''
+        The erode and connect steps in the boxes around the seed points match 
+        the steps on the whole image, and grouping the seed points by their 
+        radii gives the same erosions as one run for each radii setting.
+        '''
+        img, mask_img, seeds = makePhantom()
+        # a third erosion, with the radii of the second one
+        arr = sitk.GetArrayFromImage(img)
+        z, y, x = np.mgrid[0:arr.shape[0], 0:arr.shape[1], 0:arr.shape[2]]
+        arr[(x - 22)**2 + (y - 50)**2 + (z - 28)**2 < 25] = 0
+        img = sitk.GetImageFromArray(arr)
+        img.CopyInformation(mask_img)
+        seeds.append((22, 50, 28))
+        minimalRadius, dilateErodeDistance = [3, 2, 2], [4, 3, 3]
+
+        # boxes against the whole image, on the distance map of each group
+        logic = VoidVolumeLogic(img, None, 530, 15000, 1, list(seeds), 
+                                list(minimalRadius), list(dilateErodeDistance))
+        logic.setContourImage(mask_img)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for step in (1, 2, 3):
+                logic.execute(step)
+            for radius, distance, group_seeds in logic._seedGroups:
+                distance_img = logic._group_imgs[(radius, distance)]
+                regions = logic.seedRegions(distance_img, group_seeds, distance)
+                erode_img = logic.erodeSeedRegions(distance_img, regions, distance)
+                connect_img = logic.connectSeedRegions(erode_img, regions, distance)
+                reference = logic.connectVoidVolume(logic.erodeVoidVolume(distance_img, distance),
+                                                    group_seeds, distance)
+                self.assertGreater(np.count_nonzero(sitk.GetArrayFromImage(reference)), 0)
+                np.testing.assert_array_equal(sitk.GetArrayFromImage(connect_img),
+                                              sitk.GetArrayFromImage(reference))
+
+        # one run for each radii setting
+        logic = VoidVolumeLogic(img, None, 530, 15000, 1, list(seeds), 
+                                list(minimalRadius), list(dilateErodeDistance))
+        logic.setContourImage(mask_img)
+        output = runVoidVolume(logic)
+        reference = np.zeros_like(output)
+        for radius, distance in set(zip(minimalRadius, dilateErodeDistance)):
+            setting = [i for i in range(len(seeds)) 
+                       if (minimalRadius[i], dilateErodeDistance[i]) == (radius, distance)]
+            logic = VoidVolumeLogic(img, None, 530, 15000, 1, [seeds[i] for i in setting], 
+                                    radius, distance)
+            logic.setContourImage(mask_img)
+            logic.setErosionIds([i + 1 for i in setting])
+            setting_output = runVoidVolume(logic)
+            reference[setting_output > 0] = setting_output[setting_output > 0]
+        self.assertEqual(len(np.unique(reference)), len(seeds) + 1)
+        np.testing.assert_array_equal(output, reference)
+
+    def test_LocalLevelSet(self):
+        '''
+        The level set workers and the low memory mode alone give the output of
+        the whole image level set. The local level set, serial and in worker
+        processes, differs from it in at most 2% of the voxels of each erosion.
+        '''
+        img, mask_img, seeds = makeBlock()
+
+        def run(localLevelSet=False, workers=1, lowMemory=False):
+            logic = VoidVolumeLogic(img, None, 530, 15000, 1, list(seeds), 2, 2)
+            logic.setContourImage(mask_img)
+            logic.setLocalLevelSet(localLevelSet)
+            logic.setLevelSetWorkers(workers)
+            logic.setLowMemory(lowMemory)
+            return runVoidVolume(logic)
+
+        reference = run()
+        np.testing.assert_array_equal(run(workers=2), reference)
+        np.testing.assert_array_equal(run(lowMemory=True), reference)
+        for workers in (1, 2):
+            output = run(localLevelSet=True, workers=workers)
+            for label in range(1, len(seeds) + 1):
+                erosion = np.count_nonzero(reference == label)
+                self.assertGreater(erosion, 0)
+                self.assertLessEqual(np.count_nonzero((output == label) != (reference == label)),
+                                     0.02 * erosion)
+
+    def test_Manifest(self):
+        '''
+        The seed file of a scan is only used for a contour without its own seed
+        file when the scan has one contour.
+        '''
+        with tempfile.TemporaryDirectory() as folder:
+            names = {'images': ['SCAN_1.nii', 'SCAN_10.nii', 'SCAN_2.nii'],
+                     'contours': ['SCAN_1_MASK.nii', 'SCAN_10_MASK1.nii', 'SCAN_10_MASK2.nii',
+                                  'SCAN_2_MASK1.nii', 'SCAN_2_MASK2.nii'],
+                     'seeds': ['SCAN_1_SEEDS.json', 'SCAN_10_SEEDS.json', 
+                               'SCAN_2_MASK1_SEEDS.json', 'SCAN_2_BREAKS.nii']}
+            for sub, files in names.items():
+                os.mkdir(os.path.join(folder, sub))
+                for name in files:
+                    open(os.path.join(folder, sub, name), 'w').close()
+            with contextlib.redirect_stdout(io.StringIO()):
+                manifest = buildManifest(*[os.path.join(folder, sub) for sub in names])
+            pairs = [(os.path.basename(entry['contour']), 
+                      [os.path.basename(name) for name in entry['seeds']]) for entry in manifest]
+            self.assertEqual(pairs, [('SCAN_1_MASK.nii', ['SCAN_1_SEEDS.json']),
+                                     ('SCAN_2_MASK1.nii', ['SCAN_2_MASK1_SEEDS.json'])])
+
+if __name__ == '__main__':
+    unittest.main()